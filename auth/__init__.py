@@ -15,5 +15,9 @@ from __future__ import annotations
 
 from auth.datastore import cloud_storage
 from auth.datastore import firestore
+from auth.datastore import indexed_file
 from auth.datastore import local_file
+from auth.datastore import log_structured
 from auth.datastore import secret_manager
+from auth.datastore import sharded_cloud_storage
+from auth.datastore import sqlite
@@ -13,7 +13,7 @@
 # limitations under the License.
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Mapping, Optional
 
 
 class AbstractDatastore(object):
@@ -44,6 +44,25 @@ class AbstractDatastore(object):
     """
     raise NotImplementedError('Must be implemented by child class.')
 
+  def get_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents at once.
+
+    Concrete datastores should override this with their native batch read.
+    This default simply fetches the documents one at a time.
+
+    Arguments:
+        ids (List[str]): the document ids
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id; ids that
+                                   are not present are omitted
+    """
+    documents = {}
+    for id in ids:
+      if (document := self.get_document(id=id)) is not None:
+        documents[id] = document
+    return documents
+
   def store_document(self, id: str,
                      document: Dict[str, Any]) -> None:
     """Stores a document.
@@ -70,6 +89,77 @@ class AbstractDatastore(object):
     """
     raise NotImplementedError('Must be implemented by child class.')
 
+  def refresh_document(self, id: str,
+                       refresh: Callable[[], Dict[str, Any]],
+                       is_fresh: Callable[[Dict[str, Any]], bool]
+                       ) -> Dict[str, Any]:
+    """Refreshes a document, if no one else already has.
+
+    `refresh` makes the new document (for a token, by calling the token
+    endpoint), which is then stored with `update_document`. Datastores that
+    can coordinate writers in different processes override this so that,
+    when many see the same stale document, only one calls `refresh`: the
+    others wait for it and return what it stored, which `is_fresh` accepts.
+    This default cannot, so it always refreshes and never calls `is_fresh`.
+
+    Arguments:
+        id (str): document id
+        refresh (Callable[[], Dict[str, Any]]): makes the new document
+        is_fresh (Callable[[Dict[str, Any]], bool]): whether a stored
+            document no longer needs refreshing
+
+    Returns:
+        Dict[str, Any]: the new document, or the fresh one found instead
+    """
+    document = refresh()
+    self.update_document(id=id, new_data=document)
+    return document
+
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents at once.
+
+    Concrete datastores should override this with their native bulk write.
+    This default simply stores the documents one at a time.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that stopped it
+    """
+    return self._write_each(self.store_document, documents)
+
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents at once.
+
+    Concrete datastores should override this with their native bulk write.
+    This default simply updates the documents one at a time.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that stopped it
+    """
+    return self._write_each(self.update_document, documents)
+
+  def _write_each(self, write: Callable[[str, Dict[str, Any]], Any],
+                  documents: Mapping[str, Dict[str, Any]]
+                  ) -> Dict[str, Optional[Exception]]:
+    """Writes documents one at a time, recording each one's outcome."""
+    results = {}
+    for id, document in documents.items():
+      try:
+        write(id, document)
+        results[id] = None
+      except Exception as e:
+        results[id] = e
+    return results
+
   def delete_document(self, id: str, key: Optional[str]=None) -> None:
     """Deletes a document.
 
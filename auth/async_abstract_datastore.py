@@ -0,0 +1,117 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class AsyncAbstractDatastore(object):
+  """Abstract asynchronous Datastore.
+
+  The asyncio counterpart of `AbstractDatastore`, used by `AsyncCredentials`.
+  Every method is a coroutine with the same arguments and meaning as its
+  blocking equivalent, so a caller on an event loop never blocks it waiting
+  for storage.
+
+  All unimplemented functions raise a NotImplementedError() rather than
+  simply 'pass'.
+  """
+  async def get_document(self, id: str,
+                         key: Optional[str] = None) -> Dict[str, Any]:
+    """Fetches a document.
+
+    Arguments:
+        id (str): document id
+        key: Optional(str): the document collection sub-key
+
+    Returns:
+        Dict[str, Any]: stored configuration dictionary, or None
+                          if not present
+    """
+    raise NotImplementedError('Must be implemented by child class.')
+
+  async def store_document(self, id: str, document: Dict[str, Any]) -> None:
+    """Stores a document.
+
+    Arguments:
+        id (str): the id of the document
+        document (Dict[str, Any]): the document content
+    """
+    raise NotImplementedError('Must be implemented by child class.')
+
+  async def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    If the document is not already there, it will be created as a net-new
+    document. If it is, it will be updated.
+
+    Args:
+        id (str): the id of the document within the collection.
+        new_data (Dict[str, Any]): the document content.
+    """
+    raise NotImplementedError('Must be implemented by child class.')
+
+  async def refresh_document(self, id: str,
+                             refresh: Callable[[], Awaitable[Dict[str, Any]]],
+                             is_fresh: Callable[[Dict[str, Any]], bool]
+                             ) -> Dict[str, Any]:
+    """Refreshes a document, if no one else already has.
+
+    See `AbstractDatastore.refresh_document`; here `refresh` is a coroutine
+    function. This default always refreshes and never calls `is_fresh`.
+
+    Arguments:
+        id (str): document id
+        refresh (Callable[[], Awaitable[Dict[str, Any]]]): makes the new
+            document
+        is_fresh (Callable[[Dict[str, Any]], bool]): whether a stored
+            document no longer needs refreshing
+
+    Returns:
+        Dict[str, Any]: the new document, or the fresh one found instead
+    """
+    document = await refresh()
+    await self.update_document(id=id, new_data=document)
+    return document
+
+  async def delete_document(self, id: str, key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    If a key is supplied, then just that key is removed from the document. If
+    no key is given, the entire document will be removed.
+
+    Args:
+        id (str): the id of the document within the collection.
+        key (str, optional): the key to remove. Defaults to None.
+    """
+    raise NotImplementedError('Must be implemented by child class.')
+
+  async def list_documents(self, key: Optional[str] = None) -> List[str]:
+    """Lists documents in a collection.
+
+    Args:
+        key (str, optional): the sub-key. Defaults to None.
+
+    Returns:
+        List[str]: the list
+    """
+    raise NotImplementedError('Must be implemented by child class.')
+
+  async def get_all_documents(self) -> List[Dict[str, Any]]:
+    """Fetches all documents.
+
+    Returns:
+        List[Dict[str, Any]]: contents of all documents
+    """
+    raise NotImplementedError('Must be implemented by child class.')
@@ -0,0 +1,286 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, Mapping, Optional, Type, TypeVar, Union
+
+from google.auth import transport as google_transport
+from google.oauth2 import credentials as oauth
+
+try:
+  # Private to google-auth; requirements.txt pins the versions that have it.
+  from google.oauth2 import _credentials_async as oauth_async
+except ImportError as e:
+  raise ImportError('AsyncCredentials needs google.oauth2._credentials_async, '
+                    'which the installed google-auth does not have.') from e
+
+from auth import transport as auth_transport
+from auth.async_abstract_datastore import AsyncAbstractDatastore
+from auth.credentials import ProjectCredentials
+from auth.credentials_helpers import (cache_key, credentials_to_dict,
+                                      encode_key)
+from auth.exceptions import CredentialsError
+from auth.single_flight import AsyncSingleFlight
+from auth.token_cache import DEFAULT_TOKEN_CACHE, TokenCache
+
+
+class AsyncCredentials(object):
+  """AsyncCredentials.
+
+  The asyncio counterpart of `Credentials`. Everything that touches the
+  datastore or the token endpoint is a coroutine, backed by an
+  `AsyncAbstractDatastore` and an `aiohttp` refresh transport, so many users
+  can be served concurrently from one event loop without blocking it or
+  needing a thread pool:
+
+      creds = AsyncCredentials(datastore=..., email='<user email>')
+      headers = await creds.auth_headers()
+
+  Built credentials share the `TokenCache` used by `Credentials`, and
+  concurrent refreshes of the same user's token on one event loop are
+  coalesced into one refresh and one write.
+  """
+  _email: str = None
+  _project: str = None
+
+  # Refreshes in flight, keyed by event loop and `cache_key`.
+  _refreshes: AsyncSingleFlight = AsyncSingleFlight()
+
+  TDatastore = TypeVar('TDatastore', bound=AsyncAbstractDatastore)
+
+  def __init__(self,
+               datastore: Union[Type[TDatastore], AsyncAbstractDatastore],
+               email: str = None,
+               project: str = None,
+               token_cache: Optional[TokenCache] = None,
+               transport: Optional[google_transport.Request] = None,
+               **dsargs) -> AsyncCredentials:
+    self._email = email
+    self._project = project
+    self._token_cache = \
+        DEFAULT_TOKEN_CACHE if token_cache is None else token_cache
+    self._transport = transport
+    self._project_credentials = None
+    if isinstance(datastore, AsyncAbstractDatastore):
+      self._datastore = datastore
+    else:
+      self._datastore = datastore(email=email, project=project, **dsargs)
+
+  @property
+  def datastore(self) -> AsyncAbstractDatastore:
+    """The datastore property."""
+    return self._datastore
+
+  @datastore.setter
+  def datastore(self, f: AsyncAbstractDatastore) -> None:
+    """datastore setter
+
+    As with `Credentials`, the datastore cannot be changed once set.
+
+    Raises:
+        KeyError: the datastore should be immutable
+    """
+    raise KeyError('Datastore can only be set on instantiation.')
+
+  @property
+  def email(self) -> str:
+    """The email of the user whose credentials these are."""
+    return self._email
+
+  @property
+  def cache_key(self) -> str:
+    """The key of these credentials in the token cache (see `cache_key`)."""
+    return cache_key(self.datastore, self._email)
+
+  @property
+  def token_cache(self) -> TokenCache:
+    """The token cache property."""
+    return self._token_cache
+
+  @property
+  def transport(self) -> google_transport.Request:
+    """The async HTTP transport used to refresh tokens.
+
+    Unless one was given on instantiation, this is the pooled transport shared
+    by everything on the running event loop.
+    """
+    return self._transport or auth_transport.default_async_transport()
+
+  async def project_credentials(self) -> ProjectCredentials:
+    """The project credentials.
+
+    These are only fetched once from the datastore for the life of the
+    object.
+
+    Returns:
+        ProjectCredentials: the project client id and secret as a dataclass
+    """
+    if not self._project_credentials:
+      secrets = None
+      if secrets := await self.datastore.get_document(id='client_id'):
+        secrets |= await self.datastore.get_document(id='client_secret')
+
+      elif client_secret := await self.datastore.get_document(
+              id='client_secret'):
+        secrets = \
+            client_secret.get('web') or \
+            client_secret.get('installed')
+
+      self._project_credentials = \
+          ProjectCredentials(client_id=secrets['client_id'],
+                             client_secret=secrets['client_secret']) \
+          if secrets else None
+
+    return self._project_credentials
+
+  async def token_details(self) -> Dict[str, Any]:
+    """The users's OAuth token, as stored."""
+    return await self.datastore.get_document(id=encode_key(self._email))
+
+  async def store_credentials(
+          self, creds: Union[oauth.Credentials, Mapping[str, Any]]) -> None:
+    """Stores the credentials.
+
+    Args:
+        creds (oauth.Credentials): the credentials or their `dict` form
+    """
+    if self._email:
+      key = encode_key(self._email)
+
+      if isinstance(creds, oauth.Credentials):
+        await self.datastore.update_document(id=key,
+                                             new_data=credentials_to_dict(creds))
+        self.token_cache.put(self.cache_key, creds)
+      else:
+        await self.datastore.update_document(id=key, new_data=creds)
+        self.token_cache.invalidate(self.cache_key)
+
+  async def refresh(self) -> oauth.Credentials:
+    """Refreshes the user's token now, whether or not it has expired.
+
+    Returns:
+        google.oauth2.credentials.Credentials: the refreshed credentials
+    """
+    creds = oauth_async.Credentials.from_authorized_user_info(
+        credentials_to_dict(await self.credentials()))
+    return await self._refresh_credentials(creds=creds, force=True)
+
+  async def _refresh_credentials(self,
+                                 creds: oauth_async.Credentials,
+                                 force: bool = False) -> oauth.Credentials:
+    """Refreshes the Google OAuth credentials.
+
+    Concurrent refreshes for the same user are coalesced, as they are in
+    `Credentials._refresh_credentials`.
+
+    Args:
+        creds (oauth_async.Credentials): the credentials to refresh
+        force (bool): refresh even if the cache holds a fresh token
+
+    Returns:
+        google.oauth2.credentials.Credentials: the credentials
+    """
+    if not self._email:
+      return await self._refresh_and_store(creds)
+
+    key = self.cache_key
+
+    async def _refresh() -> oauth.Credentials:
+      if not force and (fresh := self.token_cache.get(key)):
+        return fresh
+      return await self._refresh_and_store(creds)
+
+    return await self._refreshes.do(key, _refresh)
+
+  async def _refresh_and_store(
+          self, creds: oauth_async.Credentials) -> oauth.Credentials:
+    """Refreshes the credentials and writes them back to the datastore.
+
+    As in `Credentials._refresh_and_store`, this goes through the datastore's
+    `refresh_document`, so only one of the processes holding a stale token
+    refreshes it.
+
+    Returns:
+        google.oauth2.credentials.Credentials: the refreshed credentials
+    """
+    if not self._email:
+      await creds.refresh(self.transport)
+      return creds
+
+    key = encode_key(self._email)
+    refreshed = []
+
+    async def _refresh() -> Dict[str, Any]:
+      await creds.refresh(self.transport)
+      refreshed.append(creds)
+      return credentials_to_dict(creds)
+
+    def _is_fresh(token: Dict[str, Any]) -> bool:
+      try:
+        if isinstance(token, str):
+          token = json.loads(token)
+        stored = oauth.Credentials.from_authorized_user_info(token)
+      except (ValueError, KeyError):
+        return False                    # missing, partial or lease-only
+      return stored.token != creds.token and not stored.expired
+
+    token = await self.datastore.refresh_document(key, _refresh, _is_fresh)
+    if not refreshed:
+      if isinstance(token, str):
+        token = json.loads(token)
+      creds = oauth_async.Credentials.from_authorized_user_info(token)
+    self.token_cache.put(self.cache_key, creds)
+    return creds
+
+  async def credentials(self) -> oauth.Credentials:
+    """Fetches the credentials.
+
+    Credentials still in the token cache are returned as they are; otherwise
+    they are loaded from the datastore, refreshed if expired and cached.
+
+    Returns:
+       (google.oauth2.credentials.Credentials):  the credentials
+    """
+    if self._email:
+      if creds := self.token_cache.get(self.cache_key):
+        return creds
+
+    if token := await self.token_details():
+      if isinstance(token, str):
+        token = json.loads(token)
+
+      creds = oauth_async.Credentials.from_authorized_user_info(token)
+
+      if creds.expired:
+        creds = await self._refresh_credentials(creds=creds)
+
+      elif self._email:
+        self.token_cache.put(self.cache_key, creds)
+
+    else:
+      raise CredentialsError(message='credentials not found', email=self._email)
+
+    return creds
+
+  async def auth_headers(self) -> Dict[str, Any]:
+    """Returns authorized http headers.
+
+    Returns:
+      oauth2_headers (Dict[str, Any]):  the OAuth headers
+    """
+    oauth2_header = {}
+    (await self.credentials()).apply(oauth2_header)
+
+    return oauth2_header
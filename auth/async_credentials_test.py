@@ -0,0 +1,191 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import http.server
+import json
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+from unittest import mock
+
+from google.oauth2 import credentials as oauth
+
+from auth.async_abstract_datastore import AsyncAbstractDatastore
+from auth.async_credentials import AsyncCredentials
+from auth.credentials_helpers import encode_key
+from auth.exceptions import CredentialsError
+from auth.token_cache import TokenCache
+from auth.transport import AsyncPooledRequest
+
+EXPIRED = '2023-10-12T19:30:11Z'
+
+
+class _FakeAsyncDatastore(AsyncAbstractDatastore):
+  documents: Dict[str, Dict[str, Any]] = {}
+  reads = 0
+  writes = 0
+
+  def __init__(self, email: str = None, project: str = None) -> None:
+    pass
+
+  async def get_document(self, id: str,
+                         key: Optional[str] = None) -> Dict[str, Any]:
+    _FakeAsyncDatastore.reads += 1
+    await asyncio.sleep(0)
+    return dict(doc) if (doc := self.documents.get(id)) else None
+
+  async def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    _FakeAsyncDatastore.writes += 1
+    await asyncio.sleep(0)
+    self.documents.setdefault(id, {}).update(new_data)
+
+
+class _FakeTokenHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  requests = 0
+  lock = threading.Lock()
+
+  def do_POST(self) -> None:
+    self.rfile.read(int(self.headers['Content-Length']))
+    with _FakeTokenHandler.lock:
+      _FakeTokenHandler.requests += 1
+    time.sleep(0.05)
+    body = json.dumps({'access_token': 'fresh_token',
+                       'expires_in': 3600}).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *unused) -> None:
+    pass
+
+
+def _token(expiry: str) -> Dict[str, Any]:
+  return {'token': 'stale_token', 'refresh_token': 'refresh_token',
+          'client_id': 'client_id', 'client_secret': 'client_secret',
+          'expiry': expiry}
+
+
+class AsyncCredentialsTest(unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    _FakeAsyncDatastore.documents = {}
+    _FakeAsyncDatastore.reads = 0
+    _FakeAsyncDatastore.writes = 0
+    _FakeTokenHandler.requests = 0
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  _FakeTokenHandler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.endpoint = mock.patch.object(
+        oauth, '_GOOGLE_OAUTH2_TOKEN_ENDPOINT',
+        f'http://127.0.0.1:{self.server.server_port}/token')
+    self.endpoint.start()
+    self.transport = AsyncPooledRequest()
+    self.cache = TokenCache()
+
+  async def asyncTearDown(self):
+    await self.transport.close()
+
+  def tearDown(self):
+    self.endpoint.stop()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def _credentials(self, email: str) -> AsyncCredentials:
+    return AsyncCredentials(datastore=_FakeAsyncDatastore, email=email,
+                            token_cache=self.cache, transport=self.transport)
+
+  async def test_valid_token_cached(self):
+    expiry = datetime.now(timezone.utc) + timedelta(minutes=55)
+    _FakeAsyncDatastore.documents[encode_key('westley@pb.com')] = \
+        _token(expiry.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    first = await self._credentials('westley@pb.com').credentials()
+    second = await self._credentials('westley@pb.com').credentials()
+
+    self.assertIs(first, second)
+    self.assertEqual(1, _FakeAsyncDatastore.reads)
+    self.assertEqual(0, _FakeTokenHandler.requests)
+
+  async def test_missing_credentials(self):
+    with self.assertRaises(CredentialsError):
+      await self._credentials('nobody@pb.com').credentials()
+
+  async def test_concurrent_refresh_is_coalesced(self):
+    _FakeAsyncDatastore.documents[encode_key('inigo@pb.com')] = \
+        _token(EXPIRED)
+
+    headers = await asyncio.gather(
+        *[self._credentials('inigo@pb.com').auth_headers()
+          for _ in range(100)])
+
+    self.assertEqual([{'authorization': 'Bearer fresh_token'}] * 100, headers)
+    self.assertEqual(1, _FakeTokenHandler.requests)
+    self.assertEqual(1, _FakeAsyncDatastore.writes)
+
+  async def test_many_users_concurrently(self):
+    emails = [f'user{i}@pb.com' for i in range(200)]
+    for email in emails:
+      _FakeAsyncDatastore.documents[encode_key(email)] = _token(EXPIRED)
+
+    headers = await asyncio.gather(
+        *[self._credentials(email).auth_headers() for email in emails])
+
+    self.assertEqual([{'authorization': 'Bearer fresh_token'}] * 200, headers)
+    self.assertEqual(200, _FakeTokenHandler.requests)
+    self.assertEqual(
+        'fresh_token',
+        _FakeAsyncDatastore.documents[encode_key('user7@pb.com')]['token'])
+
+  async def test_datastore_instance(self):
+    datastore = _FakeAsyncDatastore()
+    creds = AsyncCredentials(datastore=datastore, email='westley@pb.com')
+    self.assertIs(datastore, creds.datastore)
+
+  async def test_refreshed_elsewhere(self):
+    _FakeAsyncDatastore.documents[encode_key('vizzini@pb.com')] = \
+        _token(EXPIRED)
+    fresh = _token((datetime.now(timezone.utc) + timedelta(minutes=55))
+                   .strftime('%Y-%m-%dT%H:%M:%SZ')) | {'token': 'their_token'}
+
+    async def _refresh_document(id, refresh, is_fresh):
+      self.assertTrue(is_fresh(fresh))
+      self.assertFalse(is_fresh({'_refresh_lease': {}}))
+      return fresh
+
+    with mock.patch.object(_FakeAsyncDatastore, 'refresh_document',
+                           side_effect=_refresh_document):
+      headers = await self._credentials('vizzini@pb.com').auth_headers()
+
+    self.assertEqual({'authorization': 'Bearer their_token'}, headers)
+    self.assertEqual(0, _FakeTokenHandler.requests)
+
+  async def test_project_credentials(self):
+    _FakeAsyncDatastore.documents['client_secret'] = {
+        'web': {'client_id': 'id', 'client_secret': 'secret'}}
+
+    creds = self._credentials('fezzik@pb.com')
+    project = await creds.project_credentials()
+    await creds.project_credentials()
+
+    self.assertEqual('id', project.client_id)
+    self.assertEqual('secret', project.client_secret)
+    self.assertEqual(2, _FakeAsyncDatastore.reads)
+
+
+if __name__ == '__main__':
+  unittest.main()
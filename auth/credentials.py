@@ -16,7 +16,9 @@ from __future__ import annotations
 from dataclasses import dataclass
 from datetime import datetime
 import json
-from typing import Any, Dict, Mapping, Type, TypeVar, Union
+from concurrent import futures
+from typing import (Any, Dict, List, Mapping, Optional, Type, TypeVar,
+                    Union)
 from io import BytesIO
 
 import pytz
@@ -25,10 +27,14 @@ from google.auth.transport import requests
 from google.oauth2 import credentials as oauth
 
 from auth import decorators
+from auth import transport as auth_transport
 
 from auth.abstract_datastore import AbstractDatastore
-from auth.credentials_helpers import encode_key
+from auth.credentials_helpers import (cache_key, credentials_to_dict,
+                                      encode_key)
 from auth.exceptions import CredentialsError
+from auth.single_flight import SingleFlight
+from auth.token_cache import DEFAULT_TOKEN_CACHE, TokenCache
 
 
 @dataclass
@@ -53,20 +59,103 @@ class Credentials(object):
   'datastore' can return a 'pass', although if it is not set, this will cause
   failures further down the line if an attempt is made to store or load
   credentials.
+
+  Built OAuth credentials are held in a `TokenCache` (by default the one
+  shared by the whole process) until shortly before they expire, so repeated
+  calls to `credentials` or `auth_headers` do not go back to the datastore.
   """
   _email: str = None
   _project: str = None
 
+  # Refreshes in flight for the whole process, keyed by `cache_key`, so that
+  # concurrent callers for one user of one datastore share a single refresh
+  # and write.
+  _refreshes: SingleFlight = SingleFlight()
+
   TDatastore = TypeVar('TDatastore', bound=AbstractDatastore)
 
   def __init__(self,
-               datastore: Type[TDatastore],
+               datastore: Union[Type[TDatastore], AbstractDatastore],
                email: str = None,
                project: str = None,
+               token_cache: Optional[TokenCache] = None,
+               transport: Optional[requests.Request] = None,
                **dsargs) -> Credentials:
     self._email = email
     self._project = project
-    self._datastore = datastore(email=email, project=project, **dsargs)
+    self._transport = transport
+    self._token_cache = \
+        DEFAULT_TOKEN_CACHE if token_cache is None else token_cache
+    if isinstance(datastore, AbstractDatastore):
+      self._datastore = datastore
+    else:
+      self._datastore = datastore(email=email, project=project, **dsargs)
+
+  @classmethod
+  def get_many(cls,
+               datastore: Union[Type[TDatastore], AbstractDatastore],
+               emails: List[str],
+               project: str = None,
+               token_cache: Optional[TokenCache] = None,
+               transport: Optional[requests.Request] = None,
+               max_workers: int = 8,
+               **dsargs) -> Dict[str, oauth.Credentials]:
+    """Fetches the credentials for many users at once.
+
+    Tokens still in the token cache are used as they are. The rest are read
+    with a single call to the datastore's `get_documents`, which uses each
+    backend's native batch read, and any that have expired are refreshed in a
+    pool of at most `max_workers` threads.
+
+    Args:
+        datastore (AbstractDatastore): the datastore, or its type
+        emails (List[str]): the users' emails
+        project (str): the project, if a datastore type is given
+        token_cache (TokenCache): the token cache; defaults to the shared one
+        transport (requests.Request): the refresh transport
+        max_workers (int): the maximum number of concurrent refreshes
+
+    Returns:
+        Dict[str, oauth.Credentials]: the credentials by email; users with no
+                                      stored token are omitted
+    """
+    if not isinstance(datastore, AbstractDatastore):
+      datastore = datastore(project=project, **dsargs)
+
+    def _credentials(email: str) -> Credentials:
+      return cls(datastore=datastore, email=email, project=project,
+                 token_cache=token_cache, transport=transport)
+
+    cache = DEFAULT_TOKEN_CACHE if token_cache is None else token_cache
+    found: Dict[str, oauth.Credentials] = {}
+    keys: Dict[str, str] = {}
+    for email in emails:
+      if creds := cache.get(cache_key(datastore, email)):
+        found[email] = creds
+      else:
+        keys[encode_key(email)] = email
+
+    expired: Dict[str, oauth.Credentials] = {}
+    for key, token in datastore.get_documents(list(keys)).items():
+      if isinstance(token, str):
+        token = json.loads(token)
+
+      creds = oauth.Credentials.from_authorized_user_info(token)
+      if creds.expired:
+        expired[keys[key]] = creds
+      else:
+        cache.put(cache_key(datastore, keys[key]), creds)
+        found[keys[key]] = creds
+
+    if expired:
+      with futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        refreshed = pool.map(
+            lambda email: _credentials(email)._refresh_credentials(
+                expired[email]),
+            expired)
+        found.update(zip(expired, refreshed))
+
+    return found
 
   @property
   def datastore(self) -> AbstractDatastore:
@@ -91,6 +180,30 @@ class Credentials(object):
     """
     raise KeyError('Datastore can only be set on instantiation.')
 
+  @property
+  def email(self) -> str:
+    """The email of the user whose credentials these are."""
+    return self._email
+
+  @property
+  def cache_key(self) -> str:
+    """The key of these credentials in the token cache (see `cache_key`)."""
+    return cache_key(self.datastore, self._email)
+
+  @property
+  def token_cache(self) -> TokenCache:
+    """The token cache property."""
+    return self._token_cache
+
+  @property
+  def transport(self) -> requests.Request:
+    """The HTTP transport used to refresh tokens.
+
+    Unless one was given on instantiation, this is the pooled transport shared
+    by every `Credentials` object in the process.
+    """
+    return self._transport or auth_transport.default_transport()
+
   @decorators.lazy_property
   def project_credentials(self) -> ProjectCredentials:
     """The project credentials.
@@ -141,17 +254,95 @@ class Credentials(object):
       if isinstance(creds, oauth.Credentials):
         self.datastore.update_document(id=key,
                                        new_data=self._to_dict(creds))
+        self.token_cache.put(self.cache_key, creds)
       else:
         self.datastore.update_document(id=key, new_data=creds)
+        self.token_cache.invalidate(self.cache_key)
+
+  def refresh(self) -> oauth.Credentials:
+    """Refreshes the user's token now, whether or not it has expired.
+
+    This is used to refresh tokens ahead of their expiry (see
+    `auth.refresher.TokenRefresher`) so that callers of `credentials` never
+    have to wait for a refresh. A copy of the current credentials is refreshed
+    so that the cached object other threads may be using is left untouched.
+
+    Returns:
+        google.oauth2.credentials.Credentials: the refreshed credentials
+    """
+    creds = oauth.Credentials.from_authorized_user_info(
+        self._to_dict(self.credentials))
+    return self._refresh_credentials(creds=creds, force=True)
 
-  def _refresh_credentials(self, creds: oauth.Credentials) -> None:
+  def _refresh_credentials(self,
+                           creds: oauth.Credentials,
+                           force: bool = False) -> oauth.Credentials:
     """Refreshes the Google OAuth credentials.
 
+    Concurrent refreshes for the same user are coalesced: one caller refreshes
+    and stores the token while the others wait for, and share, its result. A
+    caller arriving just after a refresh finished picks up the newly cached
+    token instead of refreshing again, unless `force` is set.
+
+    Args:
+        creds (oauth.Credentials): the credentials to refresh
+        force (bool): refresh even if the cache holds a fresh token
+
     Returns:
         google.oauth2.credentials.Credentials: the credentials
     """
-    creds.refresh(requests.Request())
-    self.store_credentials(creds)
+    if not self._email:
+      return self._refresh_and_store(creds)
+
+    key = self.cache_key
+
+    def _refresh() -> oauth.Credentials:
+      if not force and (fresh := self.token_cache.get(key)):
+        return fresh
+      return self._refresh_and_store(creds)
+
+    return self._refreshes.do(key, _refresh)
+
+  def _refresh_and_store(self,
+                         creds: oauth.Credentials) -> oauth.Credentials:
+    """Refreshes the credentials and writes them back to the datastore.
+
+    This goes through the datastore's `refresh_document`, so a datastore that
+    coordinates processes (such as `Firestore`) lets just one of the
+    processes holding a stale token refresh it. The others get the token it
+    stored: any unexpired token other than the one being refreshed.
+
+    Returns:
+        google.oauth2.credentials.Credentials: the refreshed credentials
+    """
+    if not self._email:
+      creds.refresh(self.transport)
+      return creds
+
+    key = encode_key(self._email)
+    refreshed = []
+
+    def _refresh() -> Dict[str, Any]:
+      creds.refresh(self.transport)
+      refreshed.append(creds)
+      return self._to_dict(creds)
+
+    def _is_fresh(token: Dict[str, Any]) -> bool:
+      try:
+        if isinstance(token, str):
+          token = json.loads(token)
+        stored = oauth.Credentials.from_authorized_user_info(token)
+      except (ValueError, KeyError):
+        return False                    # missing, partial or lease-only
+      return stored.token != creds.token and not stored.expired
+
+    token = self.datastore.refresh_document(key, _refresh, _is_fresh)
+    if not refreshed:
+      if isinstance(token, str):
+        token = json.loads(token)
+      creds = oauth.Credentials.from_authorized_user_info(token)
+    self.token_cache.put(self.cache_key, creds)
+    return creds
 
   def _to_utc(self, last_date: datetime) -> datetime:
     """Convert a datetime to UTC
@@ -171,12 +362,7 @@ class Credentials(object):
   def _to_dict(self, credentials: oauth.Credentials) -> Mapping[str, Any]:
     """Convert an OAuth token to a dict
 
-    Note the conversion of the expiry date (A `datetime` object) to the Zulu
-    format date string. This is because the primary function of the dict is to
-    be serialized to the `Datastore` and we have to ensure that all fields can
-    be turned to `json` for this purpose. When reinstantiated, the OAuth
-    Credentials object takes care of converting the expiry date back to a
-    `datetime` for us.
+    See `credentials_helpers.credentials_to_dict`.
 
     Args:
         credentials (oauth.Credentials): the OAuth credentials
@@ -184,22 +370,22 @@ class Credentials(object):
     Returns:
         Mapping[str, Any]: the credentials as a `dict[str, Any]`
     """
-    return {'token': credentials.token,
-            'refresh_token': credentials.refresh_token,
-            'token_uri': credentials.token_uri,
-            'client_id': credentials.client_id,
-            'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes,
-            'default_scopes': credentials.default_scopes,
-            'expiry': credentials.expiry.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    return credentials_to_dict(credentials)
 
   @ property
   def credentials(self) -> oauth.Credentials:
     """Fetches the credentials.
 
+    Credentials still in the token cache are returned as they are; otherwise
+    they are loaded from the datastore, refreshed if expired and cached.
+
     Returns:
        (google.oauth2.credentials.Credentials):  the credentials
     """
+    if self._email:
+      if creds := self.token_cache.get(self.cache_key):
+        return creds
+
     expiry = self._to_utc(
         datetime.now().astimezone(pytz.utc) + relativedelta(minutes=60))
 
@@ -211,7 +397,10 @@ class Credentials(object):
 
       if creds.expired:
         creds.expiry = expiry
-        self._refresh_credentials(creds=creds)
+        creds = self._refresh_credentials(creds=creds)
+
+      elif self._email:
+        self.token_cache.put(self.cache_key, creds)
 
     else:
       creds = None
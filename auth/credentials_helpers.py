@@ -14,6 +14,9 @@
 from __future__ import annotations
 
 import base64
+from typing import Any, Mapping
+
+from google.oauth2 import credentials as oauth
 
 from auth.exceptions import KeyEncodingError
 
@@ -37,3 +40,52 @@ def encode_key(key: str) -> str:
 
   except:
     raise KeyEncodingError(f'Cannot encode {key}.')
+
+
+def cache_key(datastore: Any, email: str) -> str:
+  """Creates the key of a user's credentials in a `TokenCache`.
+
+  The process-wide cache is shared by every `Credentials` object, so the key
+  names the datastore as well as the user: the datastore's class, and the
+  project, bucket, file and prefix it reads where it has them. Two datastores
+  share cached tokens only if they are the same kind reading the same place.
+
+  Args:
+      datastore (Any): the datastore the credentials are stored in
+      email (str): the user's email
+
+  Returns:
+      str: the cache key
+  """
+  where = [str(value)
+           for name in ('_project', '_bucket', '_datastore_file', '_prefix')
+           if (value := getattr(datastore, name, None)) is not None]
+  kind = type(datastore)
+  return '/'.join([f'{kind.__module__}.{kind.__qualname__}', *where,
+                   encode_key(email)])
+
+
+def credentials_to_dict(credentials: oauth.Credentials) -> Mapping[str, Any]:
+  """Convert an OAuth token to a dict
+
+  Note the conversion of the expiry date (A `datetime` object) to the Zulu
+  format date string. This is because the primary function of the dict is to
+  be serialized to the `Datastore` and we have to ensure that all fields can
+  be turned to `json` for this purpose. When reinstantiated, the OAuth
+  Credentials object takes care of converting the expiry date back to a
+  `datetime` for us.
+
+  Args:
+      credentials (oauth.Credentials): the OAuth credentials
+
+  Returns:
+      Mapping[str, Any]: the credentials as a `dict[str, Any]`
+  """
+  return {'token': credentials.token,
+          'refresh_token': credentials.refresh_token,
+          'token_uri': credentials.token_uri,
+          'client_id': credentials.client_id,
+          'client_secret': credentials.client_secret,
+          'scopes': credentials.scopes,
+          'default_scopes': credentials.default_scopes,
+          'expiry': credentials.expiry.strftime('%Y-%m-%dT%H:%M:%SZ')}
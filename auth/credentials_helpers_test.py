@@ -16,7 +16,7 @@ import json
 import unittest
 from unittest import mock
 
-from auth.credentials_helpers import encode_key
+from auth.credentials_helpers import cache_key, encode_key
 from auth.exceptions import KeyEncodingError
 
 
@@ -28,3 +28,18 @@ class CredentialsHelpersTest(unittest.TestCase):
   def test_encode_none(self) -> None:
     with self.assertRaisesRegex(KeyEncodingError, 'Cannot encode None'):
       encode_key(None)
+
+  def test_cache_key(self) -> None:
+    class _Datastore(object):
+      def __init__(self, project: str, datastore_file: str = None) -> None:
+        self._project = project
+        self._datastore_file = datastore_file
+
+    key = cache_key(_Datastore('florin'), 'westley@pb.com')
+    self.assertTrue(key.endswith(encode_key('westley@pb.com')))
+    self.assertEqual(key, cache_key(_Datastore('florin'), 'westley@pb.com'))
+    self.assertNotEqual(key, cache_key(_Datastore('guilder'),
+                                       'westley@pb.com'))
+    self.assertNotEqual(key, cache_key(_Datastore('florin', 'other.json'),
+                                       'westley@pb.com'))
+
@@ -12,15 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import http.server
 import json
+import threading
+import time
 import unittest
+from concurrent import futures
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict
 from unittest import mock
 
-from auth.credentials_helpers import encode_key
+from auth.credentials_helpers import cache_key, encode_key
 from auth.exceptions import KeyEncodingError
 from google.oauth2 import credentials as oauth
+from auth.abstract_datastore import AbstractDatastore
 from auth.credentials import Credentials
 from auth import local_file
+from auth.token_cache import TokenCache
 
 MASTER_CONFIG = {
     "auth": {
@@ -36,6 +44,13 @@ MASTER_CONFIG = {
 CLASS_UNDER_TEST = 'auth.local_file'
 
 
+def _refresh_by_default(datastore: mock.MagicMock) -> mock.MagicMock:
+  """Makes a mock datastore refresh as `AbstractDatastore` does."""
+  datastore.refresh_document.side_effect = \
+      lambda *args: AbstractDatastore.refresh_document(datastore, *args)
+  return datastore
+
+
 class CredentialsTest(unittest.TestCase):
   def setUp(self):
     self.open = mock.mock_open(read_data=json.dumps(MASTER_CONFIG))
@@ -58,3 +73,196 @@ class CredentialsTest(unittest.TestCase):
     c.store_credentials(creds)
 
     print(c.datastore.list_documents())
+
+  def test_credentials_cached(self) -> None:
+    expiry = datetime.now(timezone.utc) + timedelta(minutes=55)
+    token = {"token": "token",
+             "refresh_token": "refresh_token",
+             "token_uri": "https://oauth2.googleapis.com/token",
+             "client_id": "client_id", "client_secret": "client_secret",
+             "expiry": expiry.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    datastore = mock.MagicMock()
+    datastore.return_value.get_document.return_value = token
+    cache = TokenCache()
+
+    first = Credentials(datastore=datastore, email='inigo@princessbride.com',
+                        token_cache=cache).credentials
+    second = Credentials(datastore=datastore, email='inigo@princessbride.com',
+                         token_cache=cache).credentials
+
+    self.assertIs(first, second)
+    datastore.return_value.get_document.assert_called_once()
+
+
+class _FakeTokenHandler(http.server.BaseHTTPRequestHandler):
+  """A stand-in for the OAuth token endpoint that counts refreshes."""
+  requests = 0
+  lock = threading.Lock()
+
+  def do_POST(self) -> None:
+    self.rfile.read(int(self.headers['Content-Length']))
+    with _FakeTokenHandler.lock:
+      _FakeTokenHandler.requests += 1
+    time.sleep(0.2)
+    body = json.dumps({'access_token': 'fresh_token',
+                       'expires_in': 3600}).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *unused) -> None:
+    pass
+
+
+class CredentialsRefreshStressTest(unittest.TestCase):
+  def setUp(self):
+    _FakeTokenHandler.requests = 0
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  _FakeTokenHandler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_concurrent_refresh_is_coalesced(self) -> None:
+    workers = 32
+    token_uri = f'http://127.0.0.1:{self.server.server_port}/token'
+    token = {"token": "stale_token",
+             "refresh_token": "refresh_token",
+             "client_id": "client_id", "client_secret": "client_secret",
+             "expiry": "2023-10-12T19:30:11Z"}
+    datastore = mock.MagicMock()
+    datastore.return_value.get_document.return_value = token
+    _refresh_by_default(datastore.return_value)
+    cache = TokenCache()
+    barrier = threading.Barrier(workers)
+
+    def _headers() -> Dict[str, Any]:
+      c = Credentials(datastore=datastore, email='vizzini@princessbride.com',
+                      token_cache=cache)
+      barrier.wait()
+      return c.auth_headers
+
+    # `from_authorized_user_info` always uses Google's token endpoint.
+    with mock.patch.object(oauth, '_GOOGLE_OAUTH2_TOKEN_ENDPOINT', token_uri), \
+            futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      headers = list(pool.map(lambda _: _headers(), range(workers)))
+
+    self.assertEqual(1, _FakeTokenHandler.requests)
+    datastore.return_value.update_document.assert_called_once()
+    self.assertEqual([{'authorization': 'Bearer fresh_token'}] * workers,
+                     headers)
+
+  def test_refresh_forced_while_cached(self) -> None:
+    token_uri = f'http://127.0.0.1:{self.server.server_port}/token'
+    expiry = datetime.now(timezone.utc) + timedelta(minutes=8)
+    token = {"token": "cached_token",
+             "refresh_token": "refresh_token",
+             "client_id": "client_id", "client_secret": "client_secret",
+             "expiry": expiry.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    datastore = mock.MagicMock()
+    datastore.return_value.get_document.return_value = token
+    _refresh_by_default(datastore.return_value)
+    c = Credentials(datastore=datastore, email='fezzik@princessbride.com',
+                    token_cache=TokenCache())
+
+    self.assertEqual('cached_token', c.credentials.token)
+    with mock.patch.object(oauth, '_GOOGLE_OAUTH2_TOKEN_ENDPOINT', token_uri):
+      c.refresh()
+
+    self.assertEqual(1, _FakeTokenHandler.requests)
+    self.assertEqual('fresh_token', c.credentials.token)
+
+  def test_refreshed_elsewhere(self) -> None:
+    valid = datetime.now(timezone.utc) + timedelta(minutes=55)
+    stale = {"token": "stale_token",
+             "refresh_token": "refresh_token",
+             "client_id": "client_id", "client_secret": "client_secret",
+             "expiry": "2023-10-12T19:30:11Z"}
+    fresh = {**stale, "token": "fresh_token",
+             "expiry": valid.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    datastore = mock.MagicMock()
+    datastore.return_value.get_document.return_value = stale
+
+    def _refresh_document(id, refresh, is_fresh):
+      self.assertFalse(is_fresh(stale))
+      self.assertTrue(is_fresh(fresh))
+      self.assertFalse(is_fresh({}))                 # only a lease was there
+      self.assertFalse(is_fresh({"token": "partial_token"}))
+      return fresh
+
+    datastore.return_value.refresh_document.side_effect = _refresh_document
+    cache = TokenCache()
+    c = Credentials(datastore=datastore, email='buttercup@princessbride.com',
+                    token_cache=cache)
+
+    self.assertEqual('fresh_token', c.credentials.token)
+    self.assertEqual(0, _FakeTokenHandler.requests)
+    self.assertEqual('fresh_token',
+                     cache.get(c.cache_key).token)
+
+  def test_cache_keyed_by_datastore(self) -> None:
+    expiry = datetime.now(timezone.utc) + timedelta(minutes=55)
+
+    class _Datastore(AbstractDatastore):
+      def __init__(self, email: str = None, project: str = None) -> None:
+        self._project = project
+
+      def get_document(self, id: str) -> Dict[str, Any]:
+        return {"token": f'{self._project}_token',
+                "refresh_token": "refresh_token",
+                "client_id": "client_id", "client_secret": "client_secret",
+                "expiry": expiry.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    cache = TokenCache()
+    florin = Credentials(datastore=_Datastore,
+                         email='humperdinck@pb.com', project='florin',
+                         token_cache=cache)
+    guilder = Credentials(datastore=_Datastore,
+                          email='humperdinck@pb.com', project='guilder',
+                          token_cache=cache)
+
+    self.assertEqual('florin_token', florin.credentials.token)
+    self.assertEqual('guilder_token', guilder.credentials.token)
+    self.assertNotEqual(florin.cache_key, guilder.cache_key)
+
+  def test_get_many(self) -> None:
+    token_uri = f'http://127.0.0.1:{self.server.server_port}/token'
+    valid = datetime.now(timezone.utc) + timedelta(minutes=55)
+    cache = TokenCache()
+    cached = oauth.Credentials(token='cached_token',
+                               expiry=valid.replace(tzinfo=None))
+
+    def _token(token: str, expiry: str) -> Dict[str, Any]:
+      return {"token": token, "refresh_token": "refresh_token",
+              "client_id": "client_id", "client_secret": "client_secret",
+              "expiry": expiry}
+
+    datastore = _refresh_by_default(
+        mock.create_autospec(AbstractDatastore, instance=True))
+    cache.put(cache_key(datastore, 'westley@pb.com'), cached)
+    datastore.get_documents.return_value = {
+        encode_key('inigo@pb.com'):
+            _token('valid_token', valid.strftime('%Y-%m-%dT%H:%M:%SZ')),
+        encode_key('fezzik@pb.com'):
+            _token('stale_token', '2023-10-12T19:30:11Z'),
+    }
+
+    with mock.patch.object(oauth, '_GOOGLE_OAUTH2_TOKEN_ENDPOINT', token_uri):
+      creds = Credentials.get_many(
+          datastore=datastore, token_cache=cache,
+          emails=['westley@pb.com', 'inigo@pb.com', 'fezzik@pb.com',
+                  'vizzini@pb.com'])
+
+    self.assertEqual({'westley@pb.com': 'cached_token',
+                      'inigo@pb.com': 'valid_token',
+                      'fezzik@pb.com': 'fresh_token'},
+                     {email: c.token for email, c in creds.items()})
+    datastore.get_documents.assert_called_once_with(
+        [encode_key('inigo@pb.com'), encode_key('fezzik@pb.com'),
+         encode_key('vizzini@pb.com')])
+    self.assertEqual(1, _FakeTokenHandler.requests)
+    datastore.update_document.assert_called_once()
@@ -0,0 +1,192 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import atexit
+import contextlib
+import functools
+import threading
+import weakref
+from typing import Any, Callable, Iterator, Mapping, Optional
+
+
+def persist(f: Callable) -> Any:
+  """Decorator to write the datastore back after a mutation.
+
+  This is used to decorate the methods of a `WriteCoalescing` datastore that
+  modify its in-memory document map; when the outermost of them returns, the
+  map is written back with the datastore's `_persist`. Mutations made inside a
+  `batch()`, or while write-behind is enabled, are deferred and coalesced
+  into a single write instead. Mutations are serialized with the datastore's
+  lock, so one instance can be shared between threads.
+
+  Args:
+      f (Callable): the function to wrap
+
+  Returns:
+      Any: the return value of `f`
+  """
+  @functools.wraps(f)
+  def f_persist(*args: Mapping[str, Any], **kw: Mapping[str, Any]) -> Any:
+    datastore = args[0]                 # 'self' in the original caller
+    with datastore._lock:
+      datastore._depth += 1
+      try:
+        return f(*args, **kw)
+      finally:
+        datastore._depth -= 1
+        datastore._dirty += 1
+        datastore._maybe_flush()
+  return f_persist
+
+
+def _flush_at_exit(ref: weakref.ref) -> None:
+  if (datastore := ref()) is not None:
+    datastore.flush()
+
+
+class WriteCoalescing(object):
+  """Mixin for datastores which write their whole document map on a change.
+
+  By default every `persist` decorated mutation is written through as soon
+  as it completes. Two ways of deferring the writes are offered:
+
+      with datastore.batch():
+        datastore.store_document(...)
+        datastore.delete_document(...)
+
+  writes once, when the outermost `batch()` exits, however many mutations
+  (from any thread) were made inside it. Alternatively,
+
+      datastore.write_behind(max_writes=100, max_delay=5.0)
+
+  keeps mutations in memory until 100 of them are pending or 5 seconds have
+  passed since the first of them, whichever comes first. Pending mutations
+  are always written by `flush()`, `close()`, leaving the datastore's `with`
+  block and at interpreter exit.
+
+  Subclasses call `super().__init__()` and implement `_persist`.
+  """
+
+  def __init__(self) -> WriteCoalescing:
+    self._lock = threading.RLock()
+    self._depth = 0
+    self._dirty = 0
+    self._max_writes: Optional[int] = None
+    self._max_delay: Optional[float] = None
+    self._timer: Optional[threading.Timer] = None
+    self._at_exit: Optional[Callable] = None
+
+  def _persist(self) -> None:
+    """Writes the whole document map to the underlying storage."""
+    raise NotImplementedError('Must be implemented by subclasses.')
+
+  @property
+  def dirty(self) -> bool:
+    """Whether there are mutations which have not been written yet."""
+    return self._dirty > 0
+
+  @contextlib.contextmanager
+  def batch(self) -> Iterator[WriteCoalescing]:
+    """Defers every write until the outermost batch exits.
+
+    Batches nest, and the datastore is written once when the outermost one
+    exits, even if it exits with an exception; mutations which had already
+    been applied in memory are not rolled back.
+
+    Yields:
+        WriteCoalescing: the datastore
+    """
+    with self._lock:
+      self._depth += 1
+    try:
+      yield self
+    finally:
+      with self._lock:
+        self._depth -= 1
+        if not self._depth:
+          self.flush()
+
+  def write_behind(self,
+                   max_writes: Optional[int] = None,
+                   max_delay: Optional[float] = None) -> None:
+    """Enables (or, with no arguments, disables) write-behind.
+
+    Args:
+        max_writes (int): write once this many mutations are pending
+        max_delay (float): write this many seconds after the first pending
+                           mutation
+    """
+    with self._lock:
+      self._max_writes = max_writes
+      self._max_delay = max_delay
+
+      if max_writes is None and max_delay is None:
+        if self._at_exit:
+          atexit.unregister(self._at_exit)
+          self._at_exit = None
+        self.flush()
+
+      else:
+        if not self._at_exit:
+          self._at_exit = functools.partial(_flush_at_exit, weakref.ref(self))
+          atexit.register(self._at_exit)
+        self._maybe_flush()
+
+  def flush(self) -> None:
+    """Writes any pending mutations now."""
+    with self._lock:
+      if self._timer:
+        self._timer.cancel()
+        self._timer = None
+
+      if self._dirty:
+        self._persist()
+        self._dirty = 0
+
+  def close(self) -> None:
+    """Writes any pending mutations and disables write-behind."""
+    self.write_behind()
+
+  def __enter__(self) -> WriteCoalescing:
+    return self
+
+  def __exit__(self, *unused) -> None:
+    self.close()
+
+  def _maybe_flush(self) -> None:
+    """Writes, or schedules the write of, pending mutations as configured.
+
+    The caller must hold the lock.
+    """
+    if not self._dirty or self._depth:
+      return
+
+    if self._max_writes is None and self._max_delay is None:
+      self.flush()
+
+    elif self._max_writes is not None and self._dirty >= self._max_writes:
+      self.flush()
+
+    elif self._max_delay is not None and not self._timer:
+      self._timer = threading.Timer(self._max_delay, self._flush_on_timer)
+      self._timer.daemon = True
+      self._timer.start()
+
+  def _flush_on_timer(self) -> None:
+    with self._lock:
+      self._timer = None
+      # An open batch writes everything when it exits.
+      if not self._depth:
+        self.flush()
@@ -0,0 +1,185 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+import unittest
+from unittest import mock
+
+from auth.datastore.batching import WriteCoalescing, persist
+
+
+class _Store(WriteCoalescing):
+  def __init__(self):
+    super().__init__()
+    self.datastore = {}
+    self.writes = []
+
+  def _persist(self):
+    self.writes.append(dict(self.datastore))
+
+  @persist
+  def store_document(self, id, document):
+    self.datastore[id] = document
+
+  @persist
+  def update_document(self, id, new_data):
+    if id in self.datastore:
+      self.datastore[id].update(new_data)
+    else:
+      self.store_document(id, new_data)
+
+  @persist
+  def fail(self):
+    raise ValueError('inconceivable')
+
+
+class WriteCoalescingTest(unittest.TestCase):
+  def test_write_through(self):
+    store = _Store()
+    store.store_document('westley', {'a': 1})
+    store.store_document('buttercup', {'b': 2})
+
+    self.assertEqual(2, len(store.writes))
+    self.assertFalse(store.dirty)
+
+  def test_nested_mutation_writes_once(self):
+    store = _Store()
+    store.update_document('westley', {'a': 1})
+
+    self.assertEqual([{'westley': {'a': 1}}], store.writes)
+
+  def test_failed_mutation_still_written(self):
+    store = _Store()
+    with self.assertRaises(ValueError):
+      store.fail()
+
+    self.assertEqual(1, len(store.writes))
+
+  def test_batch(self):
+    store = _Store()
+    with store.batch():
+      for name in ['westley', 'buttercup', 'inigo']:
+        store.store_document(name, {})
+      self.assertEqual([], store.writes)
+      self.assertTrue(store.dirty)
+
+    self.assertEqual(1, len(store.writes))
+    self.assertEqual(3, len(store.writes[0]))
+
+  def test_nested_batch(self):
+    store = _Store()
+    with store.batch():
+      with store.batch():
+        store.store_document('westley', {})
+      store.store_document('buttercup', {})
+      self.assertEqual([], store.writes)
+
+    self.assertEqual(1, len(store.writes))
+
+  def test_batch_flushes_on_error(self):
+    store = _Store()
+    with self.assertRaises(ValueError):
+      with store.batch():
+        store.store_document('westley', {})
+        raise ValueError('inconceivable')
+
+    self.assertEqual([{'westley': {}}], store.writes)
+
+  def test_empty_batch_does_not_write(self):
+    store = _Store()
+    with store.batch():
+      pass
+
+    self.assertEqual([], store.writes)
+
+  def test_batch_from_other_threads(self):
+    store = _Store()
+    with store.batch():
+      threads = [threading.Thread(target=store.store_document, args=(n, {}))
+                 for n in ['westley', 'buttercup', 'inigo', 'fezzik']]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertEqual([], store.writes)
+
+    self.assertEqual(1, len(store.writes))
+    self.assertEqual(4, len(store.writes[0]))
+
+  def test_write_behind_count(self):
+    store = _Store()
+    store.write_behind(max_writes=3)
+    for i in range(7):
+      store.store_document(str(i), {})
+
+    self.assertEqual(2, len(store.writes))
+    self.assertTrue(store.dirty)
+
+    store.close()
+    self.assertEqual(3, len(store.writes))
+    self.assertFalse(store.dirty)
+
+  def test_write_behind_delay(self):
+    store = _Store()
+    store.write_behind(max_delay=0.05)
+    for i in range(10):
+      store.store_document(str(i), {})
+    self.assertEqual([], store.writes)
+
+    time.sleep(0.5)
+    self.assertEqual(1, len(store.writes))
+    self.assertEqual(10, len(store.writes[0]))
+    store.close()
+
+  def test_write_behind_disabled_flushes(self):
+    store = _Store()
+    store.write_behind(max_writes=100)
+    store.store_document('westley', {})
+    store.write_behind()
+
+    self.assertEqual(1, len(store.writes))
+
+  def test_context_manager_flushes(self):
+    with _Store() as store:
+      store.write_behind(max_writes=100)
+      store.store_document('westley', {})
+      self.assertEqual([], store.writes)
+
+    self.assertEqual(1, len(store.writes))
+
+  def test_flushed_at_exit(self):
+    with mock.patch('atexit.register') as register:
+      store = _Store()
+      store.write_behind(max_delay=60)
+      store.store_document('westley', {})
+
+      at_exit = register.call_args.args[0]
+      at_exit()
+
+    self.assertEqual(1, len(store.writes))
+    store.close()
+
+  def test_at_exit_does_not_keep_datastore_alive(self):
+    with mock.patch('atexit.register') as register:
+      store = _Store()
+      store.write_behind(max_writes=10)
+      at_exit = register.call_args.args[0]
+      store.close()
+      del store
+
+    at_exit()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -13,65 +13,259 @@
 # limitations under the License.
 from __future__ import annotations
 
-import json
-from typing import Any, Callable, Dict, List, Mapping, Optional
+import asyncio
+import dataclasses
+import itertools
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple
+from urllib import parse
 
 import gcsfs
 from auth import decorators
 from auth.abstract_datastore import AbstractDatastore
+from auth.async_abstract_datastore import AsyncAbstractDatastore
+from auth.datastore import codecs
+from auth.datastore.batching import WriteCoalescing, persist
 
 
-def persist(f: Callable) -> Any:
-  """Persists the datastore after internal manipulations.
+_filesystems: Dict[str, gcsfs.GCSFileSystem] = {}
+_filesystems_lock = threading.Lock()
 
-  This is used to decorate functions that modify the internal json object
-  containing the authentication credentials and ensures that any changes
-  locally will be written back to the store automatically.
+API_PATH = '/storage/v1/'
+
+
+def filesystem(project: str) -> gcsfs.GCSFileSystem:
+  """The GCS filesystem for a project, shared by every `CloudStorage`.
+
+  Sharing it means its HTTP session, and so its pool of established
+  connections, is reused by every read and write.
 
   Args:
-      f (Callable): the source of the persist action
+      project (str): the GCP project
 
   Returns:
-      Any: whatever the original function returns
+      gcsfs.GCSFileSystem: the project's filesystem
   """
-  def f_persist(*args: Mapping[str, Any], **kw: Mapping[str, Any]) -> Any:
-    datastore = args[0]                 # 'self' in the original caller
-    try:
-      return f(*args, **kw)
-    finally:
-      fs = gcsfs.GCSFileSystem(project=datastore.project)
-      file_name = f'{datastore.bucket}/{datastore.datastore_file}'
-      with fs.open(file_name, 'w') as storage:
-        storage.write(json.dumps(datastore.datastore, indent=2))
-  return f_persist
+  with _filesystems_lock:
+    if (fs := _filesystems.get(project)) is None:
+      fs = _filesystems[project] = gcsfs.GCSFileSystem(project=project)
+    return fs
+
+
+def api_url(fs: gcsfs.GCSFileSystem, *path: str, upload: bool = False) -> str:
+  """A JSON API URL on the filesystem's storage endpoint.
+
+  gcsfs has no public call for a conditional upload, a conditional delete or
+  a paged listing, so those are made with `fs.call` on a full URL. The URL is
+  built from `fs.base` (`<endpoint>/storage/v1/`), which follows the
+  filesystem's endpoint, mTLS setting and `STORAGE_EMULATOR_HOST`; the media
+  upload URL is the same path under `<endpoint>/upload`.
+
+  Args:
+      fs (gcsfs.GCSFileSystem): the filesystem
+      *path (str): the path segments, each quoted (including any '/')
+      upload (bool): True for the media upload URL
+
+  Returns:
+      str: the URL
+
+  Raises:
+      ValueError: if this gcsfs's `base` is not a JSON API root
+  """
+  base = fs.base
+  if not base.endswith(API_PATH):
+    raise ValueError(f'Unsupported gcsfs storage endpoint: {base}')
+
+  if upload:
+    base = f'{base[:-len(API_PATH)]}/upload{API_PATH}'
+  return base + '/'.join(parse.quote(segment, safe='') for segment in path)
+
+
+@dataclasses.dataclass
+class ContentionStats(object):
+  """ContentionStats
 
+  A snapshot of how often a `CloudStorage` lost a race to write the object.
 
-class CloudStorage(AbstractDatastore):
+  writes is the number of successful uploads and conflicts the number of
+  uploads refused because another writer got there first; failed counts the
+  writes abandoned after `max_attempts`, backoff the total seconds spent
+  waiting to retry and max_attempts the most uploads any one write needed.
+  """
+  writes: int = 0
+  conflicts: int = 0
+  failed: int = 0
+  backoff: float = 0.0
+  max_attempts: int = 0
+
+
+class CloudStorage(WriteCoalescing, AbstractDatastore):
   """A datastore for storing auth credentials in GCS.
+
+  The store is one JSON object, downloaded on first use. `reload()` (or a
+  read once `max_age` seconds have passed since the last check) revalidates
+  it with a conditional GET on its generation and ETag, so it is only
+  downloaded again if it has changed.
+
+  Several processes may share the object. Each upload is conditional on the
+  object still being the generation last read; if another writer has
+  replaced it, the object is fetched again, the documents changed here are
+  applied on top of it and the upload retried, up to `max_attempts` times
+  with a randomized exponential backoff. `stats` reports how often that
+  happens.
+
+  The object is written with `codec` (compact JSON by default; see
+  `auth.datastore.codecs`), and read whatever codec wrote it.
+
+  Args:
+      max_age (float): how long reads may use the object without checking it
+                       for changes; None (the default) means until `reload()`
+      max_attempts (int): uploads to try before a write fails
+      backoff (float): the longest wait, in seconds, before the first retry;
+                       it doubles for each retry after that
   """
-  @decorators.lazy_property
+  @property
   def datastore(self) -> Dict[str, Any]:
-    try:
-      fs = gcsfs.GCSFileSystem(project=self.project)
-      file_name = f'{self.bucket}/{self.datastore_file}'
-      with open(file_name, 'r') as store:
-        if data := store.read():
-          return json.loads(data)
-        else:
-          return {}
-
-    except FileNotFoundError:
-      return {}
+    """The document map."""
+    with self._lock:
+      if self._datastore is None or (
+              self._max_age is not None and
+              time.monotonic() - self._checked > self._max_age):
+        self.reload()
+      return self._datastore
 
   def __init__(self,
                project: str,
                bucket: str,
                email: str = None,
-               datastore_file: str = 'datastore.json') -> AbstractDatastore:
+               datastore_file: str = 'datastore.json',
+               max_age: Optional[float] = None,
+               max_attempts: int = 5,
+               backoff: float = 0.1,
+               codec: Optional[codecs.Codec] = None) -> AbstractDatastore:
     self._project = project
     self._email = email
     self._bucket = bucket
     self._datastore_file = datastore_file
+    self._max_age = max_age
+    self._datastore: Optional[Dict[str, Any]] = None
+    self._generation: Optional[str] = None
+    self._etag: Optional[str] = None
+    self._checked = 0.0
+    self._changed: Set[str] = set()
+    self._max_attempts = max_attempts
+    self._backoff = backoff
+    self._codec = codec or codecs.Codec()
+    self._stats = ContentionStats()
+    super().__init__()
+
+  @property
+  def fs(self) -> gcsfs.GCSFileSystem:
+    """The project's shared GCS filesystem."""
+    return filesystem(self.project)
+
+  @property
+  def file_name(self) -> str:
+    return f'{self.bucket}/{self.datastore_file}'
+
+  @property
+  def generation(self) -> Optional[str]:
+    """The generation of the object last read or written, if known."""
+    return self._generation
+
+  @property
+  def stats(self) -> ContentionStats:
+    """A snapshot of the datastore's write contention metrics."""
+    with self._lock:
+      return dataclasses.replace(self._stats)
+
+  def reload(self) -> None:
+    """Fetches the object again, if it has changed since it was last read.
+
+    Documents changed here but not written yet (inside a `batch()`, or with
+    write-behind) keep their local content; every other document is replaced
+    by what is stored.
+    """
+    with self._lock:
+      conditions = {}
+      headers = {}
+      if self._datastore is not None:
+        if self._generation:
+          conditions['ifGenerationNotMatch'] = self._generation
+        elif self._etag:
+          headers['If-None-Match'] = self._etag
+
+      stored = None
+      try:
+        response_headers, data = self.fs.call('GET',
+                                              self.fs.url(self.file_name),
+                                              headers=headers,
+                                              **conditions)
+      except FileNotFoundError:
+        stored, self._generation, self._etag = {}, None, None
+
+      else:
+        if generation := response_headers.get('x-goog-generation'):
+          modified = generation != self._generation
+        else:
+          modified = bool(data)         # a 304 Not Modified has no body
+
+        if self._datastore is None or modified:
+          stored = codecs.decode(data)
+          self._generation = generation
+          self._etag = response_headers.get('ETag')
+
+      if stored is not None:
+        if self._datastore is not None:
+          for id in self._changed:
+            if id in self._datastore:
+              stored[id] = self._datastore[id]
+            else:
+              stored.pop(id, None)
+        self._datastore = stored
+
+      self._checked = time.monotonic()
+
+  def _upload(self) -> Dict[str, Any]:
+    """Uploads the document map if the object is still the one last read.
+
+    Raises:
+        FileExistsError: if the object has been written since (HTTP 412)
+    """
+    bucket, name = self.file_name.split('/', 1)
+    return self.fs.call(
+        'POST', api_url(self.fs, 'b', bucket, 'o', upload=True),
+        uploadType='media', name=name,
+        data=self._codec.encode(self.datastore),
+        ifGenerationMatch=self._generation or '0',
+        headers={'Content-Type': self._codec.content_type}, json_out=True)
+
+  def _persist(self) -> None:
+    for attempt in itertools.count(1):
+      try:
+        metadata = self._upload()
+        break
+
+      except FileExistsError:
+        self._stats.conflicts += 1
+        if attempt >= self._max_attempts:
+          self._stats.failed += 1
+          raise
+
+        delay = random.uniform(0, self._backoff * 2 ** (attempt - 1))
+        self._stats.backoff += delay
+        time.sleep(delay)
+        self.reload()
+
+    self.fs.invalidate_cache(self.file_name)
+    self._generation = metadata.get('generation')
+    self._etag = metadata.get('etag')
+    self._checked = time.monotonic()
+    self._changed.clear()
+    self._stats.writes += 1
+    self._stats.max_attempts = max(self._stats.max_attempts, attempt)
 
   @decorators.lazy_property
   def datastore_file(self) -> str:
@@ -105,6 +299,21 @@ class CloudStorage(AbstractDatastore):
       else:
         return {id: parent}
 
+  def get_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents at once.
+
+    The whole store is held in memory after a single read of the object, so
+    this is a lookup per id with no further I/O.
+
+    Arguments:
+        ids (List[str]): the document ids
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id
+    """
+    return {id: document for id in ids
+            if (document := self.datastore.get(id)) is not None}
+
   @persist
   def store_document(self, id: str, document: Dict[str, Any]) -> None:
     """Stores a document.
@@ -117,6 +326,7 @@ class CloudStorage(AbstractDatastore):
         id (str): report id
         report_data (Dict[str, Any]): report configuration
     """
+    self._changed.add(id)
     self.datastore.update({id: document})
 
   @persist
@@ -131,8 +341,49 @@ class CloudStorage(AbstractDatastore):
         new_data (Dict[str, Any]): the document content.
     """
     # super().update_document(id=id, new_data=new_data)
+    self._changed.add(id)
     if document := self.datastore.get(id):
       document.update(new_data)
+    else:
+      self.datastore.update({id: new_data})
+
+  @persist
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents with a single write of the object.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    self._changed.update(documents)
+    self.datastore.update(documents)
+    return {id: None for id in documents}
+
+  @persist
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents with a single write of the object.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    self._changed.update(documents)
+    for id, new_data in documents.items():
+      if document := self.datastore.get(id):
+        document.update(new_data)
+      else:
+        self.datastore.update({id: new_data})
+    return {id: None for id in documents}
 
   @persist
   def delete_document(self, id: str, key: Optional[str] = None) -> None:
@@ -147,6 +398,7 @@ class CloudStorage(AbstractDatastore):
         id (str): the id of the document within the collection.
         key (str, optional): the key to remove. Defaults to None.
     """
+    self._changed.add(id)
     try:
       if key:
         if doc := self.datastore.get(id):
@@ -192,3 +444,217 @@ class CloudStorage(AbstractDatastore):
         documents (List[DocumentReference]): list of all documents
     """
     return self.list_documents()
+
+
+class AsyncCloudStorage(AsyncAbstractDatastore):
+  """The asyncio version of `CloudStorage`.
+
+  This uses the project's shared GCS filesystem (see `filesystem`), whose
+  coroutines run on gcsfs' own IO loop and are awaited from the caller's, so
+  the object is read and written without blocking it. Reads after the first
+  are served from memory; an `asyncio.Lock` serializes the mutations and
+  their uploads.
+
+  Several processes may share the object. As in `CloudStorage`, each upload
+  is conditional on the object still being the generation last read; if
+  another writer has replaced it, the object is read again, the change
+  applied to what was read and the upload retried, up to `max_attempts`
+  times with a randomized exponential backoff. `stats` reports how often
+  that happens.
+
+  Args:
+      max_attempts (int): uploads to try before a write fails
+      backoff (float): the longest wait, in seconds, before the first retry;
+                       it doubles for each retry after that
+  """
+
+  def __init__(self,
+               project: str,
+               bucket: str,
+               email: str = None,
+               datastore_file: str = 'datastore.json',
+               max_attempts: int = 5,
+               backoff: float = 0.1,
+               codec: Optional[codecs.Codec] = None) -> AsyncAbstractDatastore:
+    self._project = project
+    self._email = email
+    self._bucket = bucket
+    self._datastore_file = datastore_file
+    self._max_attempts = max_attempts
+    self._backoff = backoff
+    self._codec = codec or codecs.Codec()
+    self._datastore: Optional[Dict[str, Any]] = None
+    self._generation: Optional[str] = None
+    self._loading: Optional[asyncio.Future] = None
+    self._lock = asyncio.Lock()
+    self._stats = ContentionStats()
+
+  @property
+  def fs(self) -> gcsfs.GCSFileSystem:
+    """The project's shared GCS filesystem."""
+    return filesystem(self._project)
+
+  @property
+  def file_name(self) -> str:
+    return f'{self._bucket}/{self._datastore_file}'
+
+  @property
+  def generation(self) -> Optional[str]:
+    """The generation of the object last read or written, if known."""
+    return self._generation
+
+  @property
+  def stats(self) -> ContentionStats:
+    """A snapshot of the datastore's write contention metrics."""
+    return dataclasses.replace(self._stats)
+
+  async def _call(self, *args, **kwargs) -> Any:
+    """Makes a `GCSFileSystem.call` on the filesystem's own loop."""
+    fs = self.fs
+    return await asyncio.wrap_future(
+        asyncio.run_coroutine_threadsafe(fs._call(*args, **kwargs), fs.loop))
+
+  async def datastore(self) -> Dict[str, Any]:
+    """The document map, loaded on first use.
+
+    Every caller arriving before the load has finished awaits the same load,
+    and so gets the same map: a reader cannot replace the map a writer has
+    already changed with a stale copy of its own.
+    """
+    if self._datastore is None:
+      if self._loading is None:
+        self._loading = asyncio.ensure_future(self._load())
+      try:
+        self._datastore, self._generation = \
+            await asyncio.shield(self._loading)
+      finally:
+        self._loading = None
+    return self._datastore
+
+  async def _load(self) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Reads the object, returning its documents and its generation."""
+    try:
+      headers, data = await self._call('GET', self.fs.url(self.file_name))
+    except FileNotFoundError:
+      return {}, None
+    return codecs.decode(data), headers.get('x-goog-generation')
+
+  async def _upload(self, datastore: Dict[str, Any]) -> Dict[str, Any]:
+    """Uploads the document map if the object is still the one last read.
+
+    Raises:
+        FileExistsError: if the object has been written since (HTTP 412)
+    """
+    bucket, name = self.file_name.split('/', 1)
+    return await self._call(
+        'POST', api_url(self.fs, 'b', bucket, 'o', upload=True),
+        uploadType='media', name=name,
+        data=self._codec.encode(datastore),
+        ifGenerationMatch=self._generation or '0',
+        headers={'Content-Type': self._codec.content_type}, json_out=True)
+
+  async def _modify(self, change: Callable[[Dict[str, Any]], None]) -> None:
+    """Applies a change to the document map and uploads it, safely.
+
+    On a conflict the object is read again, `change` applied to what was
+    read and the upload retried after a randomized backoff.
+
+    Args:
+        change (Callable[[Dict[str, Any]], None]): changes the map in place
+    """
+    async with self._lock:
+      datastore = await self.datastore()
+      for attempt in itertools.count(1):
+        change(datastore)
+        try:
+          metadata = await self._upload(datastore)
+          break
+
+        except FileExistsError:
+          self._stats.conflicts += 1
+          if attempt >= self._max_attempts:
+            self._stats.failed += 1
+            self._datastore = None      # read it again next time
+            raise
+
+          delay = random.uniform(0, self._backoff * 2 ** (attempt - 1))
+          self._stats.backoff += delay
+          await asyncio.sleep(delay)
+          datastore, self._generation = await self._load()
+          self._datastore = datastore
+
+      self._generation = metadata.get('generation')
+      self._stats.writes += 1
+      self._stats.max_attempts = max(self._stats.max_attempts, attempt)
+
+  async def get_document(self, id: str,
+                         key: Optional[str] = None) -> Dict[str, Any]:
+    """Fetches a document.
+
+    See `CloudStorage.get_document`.
+    """
+    if parent := (await self.datastore()).get(id):
+      if key:
+        value = parent.get(key)
+        return {key: value} if value else None
+      else:
+        return {id: parent}
+
+  async def store_document(self, id: str, document: Dict[str, Any]) -> None:
+    """Stores a document.
+
+    See `CloudStorage.store_document`.
+    """
+    def _store(datastore: Dict[str, Any]) -> None:
+      datastore[id] = document
+
+    await self._modify(_store)
+
+  async def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    If the document is not already there, it will be created.
+    """
+    def _update(datastore: Dict[str, Any]) -> None:
+      if document := datastore.get(id):
+        document.update(new_data)
+      else:
+        datastore[id] = dict(new_data)
+
+    await self._modify(_update)
+
+  async def delete_document(self, id: str, key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    See `CloudStorage.delete_document`.
+    """
+    def _delete(datastore: Dict[str, Any]) -> None:
+      if key:
+        if doc := datastore.get(id):
+          doc.pop(key, None)
+      else:
+        datastore.pop(id, None)
+
+    await self._modify(_delete)
+
+  async def list_documents(self, key: Optional[str] = None) -> List[str]:
+    """Lists documents in a collection.
+
+    See `CloudStorage.list_documents`.
+    """
+    keys = None
+    if datastore := await self.datastore():
+      if key:
+        if sub_docs := datastore.get(key):
+          keys = sub_docs.keys()
+      else:
+        keys = datastore
+
+    return keys
+
+  async def get_all_documents(self) -> List[Dict[str, Any]]:
+    """Lists all documents.
+
+    See `CloudStorage.get_all_documents`.
+    """
+    return await self.list_documents()
@@ -12,11 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import itertools
 import json
+import os
+import re
+import threading
 import unittest
+import uuid
+from concurrent import futures
 from unittest import mock
 
 from auth.datastore import cloud_storage
+from auth.datastore import codecs
 
 from copy import deepcopy
 from typing import Any, Dict
@@ -33,170 +41,530 @@ MASTER_CONFIG = {
 }
 
 CLASS_UNDER_TEST = 'auth.cloud_storage'
+LOCATION = 'https://storage.googleapis.com'
+
+
+class _FakeBucket(object):
+  """Answers the `GCSFileSystem.call`s `CloudStorage` makes from memory.
+
+  Objects are kept as (data, generation), keyed by 'bucket/name'. Downloads,
+  304 Not Modified answers and uploads are counted, and uploads honour
+  `ifGenerationMatch` ('0' meaning the object must not exist).
+  """
+
+  def __init__(self, objects: Dict[str, bytes]):
+    self.generations = itertools.count(1)
+    self.objects = {name: (data, next(self.generations))
+                    for name, data in objects.items()}
+    self.downloads = 0
+    self.not_modified = 0
+    self.uploads = 0
+
+  def url(self, path: str) -> str:
+    bucket, name = path.split('/', 1)
+    return f'{LOCATION}/download/storage/v1/b/{bucket}/o/{name}?alt=media'
+
+  def call(self, method: str, url: str, headers=None, data=None,
+           json_out=False, **params) -> Any:
+    if method == 'GET':
+      bucket, name = re.match(r'.*/b/(.*)/o/(.*)\?alt=media', url).groups()
+      if (path := f'{bucket}/{name}') not in self.objects:
+        raise FileNotFoundError(path)
+
+      data, generation = self.objects[path]
+      if params.get('ifGenerationNotMatch') == str(generation):
+        self.not_modified += 1
+        return {}, b''
+
+      self.downloads += 1
+      return {'x-goog-generation': str(generation)}, data
+
+    bucket = re.match(r'.*/b/(.*)/o', url).group(1)
+    path = f'{bucket}/{params["name"]}'
+    if (match := params.get('ifGenerationMatch')) is not None:
+      if match != str(self.objects.get(path, (None, 0))[1]):
+        raise FileExistsError(path)
+
+    generation = next(self.generations)
+    self.objects[path] = (data, generation)
+    self.uploads += 1
+    return {'generation': str(generation)}
+
+  def stored(self, path: str = 'buttercup/datastore.json') -> Dict[str, Any]:
+    return json.loads(self.objects[path][0])
 
 
 class CloudStorageTest(unittest.TestCase):
   def setUp(self):
-    self.open = mock.mock_open(read_data=json.dumps(MASTER_CONFIG))
-    # mock.patch('gcsfs.GCSFileSystem', autospec=True).start()
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_get_document_with_key(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-      self.assertEqual({'api_key': 'api_key'},
-                       datastore.get_document('auth', 'api_key'))
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_get_document_without_key(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-      self.assertEqual(MASTER_CONFIG,
-                       datastore.get_document('auth'))
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_get_document_missing_type(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-      self.assertEqual(None, datastore.get_document('10011'))
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_get_document_missing_id(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-      self.assertEqual(None, datastore.get_document('10011'))
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_get_document_missing_key(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-      self.assertEqual(None, datastore.get_document('auth', 'foo'))
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_store_new_document(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-      datastore.store_document(id='0000', document={'id': '0000'})
+    cloud_storage._filesystems.clear()
+    self.filesystem = mock.patch('gcsfs.GCSFileSystem').start()
+    self.fs = self.filesystem.return_value
+    self.bucket = _FakeBucket({
+        'buttercup/datastore.json': json.dumps(MASTER_CONFIG).encode('utf-8')})
+    self.fs.base = f'{LOCATION}/storage/v1/'
+    self.fs.url.side_effect = self.bucket.url
+    self.fs.call.side_effect = self.bucket.call
+
+  def tearDown(self):
+    mock.patch.stopall()
+    cloud_storage._filesystems.clear()
+
+  def _datastore(self, **kwargs) -> cloud_storage.CloudStorage:
+    return cloud_storage.CloudStorage(project='westley', bucket='buttercup',
+                                      **kwargs)
+
+  def test_get_document_with_key(self):
+    datastore = self._datastore()
+    self.assertEqual({'api_key': 'api_key'},
+                     datastore.get_document('auth', 'api_key'))
+
+  def test_get_document_without_key(self):
+    datastore = self._datastore()
+    self.assertEqual(MASTER_CONFIG,
+                     datastore.get_document('auth'))
+
+  def test_get_document_missing_type(self):
+    datastore = self._datastore()
+    self.assertEqual(None, datastore.get_document('10011'))
+
+  def test_get_document_missing_id(self):
+    datastore = self._datastore()
+    self.assertEqual(None, datastore.get_document('10011'))
+
+  def test_get_document_missing_key(self):
+    datastore = self._datastore()
+    self.assertEqual(None, datastore.get_document('auth', 'foo'))
+
+  def test_get_document_missing_blob(self):
+    datastore = self._datastore(datastore_file='missing.json')
+    self.assertIsNone(datastore.get_document('auth'))
+
+  def test_get_documents(self):
+    datastore = self._datastore()
+    self.assertEqual({'auth': MASTER_CONFIG['auth']},
+                     datastore.get_documents(['auth', '10011']))
+    self.assertEqual(1, self.bucket.downloads)
+
+  def test_store_new_document(self):
+    datastore = self._datastore()
+    datastore.store_document(id='0000', document={'id': '0000'})
+
+    expected = deepcopy(MASTER_CONFIG)
+    expected.update({'0000': {'id': '0000'}})
+    self.assertEqual(expected, self.bucket.stored())
+
+  def test_store_new_document_new_name(self):
+    datastore = self._datastore(datastore_file='new_datastore.json')
+    datastore.store_document(id='0000', document={'id': '0000'})
+
+    self.assertEqual({'0000': {'id': '0000'}},
+                     self.bucket.stored('buttercup/new_datastore.json'))
+
+  def test_list_documents_all(self):
+    datastore = self._datastore()
+
+    _docs = datastore.list_documents()
+    expected = MASTER_CONFIG
+    self.assertDictEqual(expected, _docs)
+
+  def test_list_documents_auth(self):
+    datastore = self._datastore()
+
+    _docs = datastore.list_documents('auth')
+    expected = MASTER_CONFIG.get('auth')
+    self.assertEqual(expected.keys(), _docs)
+
+  def test_list_documents_none(self):
+    datastore = self._datastore()
+
+    _docs = datastore.list_documents('foo')
+    self.assertIsNone(_docs)
+
+  def test_get_all_documents(self):
+    datastore = self._datastore()
+
+    _docs = datastore.get_all_documents()
+    expected = MASTER_CONFIG
+    self.assertEqual(expected, _docs)
+
+  def test_delete_document_collection(self):
+    datastore = self._datastore()
+
+    datastore.delete_document(id='auth')
+    self.assertEqual({}, datastore.datastore)
+    self.assertEqual({}, self.bucket.stored())
+
+  def test_delete_document_key(self):
+    datastore = self._datastore()
+
+    datastore.delete_document(
+        id='auth', key='api_key')
+    self.assertEqual({
+        'auth': {'bHVrZUBza3l3YWxrZXIuY29t': {
+            '_key': 'luke@skywalker.com',
+            'access_token': 'access_token',
+                            'refresh_token': 'refresh_token'}}},
+        datastore.datastore)
+
+  def test_delete_document_key_missing(self):
+    datastore = self._datastore()
+
+    datastore.delete_document(
+        id='auth', key='foo')
+    self.assertEqual(MASTER_CONFIG,
+                     datastore.datastore)
+
+  def test_update_document_existing(self):
+    datastore = self._datastore()
+
+    expected = {'api_key': 'new api key'}
+    datastore.update_document(id='auth',
+                              new_data=expected)
+    self.assertEqual(expected.get('api_key'),
+                     datastore.datastore.get('auth').get('api_key'))
+    self.assertEqual(expected.get('api_key'),
+                     self.bucket.stored()['auth']['api_key'])
+
+  def test_update_document_new(self):
+    datastore = self._datastore()
+
+    datastore.update_document(id='0000', new_data={'id': '0000'})
+    self.assertEqual({'id': '0000'}, datastore.datastore.get('0000'))
 
-      expected = deepcopy(MASTER_CONFIG)
-      expected.update({'0000': {'id': '0000'}})
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_store_new_document_new_name(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(
-          project='westley',
-          bucket='buttercup',
-          datastore_file='new_datastore.json')
+  def test_update_documents_single_write(self):
+    datastore = self._datastore()
+
+    results = datastore.update_documents({'auth': {'api_key': 'new'},
+                                          '0000': {'id': '0000'}})
+    self.assertEqual({'auth': None, '0000': None}, results)
+    self.assertEqual(1, self.bucket.uploads)
+    self.assertEqual('new', datastore.datastore['auth']['api_key'])
+
+  def test_batch_single_write(self):
+    datastore = self._datastore()
+
+    with datastore.batch():
       datastore.store_document(id='0000', document={'id': '0000'})
+      datastore.update_document(id='0001', new_data={'id': '0001'})
+      datastore.delete_document(id='auth', key='api_key')
+      self.assertEqual(0, self.bucket.uploads)
+
+    self.assertEqual(1, self.bucket.uploads)
+
+  def test_filesystem_shared(self):
+    self._datastore().get_document('auth')
+    self._datastore().store_document(id='0000', document={})
+    cloud_storage.CloudStorage(project='inigo', bucket='buttercup')\
+        .get_document('auth')
+
+    self.assertEqual([mock.call(project='westley'),
+                      mock.call(project='inigo')],
+                     self.filesystem.call_args_list)
+
+  def test_unchanged_not_downloaded_again(self):
+    datastore = self._datastore()
+    datastore.get_document('auth')
+    datastore.reload()
+    datastore.reload()
+
+    self.assertEqual(1, self.bucket.downloads)
+    self.assertEqual(2, self.bucket.not_modified)
+
+  def test_own_write_not_downloaded(self):
+    datastore = self._datastore()
+    datastore.store_document(id='0000', document={'id': '0000'})
+    datastore.reload()
+
+    self.assertEqual(1, self.bucket.downloads)
+    self.assertEqual(1, self.bucket.not_modified)
+
+  def test_changed_downloaded(self):
+    datastore = self._datastore()
+    datastore.get_document('auth')
+    self._datastore().store_document(id='0000', document={'id': '0000'})
+
+    datastore.reload()
+    self.assertEqual({'0000': {'id': '0000'}}, datastore.get_document('0000'))
+
+  def test_max_age(self):
+    datastore = self._datastore(max_age=0)
+    self._datastore().get_document('auth')
+    datastore.get_document('auth')
+    self._datastore().store_document(id='0000', document={'id': '0000'})
+
+    self.assertEqual({'0000': {'id': '0000'}}, datastore.get_document('0000'))
+
+  def test_reload_keeps_unwritten_changes(self):
+    datastore = self._datastore()
+    with datastore.batch():
+      datastore.store_document(id='0000', document={'id': '0000'})
+      datastore.reload()
+      self.assertIsNotNone(datastore.get_document('0000'))
+
+  def test_new_object_must_not_exist(self):
+    datastore = self._datastore(datastore_file='new_datastore.json')
+    datastore.get_document('westley')
+    self._datastore(datastore_file='new_datastore.json').store_document(
+        id='buttercup', document={})
+
+    datastore.store_document(id='westley', document={})
+    self.assertEqual({'westley': {}, 'buttercup': {}},
+                     self.bucket.stored('buttercup/new_datastore.json'))
+    self.assertEqual(1, datastore.stats.conflicts)
+
+  @mock.patch('time.sleep')
+  def test_conflict_merges_documents(self, sleep):
+    westley = self._datastore()
+    buttercup = self._datastore()
+    westley.get_document('auth')
+    buttercup.get_document('auth')
+
+    westley.store_document(id='westley', document={'token': 'w'})
+    with buttercup.batch():
+      buttercup.store_document(id='buttercup', document={'token': 'b'})
+      buttercup.delete_document(id='auth')
+
+    self.assertEqual({'westley': {'token': 'w'},
+                      'buttercup': {'token': 'b'}}, self.bucket.stored())
+    self.assertEqual({'westley': {'token': 'w'},
+                      'buttercup': {'token': 'b'}}, buttercup.datastore)
+    self.assertEqual(cloud_storage.ContentionStats(
+        writes=1, conflicts=1, backoff=sleep.call_args.args[0],
+        max_attempts=2), buttercup.stats)
+    self.assertLessEqual(sleep.call_args.args[0], 0.1)
+
+  @mock.patch('time.sleep')
+  def test_conflict_gives_up(self, sleep):
+    datastore = self._datastore(max_attempts=3, backoff=1.0)
+    datastore.get_document('auth')
+    # Another writer replaces the object now, and again every time it is read.
+    self.bucket.objects['buttercup/datastore.json'] = (b'{}', 1000)
+    self.fs.call.side_effect = self._racing_call
+
+    with self.assertRaises(FileExistsError):
+      datastore.store_document(id='westley', document={})
+
+    self.assertEqual(3, datastore.stats.conflicts)
+    self.assertEqual(1, datastore.stats.failed)
+    self.assertEqual(0, datastore.stats.writes)
+    self.assertTrue(datastore.dirty)
+    self.assertEqual(2, sleep.call_count)
+    self.assertLessEqual(sleep.call_args_list[1].args[0], 2.0)
+
+  def _racing_call(self, method: str, url: str, **kwargs) -> Any:
+    result = self.bucket.call(method, url, **kwargs)
+    if method == 'GET':
+      data, generation = self.bucket.objects['buttercup/datastore.json']
+      self.bucket.objects['buttercup/datastore.json'] = (data, generation + 1)
+    return result
+
+
+class ApiUrlTest(unittest.TestCase):
+  def test_object(self):
+    fs = mock.Mock(base=f'{LOCATION}/storage/v1/')
+    self.assertEqual(
+        f'{LOCATION}/storage/v1/b/buttercup/o/datastore%2Fwestley%20w.json',
+        cloud_storage.api_url(fs, 'b', 'buttercup', 'o',
+                              'datastore/westley w.json'))
+
+  def test_upload(self):
+    fs = mock.Mock(base='http://localhost:4443/storage/v1/')
+    self.assertEqual('http://localhost:4443/upload/storage/v1/b/buttercup/o',
+                     cloud_storage.api_url(fs, 'b', 'buttercup', 'o',
+                                           upload=True))
+
+  def test_gcsfs(self):
+    fs = cloud_storage.gcsfs.GCSFileSystem(token='anon',
+                                           skip_instance_cache=True)
+    self.assertTrue(fs.base.endswith(cloud_storage.API_PATH))
+    self.assertRegex(cloud_storage.api_url(fs, 'b', 'buttercup', 'o',
+                                           upload=True),
+                     r'^https?://[^/]+/upload/storage/v1/b/buttercup/o$')
+
+  def test_unsupported_endpoint(self):
+    fs = mock.Mock(base=f'{LOCATION}/storage/v2/')
+    with self.assertRaises(ValueError):
+      cloud_storage.api_url(fs, 'b', 'buttercup', 'o')
+
+
+@unittest.skipUnless(os.environ.get('STORAGE_EMULATOR_HOST'),
+                     'needs a fake-gcs-server; set STORAGE_EMULATOR_HOST')
+class CloudStorageEmulatorTest(unittest.TestCase):
+  """Runs against a local fake GCS server, for example
+
+      docker run -p 4443:4443 fsouza/fake-gcs-server -scheme http
+      STORAGE_EMULATOR_HOST=http://localhost:4443 python -m pytest ...
+  """
+
+  def setUp(self):
+    cloud_storage._filesystems.clear()
+    self.bucket = f'florin-{uuid.uuid4().hex[:8]}'
+    cloud_storage.filesystem('florin').mkdir(self.bucket)
+
+  def tearDown(self):
+    cloud_storage.filesystem('florin').rm(self.bucket, recursive=True)
+    cloud_storage._filesystems.clear()
+
+  def _datastore(self) -> cloud_storage.CloudStorage:
+    return cloud_storage.CloudStorage(project='florin', bucket=self.bucket)
+
+  def test_round_trip(self):
+    self._datastore().store_document(id='westley', document={'token': 'w'})
 
-      expected = deepcopy(MASTER_CONFIG)
-      expected.update({'0000': {'id': '0000'}})
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_list_documents_all(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      _docs = datastore.list_documents()
-      expected = MASTER_CONFIG
-      self.assertDictEqual(expected, _docs)
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_list_documents_auth(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      _docs = datastore.list_documents('auth')
-      expected = MASTER_CONFIG.get('auth')
-      self.assertEqual(expected.keys(), _docs)
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_list_documents_none(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      _docs = datastore.list_documents('foo')
-      self.assertIsNone(_docs)
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_get_all_documents(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      _docs = datastore.get_all_documents()
-      expected = MASTER_CONFIG
-      self.assertEqual(expected, _docs)
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_delete_document_collection(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      datastore.delete_document(id='auth')
-      self.assertEqual({}, datastore.datastore)
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_delete_document_key(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      datastore.delete_document(
-          id='auth', key='api_key')
-      self.assertEqual({
-          'auth': {'bHVrZUBza3l3YWxrZXIuY29t': {
-              '_key': 'luke@skywalker.com',
-              'access_token': 'access_token',
-                              'refresh_token': 'refresh_token'}}},
-          datastore.datastore)
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_delete_document_key_missing(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      datastore.delete_document(
-          id='auth', key='foo')
-      self.assertEqual(MASTER_CONFIG,
-                       datastore.datastore)
-
-  @mock.patch('gcsfs.GCSFileSystem')
-  def test_update_document_existing(self, mock_filesystem):
-    mock_filesystem.return_value.get.return_value = []
-    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
-      datastore = cloud_storage.CloudStorage(project='westley',
-                                             bucket='buttercup')
-
-      expected = {'api_key': 'new api key'}
-      datastore.update_document(id='auth',
-                                new_data=expected)
-      self.assertEqual(expected.get('api_key'),
-                       datastore.datastore.get('auth').get('api_key'))
+    datastore = self._datastore()
+    self.assertEqual({'westley': {'token': 'w'}},
+                     datastore.get_document('westley'))
+    self.assertIsNotNone(datastore.generation)
+
+  def test_conditional_reload(self):
+    datastore = self._datastore()
+    datastore.store_document(id='westley', document={'token': 'w'})
+    generation = datastore.generation
+
+    datastore.reload()
+    self.assertEqual(generation, datastore.generation)
+
+    self._datastore().store_document(id='buttercup', document={'token': 'b'})
+    datastore.reload()
+    self.assertNotEqual(generation, datastore.generation)
+    self.assertIsNotNone(datastore.get_document('buttercup'))
+
+  def test_concurrent_writers(self):
+    def _write(name: str) -> cloud_storage.ContentionStats:
+      datastore = self._datastore()
+      for i in range(5):
+        datastore.store_document(id=f'{name}{i}', document={'token': i})
+      return datastore.stats
+
+    names = ['westley', 'buttercup', 'inigo', 'fezzik']
+    with futures.ThreadPoolExecutor(max_workers=len(names)) as pool:
+      stats = list(pool.map(_write, names))
+
+    self.assertEqual(20, len(self._datastore().list_documents()))
+    self.assertEqual(20, sum(s.writes for s in stats))
+
+
+class AsyncCloudStorageTest(unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    cloud_storage._filesystems.clear()
+    self.filesystem = mock.patch('gcsfs.GCSFileSystem').start()
+    self.fs = self.filesystem.return_value
+    self.bucket = _FakeBucket({
+        'buttercup/datastore.json': json.dumps(MASTER_CONFIG).encode('utf-8')})
+    self.fs.base = f'{LOCATION}/storage/v1/'
+    self.fs.url.side_effect = self.bucket.url
+    self.fs._call = mock.AsyncMock(side_effect=self.bucket.call)
+
+    # gcsfs runs its coroutines on a loop of its own, in another thread.
+    self.fs.loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=self.fs.loop.run_forever, daemon=True)
+    thread.start()
+    self.addCleanup(thread.join)
+    self.addCleanup(self.fs.loop.call_soon_threadsafe, self.fs.loop.stop)
+
+  def tearDown(self):
+    mock.patch.stopall()
+    cloud_storage._filesystems.clear()
+
+  def _datastore(self, **kwargs) -> cloud_storage.AsyncCloudStorage:
+    return cloud_storage.AsyncCloudStorage(project='westley',
+                                           bucket='buttercup', **kwargs)
+
+  async def test_get_document_with_key(self):
+    datastore = self._datastore()
+    self.assertEqual({'api_key': 'api_key'},
+                     await datastore.get_document('auth', 'api_key'))
+    self.filesystem.assert_called_once_with(project='westley')
+    self.assertEqual(1, self.bucket.downloads)
+
+  async def test_get_document_missing_blob(self):
+    self.bucket.objects.clear()
+    self.assertIsNone(await self._datastore().get_document('auth'))
+
+  async def test_reads_cached(self):
+    datastore = self._datastore()
+    await datastore.get_document('auth')
+    await datastore.get_document('auth', 'api_key')
+    self.assertEqual(1, self.bucket.downloads)
+
+  async def test_concurrent_first_reads_share_load(self):
+    loaded = threading.Event()
+
+    def _call(*args, **kwargs):
+      loaded.wait(5)
+      return self.bucket.call(*args, **kwargs)
+
+    self.fs._call.side_effect = _call
+    datastore = self._datastore()
+    reader = asyncio.ensure_future(datastore.get_document('auth'))
+    writer = asyncio.ensure_future(
+        datastore.update_document(id='0000', new_data={'id': '0000'}))
+    await asyncio.sleep(0)
+    loaded.set()
+    await asyncio.gather(reader, writer)
+
+    self.assertEqual({'0000': {'id': '0000'}},
+                     await datastore.get_document('0000'))
+    self.assertEqual(1, self.bucket.downloads)
+
+  async def test_update_document_new(self):
+    datastore = self._datastore()
+    await datastore.update_document(id='0000', new_data={'id': '0000'})
+
+    expected = deepcopy(MASTER_CONFIG)
+    expected.update({'0000': {'id': '0000'}})
+    self.assertEqual(expected, self.bucket.stored())
+    self.assertEqual(1, datastore.stats.writes)
+
+  async def test_delete_document_collection(self):
+    datastore = self._datastore()
+    await datastore.delete_document(id='auth')
+    self.assertEqual({}, self.bucket.stored())
+
+  async def test_upload_is_conditional(self):
+    datastore = self._datastore()
+    await datastore.store_document(id='westley', document={'token': 'w'})
+
+    _, kwargs = self.fs._call.call_args
+    self.assertEqual('1', kwargs['ifGenerationMatch'])
+    self.assertEqual(self.bucket.objects['buttercup/datastore.json'][1],
+                     int(datastore.generation))
+
+  async def test_concurrent_writers(self):
+    westley = self._datastore(backoff=0)
+    buttercup = self._datastore(backoff=0)
+    await westley.get_document('auth')
+    await buttercup.get_document('auth')
+
+    await asyncio.gather(
+        westley.update_document(id='auth', new_data={'westley': 'w'}),
+        buttercup.update_document(id='auth', new_data={'buttercup': 'b'}),
+        buttercup.store_document(id='inigo', document={'token': 'i'}))
+
+    stored = self.bucket.stored()
+    self.assertEqual('w', stored['auth']['westley'])
+    self.assertEqual('b', stored['auth']['buttercup'])
+    self.assertEqual('api_key', stored['auth']['api_key'])
+    self.assertEqual({'token': 'i'}, stored['inigo'])
+    self.assertEqual(3, westley.stats.writes + buttercup.stats.writes)
+    self.assertLessEqual(1, westley.stats.conflicts + buttercup.stats.conflicts)
+
+  async def test_gives_up_after_max_attempts(self):
+    datastore = self._datastore(max_attempts=2, backoff=0)
+    await datastore.get_document('auth')
+    self.bucket.objects['buttercup/datastore.json'] = (b'{}', 99)
+
+    async def _race(*args, **kwargs):
+      result = self.bucket.call(*args, **kwargs)
+      if args[0] == 'GET':                # someone writes after every read
+        data, generation = self.bucket.objects['buttercup/datastore.json']
+        self.bucket.objects['buttercup/datastore.json'] = (data,
+                                                           generation + 1)
+      return result
+
+    self.fs._call.side_effect = _race
+    with self.assertRaises(FileExistsError):
+      await datastore.store_document(id='westley', document={'token': 'w'})
+
+    self.assertEqual(1, datastore.stats.failed)
+    self.assertEqual(2, datastore.stats.conflicts)
@@ -0,0 +1,199 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serialization of whole-store datastores (`LocalFile`, `CloudStorage`).
+
+A `Codec` turns the document map into bytes and `decode` turns any codec's
+bytes back into a map. Plain compact JSON, the default, is written as is, so
+the file stays readable by anything (including older versions of this
+library). Every other combination is prefixed with a six byte header,
+`MAGIC` then one byte naming the format and one naming the compression,
+which `decode` reads to know what follows; data without the header is JSON,
+so stores written before codecs existed still load.
+
+orjson, msgpack and zstandard are optional; a `Codec` needing one that is not
+installed cannot be created.
+"""
+from __future__ import annotations
+
+import enum
+import gzip
+import json
+from typing import Any, Dict, Optional, Union
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+MAGIC = b'\x89OTM'
+
+
+class Format(enum.Enum):
+  """How the document map is serialized.
+
+  JSON is compact JSON from the standard library; ORJSON is the same JSON,
+  made by orjson. Either can be read with or without orjson installed.
+  """
+  JSON = 'json'
+  ORJSON = 'orjson'
+  MSGPACK = 'msgpack'
+
+
+class Compression(enum.Enum):
+  NONE = 'none'
+  GZIP = 'gzip'
+  ZSTD = 'zstd'
+
+
+# The header byte for each format and compression. ORJSON writes JSON, so
+# they share one.
+_FORMAT_BYTES = {Format.JSON: b'j', Format.ORJSON: b'j', Format.MSGPACK: b'm'}
+_COMPRESSION_BYTES = {Compression.NONE: b'n',
+                      Compression.GZIP: b'g',
+                      Compression.ZSTD: b'z'}
+_HEADER_SIZE = len(MAGIC) + 2
+
+
+class Codec(object):
+  """Encodes the document map of a datastore.
+
+  Args:
+      format (Format): the serialization
+      compression (Compression): the compression applied after it
+      level (int): the compression level, or None for the library's default
+  """
+
+  def __init__(self,
+               format: Union[Format, str] = Format.JSON,
+               compression: Union[Compression, str] = Compression.NONE,
+               level: Optional[int] = None) -> Codec:
+    self._format = Format(format)
+    self._compression = Compression(compression)
+    self._level = level
+
+    if self._format is Format.ORJSON and not orjson:
+      raise ValueError('The orjson format needs "orjson" to be installed.')
+    if self._format is Format.MSGPACK and not msgpack:
+      raise ValueError('The msgpack format needs "msgpack" to be installed.')
+    if self._compression is Compression.ZSTD and not zstandard:
+      raise ValueError('zstd compression needs "zstandard" to be installed.')
+
+  def __repr__(self) -> str:
+    return (f'Codec(format={self._format.value!r}, '
+            f'compression={self._compression.value!r})')
+
+  @property
+  def format(self) -> Format:
+    return self._format
+
+  @property
+  def compression(self) -> Compression:
+    return self._compression
+
+  @property
+  def content_type(self) -> str:
+    """The MIME type of the encoded bytes, for object stores."""
+    if self._format is Format.MSGPACK or \
+            self._compression is not Compression.NONE:
+      return 'application/octet-stream'
+    return 'application/json'
+
+  def encode(self, documents: Dict[str, Any]) -> bytes:
+    """Encodes a document map.
+
+    Args:
+        documents (Dict[str, Any]): the documents, keyed by id
+
+    Returns:
+        bytes: the encoded map, with its header unless it is plain JSON
+    """
+    if self._format is Format.MSGPACK:
+      data = msgpack.packb(documents)
+    elif self._format is Format.ORJSON:
+      data = orjson.dumps(documents)
+    else:
+      data = json.dumps(documents, separators=(',', ':')).encode('utf-8')
+
+    if self._compression is Compression.GZIP:
+      data = gzip.compress(data, 6 if self._level is None else self._level,
+                           mtime=0)
+    elif self._compression is Compression.ZSTD:
+      data = zstandard.ZstdCompressor(
+          level=3 if self._level is None else self._level).compress(data)
+    elif self._format is not Format.MSGPACK:
+      return data
+
+    return MAGIC + _FORMAT_BYTES[self._format] + \
+        _COMPRESSION_BYTES[self._compression] + data
+
+
+def _loads_json(data: Union[bytes, str]) -> Dict[str, Any]:
+  if orjson:
+    try:
+      return orjson.loads(data)
+    except orjson.JSONDecodeError:
+      pass                              # NaN, or an integer over 64 bits
+  return json.loads(data)
+
+
+def decode(data: Union[bytes, str]) -> Dict[str, Any]:
+  """Decodes a document map written by any `Codec`, or as plain JSON.
+
+  Args:
+      data (Union[bytes, str]): the stored data
+
+  Returns:
+      Dict[str, Any]: the documents, keyed by id; empty if there is no data
+
+  Raises:
+      ValueError: if the header names a format or compression that is not
+                  known, or whose library is not installed
+  """
+  if not data:
+    return {}
+
+  if isinstance(data, str) or not data.startswith(MAGIC):
+    return _loads_json(data)
+
+  format = data[len(MAGIC):len(MAGIC) + 1]
+  compression = data[len(MAGIC) + 1:_HEADER_SIZE]
+  data = data[_HEADER_SIZE:]
+
+  if compression == _COMPRESSION_BYTES[Compression.GZIP]:
+    data = gzip.decompress(data)
+  elif compression == _COMPRESSION_BYTES[Compression.ZSTD]:
+    if not zstandard:
+      raise ValueError('Decoding zstd needs "zstandard" to be installed.')
+    data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+  elif compression != _COMPRESSION_BYTES[Compression.NONE]:
+    raise ValueError(f'Unknown compression {compression!r}.')
+
+  if format == _FORMAT_BYTES[Format.MSGPACK]:
+    if not msgpack:
+      raise ValueError('Decoding msgpack needs "msgpack" to be installed.')
+    return msgpack.unpackb(data)
+  elif format == _FORMAT_BYTES[Format.JSON]:
+    return _loads_json(data)
+
+  raise ValueError(f'Unknown format {format!r}.')
@@ -0,0 +1,108 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import unittest
+from unittest import mock
+
+from auth.datastore import codecs
+
+MASTER_CONFIG = {
+    "auth": {
+        "api_key": "api_key",
+        "bHVrZUBza3l3YWxrZXIuY29t": {
+            "access_token": "access_token",
+            "refresh_token": "refresh_token",
+            "_key": "luke@skywalker.com"
+        },
+    },
+}
+
+
+def _available(format: str, compression: str) -> bool:
+  try:
+    codecs.Codec(format, compression)
+    return True
+  except ValueError:
+    return False
+
+
+class CodecTest(unittest.TestCase):
+  def test_round_trip(self):
+    for format in codecs.Format:
+      for compression in codecs.Compression:
+        if not _available(format, compression):
+          continue
+        with self.subTest(format=format.value, compression=compression.value):
+          codec = codecs.Codec(format, compression)
+          self.assertEqual(MASTER_CONFIG,
+                           codecs.decode(codec.encode(MASTER_CONFIG)))
+
+  def test_default_is_compact_json(self):
+    data = codecs.Codec().encode(MASTER_CONFIG)
+
+    self.assertEqual(MASTER_CONFIG, json.loads(data))
+    self.assertNotIn(b' ', data)
+    self.assertEqual('application/json', codecs.Codec().content_type)
+
+  def test_header(self):
+    data = codecs.Codec('json', 'gzip').encode(MASTER_CONFIG)
+
+    self.assertEqual(codecs.MAGIC + b'jg', data[:6])
+    self.assertEqual('application/octet-stream',
+                     codecs.Codec('json', 'gzip').content_type)
+
+  def test_gzip_deterministic(self):
+    codec = codecs.Codec(compression='gzip')
+    self.assertEqual(codec.encode(MASTER_CONFIG), codec.encode(MASTER_CONFIG))
+
+  def test_decode_legacy(self):
+    legacy = json.dumps(MASTER_CONFIG, indent=2)
+
+    self.assertEqual(MASTER_CONFIG, codecs.decode(legacy))
+    self.assertEqual(MASTER_CONFIG, codecs.decode(legacy.encode('utf-8')))
+
+  def test_decode_empty(self):
+    self.assertEqual({}, codecs.decode(b''))
+    self.assertEqual({}, codecs.decode(''))
+
+  def test_decode_without_orjson(self):
+    data = codecs.Codec().encode(MASTER_CONFIG)
+    with mock.patch.object(codecs, 'orjson', None):
+      self.assertEqual(MASTER_CONFIG, codecs.decode(data))
+
+  def test_decode_beyond_orjson(self):
+    self.assertEqual({'westley': 2**70}, codecs.decode(b'{"westley":' +
+                                                       str(2**70).encode() +
+                                                       b'}'))
+
+  def test_decode_unknown(self):
+    with self.assertRaises(ValueError):
+      codecs.decode(codecs.MAGIC + b'xn{}')
+    with self.assertRaises(ValueError):
+      codecs.decode(codecs.MAGIC + b'jx{}')
+
+  def test_missing_library(self):
+    with mock.patch.object(codecs, 'msgpack', None):
+      with self.assertRaises(ValueError):
+        codecs.Codec('msgpack')
+      with self.assertRaises(ValueError):
+        codecs.decode(codecs.MAGIC + b'mn\x80')
+
+  def test_bad_name(self):
+    with self.assertRaises(ValueError):
+      codecs.Codec(format='pickle')
+
+
+if __name__ == '__main__':
+  unittest.main()
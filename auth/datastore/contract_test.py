@@ -0,0 +1,129 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from auth.abstract_datastore import AbstractDatastore
+
+MASTER_CONFIG = {
+    "auth": {
+        "api_key": "api_key",
+        "bHVrZUBza3l3YWxrZXIuY29t": {
+            "access_token": "access_token",
+            "refresh_token": "refresh_token",
+            "_key": "luke@skywalker.com"
+        },
+    },
+}
+
+
+class DatastoreContract(object):
+  """The behaviour every file-backed datastore shares.
+
+  Mix into a `unittest.TestCase` whose `setUp` sets `self.datastore` to a
+  datastore holding `MASTER_CONFIG`. Writes go through `self.datastore`;
+  reads that should see them go through `_reader()`, which backends that
+  persist to disk override to open the file afresh.
+  """
+  datastore: AbstractDatastore
+
+  def _reader(self) -> AbstractDatastore:
+    return self.datastore
+
+  def test_get_document_with_key(self):
+    self.assertEqual({'api_key': 'api_key'},
+                     self._reader().get_document('auth', 'api_key'))
+
+  def test_get_document_without_key(self):
+    self.assertEqual(MASTER_CONFIG, self._reader().get_document('auth'))
+
+  def test_get_document_missing_id(self):
+    self.assertIsNone(self._reader().get_document('10011'))
+
+  def test_get_document_missing_key(self):
+    self.assertIsNone(self._reader().get_document('auth', 'foo'))
+
+  def test_get_documents(self):
+    self.assertEqual({'auth': MASTER_CONFIG['auth']},
+                     self._reader().get_documents(['auth', '10011']))
+
+  def test_store_document(self):
+    self.datastore.store_document(id='0000', document={'id': '0000'})
+    self.assertEqual({'0000': {'id': '0000'}},
+                     self._reader().get_document('0000'))
+
+  def test_store_documents(self):
+    results = self.datastore.store_documents({'0000': {'id': '0000'},
+                                              '0001': {'id': '0001'}})
+
+    self.assertEqual({'0000': None, '0001': None}, results)
+    self.assertEqual(['0000', '0001', 'auth'],
+                     sorted(self._reader().list_documents()))
+
+  def test_update_document_existing(self):
+    self.datastore.update_document(id='auth',
+                                   new_data={'api_key': 'new api key'})
+
+    document = self._reader().get_document('auth')['auth']
+    self.assertEqual('new api key', document['api_key'])
+    self.assertIn('bHVrZUBza3l3YWxrZXIuY29t', document)
+
+  def test_update_document_new(self):
+    self.datastore.update_document(id='0000', new_data={'id': '0000'})
+    self.assertEqual({'0000': {'id': '0000'}},
+                     self._reader().get_document('0000'))
+
+  def test_update_documents(self):
+    results = self.datastore.update_documents({'auth': {'api_key': 'new'},
+                                               '0000': {'id': '0000'}})
+
+    self.assertEqual({'auth': None, '0000': None}, results)
+    datastore = self._reader()
+    self.assertEqual({'api_key': 'new'},
+                     datastore.get_document('auth', 'api_key'))
+    self.assertIn('bHVrZUBza3l3YWxrZXIuY29t',
+                  datastore.get_document('auth')['auth'])
+    self.assertEqual({'0000': {'id': '0000'}}, datastore.get_document('0000'))
+
+  def test_list_documents_all(self):
+    self.assertEqual(['auth'], self._reader().list_documents())
+
+  def test_list_documents_auth(self):
+    self.assertEqual(sorted(MASTER_CONFIG['auth'].keys()),
+                     sorted(self._reader().list_documents('auth')))
+
+  def test_list_documents_none(self):
+    self.assertIsNone(self._reader().list_documents('foo'))
+
+  def test_get_all_documents(self):
+    self.assertEqual(MASTER_CONFIG, self._reader().get_all_documents())
+
+  def test_delete_document(self):
+    self.datastore.store_document(id='0000', document={'id': '0000'})
+    self.datastore.delete_document(id='auth')
+
+    datastore = self._reader()
+    self.assertIsNone(datastore.get_document('auth'))
+    self.assertEqual(['0000'], datastore.list_documents())
+
+  def test_delete_document_key(self):
+    self.datastore.delete_document(id='auth', key='api_key')
+    self.assertEqual({
+        'auth': {'bHVrZUBza3l3YWxrZXIuY29t': {
+            '_key': 'luke@skywalker.com',
+            'access_token': 'access_token',
+            'refresh_token': 'refresh_token'}}},
+        self._reader().get_all_documents())
+
+  def test_delete_document_key_missing(self):
+    self.datastore.delete_document(id='auth', key='foo')
+    self.datastore.delete_document(id='10011', key='foo')
+    self.assertEqual(MASTER_CONFIG, self._reader().get_all_documents())
@@ -13,12 +13,370 @@
 # limitations under the License.
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+import asyncio
+import copy
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass, replace
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable,
+                    Iterator, List, Mapping, Optional, Tuple)
 
 from auth import decorators
 from auth.abstract_datastore import AbstractDatastore
+from auth.async_abstract_datastore import AsyncAbstractDatastore
 
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath, parse_field_path
+from google.cloud.firestore_v1.watch import ChangeType
+
+# The most writes Firestore accepts in one batch.
+MAX_BATCH_SIZE = 500
+
+# The documents fetched by each query when scanning the collection.
+PAGE_SIZE = 1000
+
+# The most ids an 'in' filter accepts, so the ids each listener of a mirror
+# of chosen documents watches.
+MAX_IN_FILTER = 30
+
+# The most documents a mirror holds by default.
+MAX_MIRRORED = 100_000
+
+# The field of a document holding the lease of the process refreshing it.
+LEASE_FIELD = '_refresh_lease'
+
+
+def _field_paths(keys: Optional[Iterable[str]]) -> Optional[List[str]]:
+  """A field mask selecting the given top-level keys of a document.
+
+  Keys are quoted as needed, so ones containing '.' or other special
+  characters name a single field.
+  """
+  return None if keys is None else [FieldPath(key).to_api_repr()
+                                    for key in keys]
+
+
+def _merge(document: Dict[str, Any], data: Mapping[str, Any]) -> None:
+  """Merges `data` into `document` as `set(merge=True)` does, maps too."""
+  for key, value in data.items():
+    if isinstance(value, Mapping) and isinstance(document.get(key), dict):
+      _merge(document[key], value)
+    else:
+      document[key] = copy.deepcopy(value)
+
+
+def _update(document: Dict[str, Any], data: Mapping[str, Any]) -> None:
+  """Applies `data` to `document` as `update` does.
+
+  Each key is a field path, so 'a.b' sets field 'b' of map 'a', creating the
+  map (or replacing a value that is not one) as Firestore does; quote a part
+  in backticks to name a field containing '.'.
+  """
+  for path, value in data.items():
+    *parents, field = parse_field_path(path)
+    target = document
+    for parent in parents:
+      if not isinstance(target.get(parent), dict):
+        target[parent] = {}
+      target = target[parent]
+    target[field] = copy.deepcopy(value)
+
+
+@dataclass
+class MirrorStats(object):
+  """MirrorStats
+
+  A snapshot of the state of a `Firestore` mirror.
+
+  hits are reads answered by the mirror; misses are reads that needed an RPC,
+  because the id is not mirrored or its listener was (re)connecting.
+  overflowed is set if the collection outgrew `max_documents`, after which
+  every read is a miss.
+  """
+  documents: int = 0
+  synced: bool = False
+  hits: int = 0
+  misses: int = 0
+  changes: int = 0
+  reconnects: int = 0
+  overflowed: bool = False
+
+
+class _Mirror(object):
+  """A local copy of the 'auth' collection, or of chosen documents in it.
+
+  Firestore pushes every change to an `on_snapshot` listener, so the copy
+  stays current without polling. The whole collection takes one listener;
+  chosen ids are split over listeners of `MAX_IN_FILTER` ids each, as that is
+  the most an 'in' filter takes.
+
+  A listener's first snapshot lists every document it matches, and the copy
+  of those documents is rebuilt from it; later snapshots are applied as
+  changes. Until the first snapshot arrives, reads of a listener's documents
+  are misses, which the caller answers with an RPC.
+
+  The client library retries a broken stream itself, resuming where it left
+  off. If it gives up, the listener stops; a monitor thread checks the
+  listeners every `check_interval` seconds, replaces any that have stopped
+  and treats their documents as unsynced until the new listener's first
+  snapshot has rebuilt them.
+
+  The client library holds its own copy of every document a listener
+  matches, so the whole collection is only mirrored while it has at most
+  `max_documents` documents. The limit is checked as documents arrive: a
+  first snapshot larger than it is never copied, and the first document added
+  past it stops the mirror. The mirror then stops its listeners and drops
+  its copy, and every read is a miss from then on.
+  """
+
+  def __init__(self, client: firestore.Client,
+               ids: Optional[Iterable[str]], max_documents: int,
+               check_interval: float) -> _Mirror:
+    self._client = client
+    self._max_documents = max_documents
+    self._check_interval = check_interval
+
+    collection = client.collection('auth')
+    if ids is None:
+      self._chunks: List[Optional[List[str]]] = [None]
+      self._targets = [collection]
+      self._chunk_of: Optional[Dict[str, int]] = None
+    else:
+      ids = sorted(set(ids))
+      if len(ids) > max_documents:
+        raise ValueError(f'Cannot mirror {len(ids)} documents, the most is '
+                         f'{max_documents}.')
+      self._chunks = [ids[start:start + MAX_IN_FILTER]
+                      for start in range(0, len(ids), MAX_IN_FILTER)]
+      self._targets = [
+          collection.where(filter=FieldFilter(
+              FieldPath.document_id(), 'in',
+              [client.document(f'auth/{id}') for id in chunk]))
+          for chunk in self._chunks]
+      self._chunk_of = {id: index for index, chunk in enumerate(self._chunks)
+                        for id in chunk}
+
+    self._documents: Dict[str, Dict[str, Any]] = {}
+    self._watches: List[Any] = [None] * len(self._targets)
+    self._synced = [False] * len(self._targets)
+    self._generations = [0] * len(self._targets)
+    self._condition = threading.Condition()
+    self._stats = MirrorStats()
+    self._stopping = threading.Event()
+    self._monitor: Optional[threading.Thread] = None
+
+  @property
+  def stats(self) -> MirrorStats:
+    """A snapshot of the mirror's metrics."""
+    with self._condition:
+      return replace(self._stats, documents=len(self._documents),
+                     synced=self._all_synced())
+
+  def _all_synced(self) -> bool:
+    return not self._stats.overflowed and all(self._synced)
+
+  def start(self) -> None:
+    """Starts the listeners and the monitor thread."""
+    for index in range(len(self._targets)):
+      self._listen(index)
+    self._monitor = threading.Thread(target=self._run,
+                                     name='firestore-mirror', daemon=True)
+    self._monitor.start()
+
+  def stop(self) -> None:
+    """Stops the listeners and the monitor thread, and drops the copy."""
+    self._stopping.set()
+    self._close_watches()
+    with self._condition:
+      self._documents.clear()
+      self._synced = [False] * len(self._targets)
+
+  def wait(self, timeout: Optional[float] = None) -> bool:
+    """Waits for every listener's first snapshot.
+
+    Args:
+        timeout (float, optional): the most seconds to wait, None for ever
+
+    Returns:
+        bool: True if the whole mirror is in sync
+    """
+    with self._condition:
+      return self._condition.wait_for(self._all_synced, timeout)
+
+  def _listen(self, index: int) -> None:
+    with self._condition:
+      self._generations[index] += 1
+      generation = self._generations[index]
+
+    def _on_snapshot(docs: List[firestore.DocumentSnapshot],
+                     changes: List[Any], read_time: Any) -> None:
+      self._on_snapshot(index, generation, docs, changes)
+
+    try:
+      self._watches[index] = self._targets[index].on_snapshot(_on_snapshot)
+    except Exception as e:
+      logging.warning('Listening to Firestore failed: %s', e)
+      self._watches[index] = None
+
+  def _on_snapshot(self, index: int, generation: int,
+                   docs: List[firestore.DocumentSnapshot],
+                   changes: List[Any]) -> None:
+    with self._condition:
+      if self._stats.overflowed or self._stopping.is_set() or \
+              generation != self._generations[index]:
+        return                          # a listener since replaced, or done
+
+      if self._synced[index]:
+        for change in changes:
+          if change.type == ChangeType.REMOVED:
+            self._documents.pop(change.document.id, None)
+          elif not self._add(change.document.id, change.document.to_dict()):
+            return
+      elif self._chunks[index] is None:
+        if len(docs) > self._max_documents:
+          self._overflow()
+          return
+        self._documents = {doc.id: doc.to_dict() for doc in docs}
+      else:
+        for id in self._chunks[index]:
+          self._documents.pop(id, None)
+        for doc in docs:
+          if not self._add(doc.id, doc.to_dict()):
+            return
+
+      self._stats.changes += len(changes)
+      self._synced[index] = True
+      self._condition.notify_all()
+
+  def _add(self, id: str, document: Dict[str, Any]) -> bool:
+    """Adds or replaces a document, overflowing instead if that would take
+    the copy past `max_documents`. Call with the lock held.
+
+    Returns:
+        bool: False if the mirror overflowed
+    """
+    if id not in self._documents and \
+            len(self._documents) >= self._max_documents:
+      self._overflow()
+      return False
+    self._documents[id] = document
+    return True
+
+  def _overflow(self) -> None:
+    """Stops mirroring. Call with the lock held."""
+    logging.warning('The Firestore collection has more than %d documents; '
+                    'no longer mirroring it.', self._max_documents)
+    self._stats.overflowed = True
+    self._documents.clear()
+    self._synced = [False] * len(self._targets)
+    self._condition.notify_all()
+    # A listener cannot be closed from its own callback's thread.
+    threading.Thread(target=self._close_watches, daemon=True).start()
+
+  def _close_watches(self) -> None:
+    for watch in self._watches:
+      if watch is not None:
+        try:
+          watch.close()
+        except Exception as e:
+          logging.debug('Closing a Firestore listener failed: %s', e)
+
+  def _run(self) -> None:
+    while not self._stopping.wait(self._check_interval):
+      self._check()
+
+  def _check(self) -> None:
+    """Replaces any listener that has stopped."""
+    for index, watch in enumerate(self._watches):
+      if self._stopping.is_set() or self._stats.overflowed:
+        return
+      if watch is not None and watch.is_active:
+        continue
+
+      logging.warning('A Firestore listener stopped; reconnecting.')
+      with self._condition:
+        self._synced[index] = False
+        self._stats.reconnects += 1
+      if watch is not None:
+        try:
+          watch.close()
+        except Exception as e:
+          logging.debug('Closing a Firestore listener failed: %s', e)
+      self._listen(index)
+
+  def _synced_for(self, id: str) -> bool:
+    """Whether the mirror can answer for `id`. Call with the lock held."""
+    if self._stats.overflowed:
+      return False
+    if self._chunk_of is None:
+      return self._synced[0]
+    index = self._chunk_of.get(id)
+    return index is not None and self._synced[index]
+
+  def lookup(self, id: str, keys: Optional[Iterable[str]] = None
+             ) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Reads a document from the mirror.
+
+    Args:
+        id (str): the document id
+        keys (Iterable[str], optional): return only these fields
+
+    Returns:
+        Tuple[bool, Optional[Dict[str, Any]]]: whether the mirror could
+            answer, and a copy of the document (None if there is none)
+    """
+    with self._condition:
+      if not self._synced_for(id):
+        self._stats.misses += 1
+        return False, None
+
+      self._stats.hits += 1
+      document = self._documents.get(id)
+      if document is not None and keys is not None:
+        document = {key: document[key] for key in keys if key in document}
+      return True, copy.deepcopy(document)
+
+  # This process's own writes are applied to the mirror as well as pushed to
+  # the listener, so its next read sees them without waiting for the push.
+  def put(self, id: str, document: Mapping[str, Any]) -> None:
+    """Applies a `set` of a whole document."""
+    with self._condition:
+      if self._synced_for(id):
+        self._add(id, copy.deepcopy(dict(document)))
+
+  def merge(self, id: str, data: Mapping[str, Any], deep: bool = True) -> None:
+    """Applies a `set(merge=True)`, or with `deep` unset an `update`.
+
+    An `update` replaces the top-level fields given, where a merge also
+    merges the maps within them.
+    """
+    with self._condition:
+      if not self._synced_for(id):
+        return
+      if id not in self._documents:
+        self._add(id, copy.deepcopy(dict(data)))
+      elif deep:
+        _merge(self._documents[id], data)
+      else:
+        _update(self._documents[id], data)
+
+  def remove(self, id: str, key: Optional[str] = None) -> None:
+    """Applies the delete of a document, or of one field (path) of it."""
+    with self._condition:
+      if not self._synced_for(id):
+        return
+      if key is None:
+        self._documents.pop(id, None)
+      elif id in self._documents:
+        *parents, field = parse_field_path(key)
+        target = self._documents[id]
+        for parent in parents:
+          if not isinstance(target := target.get(parent), dict):
+            return
+        target.pop(field, None)
 
 
 class Firestore(AbstractDatastore):
@@ -30,23 +388,135 @@ class Firestore(AbstractDatastore):
   def __init__(self, email: str=None, project: str=None) -> AbstractDatastore:
     self._project = project
     self._email = email
+    self._mirror: Optional[_Mirror] = None
+
+  def watch(self, ids: Optional[Iterable[str]] = None,
+            max_documents: int = MAX_MIRRORED,
+            check_interval: float = 10.0,
+            timeout: Optional[float] = 0) -> bool:
+    """Mirrors the collection, or the given documents, in memory.
+
+    Reads of mirrored documents (`get_document`, `get_documents` and
+    `stream_documents`) are then answered from memory with no RPC, while
+    changes made by other processes arrive through an `on_snapshot` listener
+    within seconds. Reads fall back to RPCs for documents not mirrored, and
+    while a listener is waiting for its first snapshot after (re)connecting.
+
+    Mirroring the whole collection costs memory (twice, as the client library
+    keeps a copy too) for every document in it, so it stops, and every read
+    goes back to an RPC, if the collection grows past `max_documents`.
+    Mirroring chosen ids holds only those, but takes one listener per
+    `MAX_IN_FILTER` ids.
+
+    Calling `watch` again replaces the mirror; `unwatch` stops it.
+
+    Args:
+        ids (Iterable[str], optional): the ids to mirror, or None for all
+        max_documents (int): the most documents to hold
+        check_interval (float): how often, in seconds, to check for stopped
+                                listeners and replace them
+        timeout (float, optional): how long to wait for the first snapshots;
+                                   0 does not wait, None waits for ever
+
+    Returns:
+        bool: True if the mirror is in sync
 
-  def get_all_documents(self) -> List[firestore.DocumentReference]:
-    """Lists all documents
+    Raises:
+        ValueError: if more than `max_documents` ids are given
+    """
+    self.unwatch()
+    mirror = _Mirror(self.client, ids, max_documents, check_interval)
+    mirror.start()
+    self._mirror = mirror
+    return mirror.wait(timeout) if timeout != 0 else mirror.stats.synced
+
+  def unwatch(self) -> None:
+    """Stops mirroring; every read is an RPC again."""
+    if mirror := self._mirror:
+      self._mirror = None
+      mirror.stop()
+
+  @property
+  def mirror_stats(self) -> Optional[MirrorStats]:
+    """A snapshot of the mirror's metrics, or None if not watching."""
+    return self._mirror.stats if self._mirror else None
+
+  def _scan(self, page_size: int, start_after: Optional[str],
+            fields: Optional[List[str]] = None
+            ) -> Iterator[firestore.DocumentSnapshot]:
+    """Yields the collection's documents in id order, a page at a time.
 
-    Lists all documents.
+    Each page is one query of at most `page_size` documents, starting after
+    the last document of the page before, so only one page is held at once
+    however large the collection is.
+
+    Args:
+        page_size (int): the documents fetched by each query
+        start_after (str): the id to start after, or None for the first
+        fields (List[str]): fetch only these fields (a projection)
+
+    Yields:
+        DocumentSnapshot: each document
+    """
+    query = self.client.collection('auth').order_by(FieldPath.document_id())
+    if fields is not None:
+      query = query.select(fields)
+
+    cursor = self.client.document(f'auth/{start_after}') \
+        if start_after is not None else None
+    while True:
+      page = query.limit(page_size)
+      if cursor is not None:
+        page = page.start_after({FieldPath.document_id(): cursor})
+
+      count = 0
+      for snapshot in page.stream():
+        count += 1
+        cursor = snapshot.reference
+        yield snapshot
+
+      if count < page_size:
+        return
+
+  def get_all_documents(self, page_size: int = PAGE_SIZE,
+                        start_after: Optional[str] = None
+                        ) -> List[firestore.DocumentSnapshot]:
+    """Fetches all documents.
+
+    The collection is read a page at a time; use `stream_all_documents` to
+    process it without holding every document at once.
+
+    Args:
+        page_size (int): the documents fetched by each query
+        start_after (str, optional): resume after this document id
 
     Returns:
-        documents (List[DocumentReference]): list of all documents
+        List[DocumentSnapshot]: all the documents, in id order
     """
-    documents = self.client.collection(type.value).list_documents()
-    return documents
+    return list(self.stream_all_documents(page_size, start_after))
+
+  def stream_all_documents(self, page_size: int = PAGE_SIZE,
+                           start_after: Optional[str] = None
+                           ) -> Iterator[firestore.DocumentSnapshot]:
+    """Fetches all documents, lazily.
+
+    The collection is read in id order a page of `page_size` documents at a
+    time, so memory use does not grow with its size.
+
+    Args:
+        page_size (int): the documents fetched by each query
+        start_after (str, optional): resume after this document id
+
+    Yields:
+        DocumentSnapshot: each document
+    """
+    return self._scan(page_size, start_after)
 
   def get_document(self, id: str,
                    key: Optional[str]=None) -> Dict[str, Any]:
     """Loads a document
 
-    Load a document
+    Load a document. If a key is given, only that field is fetched.
 
     Arguments:
         id (str): document id
@@ -56,14 +526,65 @@ class Firestore(AbstractDatastore):
         Dict[str, Any]: stored configuration dictionary, or None
                           if not present
     """
-    document = None
+    if self._mirror:
+      found, document = self._mirror.lookup(id, [key] if key else None)
+      if found:
+        return document.get(key) if key and document else document
 
-    if report := self.client.document(f'auth/{id}'):
-
-      document = report.get().to_dict()
+    report = self.client.document(f'auth/{id}')
+    document = report.get(
+        field_paths=_field_paths([key]) if key else None).to_dict()
 
     return document.get(key) if key and document else document
 
+  def get_documents(self, ids: List[str],
+                    keys: Optional[List[str]] = None
+                    ) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents in one round trip.
+
+    Arguments:
+        ids (List[str]): the document ids
+        keys (List[str], optional): fetch only these fields of each document
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id
+    """
+    return dict(self.stream_documents(ids, keys))
+
+  def stream_documents(self, ids: Iterable[str],
+                       keys: Optional[List[str]] = None
+                       ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Fetches many documents in one round trip, as they arrive.
+
+    All the documents are requested with a single `get_all` call, and each
+    is yielded as soon as Firestore returns it (which is in no particular
+    order), so a caller can start on the first tokens before the last have
+    arrived. With `keys`, a field mask means only those fields are sent.
+    Mirrored documents (see `watch`) are yielded first, without an RPC.
+
+    Arguments:
+        ids (Iterable[str]): the document ids
+        keys (List[str], optional): fetch only these fields of each document
+
+    Yields:
+        Tuple[str, Dict[str, Any]]: (id, document) for each document found
+    """
+    if self._mirror:
+      missing = []
+      for id in ids:
+        found, document = self._mirror.lookup(id, keys)
+        if not found:
+          missing.append(id)
+        elif document is not None:
+          yield id, document
+      ids = missing
+
+    if references := [self.client.document(f'auth/{id}') for id in ids]:
+      for snapshot in self.client.get_all(references,
+                                          field_paths=_field_paths(keys)):
+        if snapshot.exists:
+          yield snapshot.id, snapshot.to_dict()
+
   def store_document(self,id: str,
                      document: Dict[str, Any]) -> None:
     """Stores a document.
@@ -78,6 +599,8 @@ class Firestore(AbstractDatastore):
     """
     report = self.client.document(f'auth/{id}')
     report.set(document)
+    if self._mirror:
+      self._mirror.put(id, document)
 
   def update_document(self, id: str,
                       new_data: Dict[str, Any]) -> None:
@@ -86,16 +609,207 @@ class Firestore(AbstractDatastore):
     Update a document in Firestore. If the document is not already there, it
     will be created as a net-new document. If it is, it will be updated.
 
+    This is a single `set(merge=True)` write, with no read first: the new
+    data is merged into the stored document (nested maps too) by Firestore,
+    so concurrent updates of different fields do not overwrite each other.
+    Use `create_or_update_document` to know which of the two happened.
+
     Args:
         id (str): the id of the document within the collection.
         new_data (Dict[str, Any]): the document content.
     """
-    if collection := self.client.collection(f'auth'):
-      if document_ref := collection.document(document_id=id):
-        if document_ref.get().exists:
-          document_ref.update(new_data)
-        else:
-          document_ref.create(new_data)
+    self.client.document(f'auth/{id}').set(new_data, merge=True)
+    if self._mirror:
+      self._mirror.merge(id, new_data)
+
+  def create_or_update_document(self, id: str,
+                                new_data: Dict[str, Any]) -> bool:
+    """Updates a document, or creates it, in a transaction.
+
+    The document is read and then updated (or created) in one transaction,
+    which Firestore retries if another writer changes the document between
+    the two. That costs the read `update_document` avoids, so use this only
+    when the caller needs to know whether the document already existed.
+
+    Args:
+        id (str): the id of the document within the collection.
+        new_data (Dict[str, Any]): the document content.
+
+    Returns:
+        bool: True if the document was created, False if it was updated
+    """
+    document_ref = self.client.document(f'auth/{id}')
+
+    @firestore.transactional
+    def _upsert(transaction: firestore.Transaction) -> bool:
+      if document_ref.get(transaction=transaction).exists:
+        transaction.update(document_ref, new_data)
+        return False
+      transaction.create(document_ref, new_data)
+      return True
+
+    created = _upsert(self.client.transaction())
+    if self._mirror:
+      self._mirror.merge(id, new_data, deep=False)
+    return created
+
+  def refresh_document(self, id: str,
+                       refresh: Callable[[], Dict[str, Any]],
+                       is_fresh: Callable[[Dict[str, Any]], bool],
+                       lease: float = 30.0,
+                       poll_interval: float = 0.25,
+                       timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Refreshes a document, if no other process already has.
+
+    A transaction reads the document and, unless `is_fresh` accepts it or
+    another process holds an unexpired lease on it, writes a lease of
+    `lease` seconds into its `LEASE_FIELD`. Only the holder calls `refresh`;
+    its new document is then written, and the lease removed, in one
+    `set(merge=True)`. The other processes re-read the document every
+    `poll_interval` seconds until it is fresh, and return it without
+    refreshing. If the holder dies its lease expires, and the next process to
+    look takes it over, so `lease` should comfortably exceed a refresh and
+    any clock skew between the processes.
+
+    If `refresh` fails, the lease is released and the error raised. A
+    process that has neither found the document fresh nor taken the lease
+    within `timeout` seconds gives up.
+
+    Arguments:
+        id (str): document id
+        refresh (Callable[[], Dict[str, Any]]): makes the new document
+        is_fresh (Callable[[Dict[str, Any]], bool]): whether a stored
+            document no longer needs refreshing
+        lease (float): how long, in seconds, a lease is held at most
+        poll_interval (float): how often, in seconds, to re-read a document
+                               another process is refreshing
+        timeout (float, optional): the most seconds to wait for another
+                                   process's refresh; 4 * `lease` by default
+
+    Returns:
+        Dict[str, Any]: the new document, or the fresh one found instead
+
+    Raises:
+        TimeoutError: if the document is still being refreshed elsewhere
+                      after `timeout` seconds
+    """
+    document_ref = self.client.document(f'auth/{id}')
+    owner = uuid.uuid4().hex
+
+    @firestore.transactional
+    def _acquire(transaction: firestore.Transaction
+                 ) -> Tuple[Optional[Dict[str, Any]], bool]:
+      """Returns a fresh document, or whether this process holds the lease."""
+      snapshot = document_ref.get(transaction=transaction)
+      if snapshot.exists:
+        document = snapshot.to_dict()
+        holder = document.pop(LEASE_FIELD, None)
+        if is_fresh(document):
+          return document, False
+        if holder and holder.get('expires', 0) > time.time():
+          return None, False
+
+      transaction.set(document_ref,
+                      {LEASE_FIELD: {'owner': owner,
+                                     'expires': time.time() + lease}},
+                      merge=True)
+      return None, True
+
+    @firestore.transactional
+    def _release(transaction: firestore.Transaction,
+                 data: Dict[str, Any]) -> None:
+      """Writes `data`, removing the lease if this process still holds it."""
+      snapshot = document_ref.get(transaction=transaction)
+      holder = (snapshot.to_dict() or {}).get(LEASE_FIELD) \
+          if snapshot.exists else None
+      if holder and holder.get('owner') == owner:
+        data = {**data, LEASE_FIELD: firestore.DELETE_FIELD}
+      if data:
+        transaction.set(document_ref, data, merge=True)
+
+    deadline = time.monotonic() + (4 * lease if timeout is None else timeout)
+    while True:
+      document, acquired = _acquire(self.client.transaction())
+      if document is not None:
+        return document
+      if acquired:
+        break
+      if time.monotonic() >= deadline:
+        raise TimeoutError(f'Document {id} is still being refreshed by '
+                           'another process.')
+      time.sleep(poll_interval)
+
+    try:
+      document = refresh()
+    except Exception:
+      _release(self.client.transaction(), {})
+      raise
+
+    _release(self.client.transaction(), document)
+    if self._mirror:
+      self._mirror.merge(id, document)
+    return document
+
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents in batches.
+
+    The documents are written in `WriteBatch` commits of up to
+    `MAX_BATCH_SIZE` documents. Each commit is atomic, so a failure affects
+    every document in that batch but none in the others.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that failed its batch
+    """
+    return self._write_batches(documents, merge=False)
+
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents in batches.
+
+    As `store_documents`, but the new data is merged into any existing
+    document, so no read is needed to tell an update from a create.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that failed its batch
+    """
+    return self._write_batches(documents, merge=True)
+
+  def _write_batches(self, documents: Mapping[str, Dict[str, Any]],
+                     merge: bool) -> Dict[str, Optional[Exception]]:
+    """Writes documents in chunks of `MAX_BATCH_SIZE`, one commit each."""
+    results = {}
+    ids = list(documents)
+    for start in range(0, len(ids), MAX_BATCH_SIZE):
+      chunk = ids[start:start + MAX_BATCH_SIZE]
+      batch = self.client.batch()
+      for id in chunk:
+        batch.set(self.client.document(f'auth/{id}'), documents[id],
+                  merge=merge)
+
+      try:
+        batch.commit()
+        error = None
+      except Exception as e:
+        error = e
+
+      results.update({id: error for id in chunk})
+      if self._mirror and error is None:
+        for id in chunk:
+          if merge:
+            self._mirror.merge(id, documents[id])
+          else:
+            self._mirror.put(id, documents[id])
+
+    return results
 
   def delete_document(self, id: str,
                       key: Optional[str]=None) -> None:
@@ -116,8 +830,11 @@ class Firestore(AbstractDatastore):
           document_ref.update({ key: firestore.DELETE_FIELD })
         else:
           document_ref.delete()
+        if self._mirror:
+          self._mirror.remove(id, key or None)
 
-  def list_documents(self, key: str=None) -> List[str]:
+  def list_documents(self, key: str=None, page_size: int = PAGE_SIZE,
+                     start_after: Optional[str] = None) -> List[str]:
     """Lists documents in a collection.
 
     List all the documents in the collection 'type'. If a key is give, list
@@ -127,20 +844,273 @@ class Firestore(AbstractDatastore):
     list_documents(Type.SA360_RPT, '_reports') will return
       { 'holiday_2020', 'sa360_hourly_depleted', ...}
 
+    The ids are read in id order a page at a time, without the documents'
+    contents; use `iter_documents` to process them without holding every id
+    at once. With a key, that one document is read directly.
+
     Args:
         key (str, optional): the sub-key. Defaults to None.
+        page_size (int): the ids fetched by each query
+        start_after (str, optional): list the ids after this one
 
     Returns:
         List[str]: the list
     """
-    documents = []
-    collection = self.client.collection('auth').list_documents()
-    for document in collection:
-      if key:
-        if document.id == key:
-          for _document in document.get().to_dict():
-            documents.append(_document)
-      else:
-        documents.append(document.id)
+    if key:
+      return list(self.get_document(key) or {})
+
+    return list(self.iter_documents(page_size, start_after))
+
+  def iter_documents(self, page_size: int = PAGE_SIZE,
+                     start_after: Optional[str] = None) -> Iterator[str]:
+    """Lists the document ids in the collection, lazily.
+
+    The ids are fetched in id order a page at a time, without the documents'
+    contents; pass the last id seen as `start_after` to resume a listing.
+
+    Args:
+        page_size (int): the ids fetched by each query
+        start_after (str, optional): list the ids after this one
+
+    Yields:
+        str: each document id
+    """
+    return (snapshot.id for snapshot in
+            self._scan(page_size, start_after,
+                       fields=[FieldPath.document_id()]))
+
+
+class AsyncFirestore(AsyncAbstractDatastore):
+  """The asyncio version of `Firestore`, using `firestore.AsyncClient`."""
+  @decorators.lazy_property
+  def client(self) -> firestore.AsyncClient:
+    """The datastore client."""
+    return firestore.AsyncClient()
+
+  def __init__(self, email: str = None,
+               project: str = None) -> AsyncAbstractDatastore:
+    self._project = project
+    self._email = email
+
+  async def _scan(self, page_size: int, start_after: Optional[str],
+                  fields: Optional[List[str]] = None
+                  ) -> AsyncIterator[firestore.DocumentSnapshot]:
+    """Yields the collection's documents in id order, a page at a time.
+
+    See `Firestore._scan`.
+    """
+    query = self.client.collection('auth').order_by(FieldPath.document_id())
+    if fields is not None:
+      query = query.select(fields)
 
-    return documents
+    cursor = self.client.document(f'auth/{start_after}') \
+        if start_after is not None else None
+    while True:
+      page = query.limit(page_size)
+      if cursor is not None:
+        page = page.start_after({FieldPath.document_id(): cursor})
+
+      count = 0
+      async for snapshot in page.stream():
+        count += 1
+        cursor = snapshot.reference
+        yield snapshot
+
+      if count < page_size:
+        return
+
+  async def get_all_documents(self, page_size: int = PAGE_SIZE,
+                              start_after: Optional[str] = None
+                              ) -> List[firestore.DocumentSnapshot]:
+    """Fetches all documents.
+
+    The collection is read a page at a time; use `stream_all_documents` to
+    process it without holding every document at once.
+
+    Returns:
+        List[DocumentSnapshot]: all the documents, in id order
+    """
+    return [snapshot async for snapshot in
+            self.stream_all_documents(page_size, start_after)]
+
+  def stream_all_documents(self, page_size: int = PAGE_SIZE,
+                           start_after: Optional[str] = None
+                           ) -> AsyncIterator[firestore.DocumentSnapshot]:
+    """Fetches all documents, lazily.
+
+    See `Firestore.stream_all_documents`.
+    """
+    return self._scan(page_size, start_after)
+
+  async def get_document(self, id: str,
+                         key: Optional[str] = None) -> Dict[str, Any]:
+    """Loads a document
+
+    See `Firestore.get_document`.
+    """
+    report = self.client.document(f'auth/{id}')
+    document = (await report.get(
+        field_paths=_field_paths([key]) if key else None)).to_dict()
+
+    return document.get(key) if key and document else document
+
+  async def get_documents(self, ids: List[str],
+                          keys: Optional[List[str]] = None
+                          ) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents in one round trip.
+
+    See `Firestore.get_documents`.
+    """
+    return {id: document
+            async for id, document in self.stream_documents(ids, keys)}
+
+  async def stream_documents(self, ids: Iterable[str],
+                             keys: Optional[List[str]] = None
+                             ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """Fetches many documents in one round trip, as they arrive.
+
+    See `Firestore.stream_documents`.
+    """
+    if references := [self.client.document(f'auth/{id}') for id in ids]:
+      async for snapshot in self.client.get_all(
+              references, field_paths=_field_paths(keys)):
+        if snapshot.exists:
+          yield snapshot.id, snapshot.to_dict()
+
+  async def store_document(self, id: str,
+                           document: Dict[str, Any]) -> None:
+    """Stores a document.
+
+    See `Firestore.store_document`.
+    """
+    await self.client.document(f'auth/{id}').set(document)
+
+  async def update_document(self, id: str,
+                            new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    See `Firestore.update_document`.
+    """
+    await self.client.document(f'auth/{id}').set(new_data, merge=True)
+
+  async def create_or_update_document(self, id: str,
+                                      new_data: Dict[str, Any]) -> bool:
+    """Updates a document, or creates it, in a transaction.
+
+    See `Firestore.create_or_update_document`.
+    """
+    document_ref = self.client.document(f'auth/{id}')
+
+    @firestore.async_transactional
+    async def _upsert(transaction: firestore.AsyncTransaction) -> bool:
+      if (await document_ref.get(transaction=transaction)).exists:
+        transaction.update(document_ref, new_data)
+        return False
+      transaction.create(document_ref, new_data)
+      return True
+
+    return await _upsert(self.client.transaction())
+
+  async def refresh_document(self, id: str,
+                             refresh: Callable[[], Awaitable[Dict[str, Any]]],
+                             is_fresh: Callable[[Dict[str, Any]], bool],
+                             lease: float = 30.0,
+                             poll_interval: float = 0.25,
+                             timeout: Optional[float] = None
+                             ) -> Dict[str, Any]:
+    """Refreshes a document, if no other process already has.
+
+    The lease is taken and released as in `Firestore.refresh_document`, so
+    sync and async processes coordinate with each other; `refresh` is a
+    coroutine function.
+
+    Raises:
+        TimeoutError: if the document is still being refreshed elsewhere
+                      after `timeout` seconds
+    """
+    document_ref = self.client.document(f'auth/{id}')
+    owner = uuid.uuid4().hex
+
+    @firestore.async_transactional
+    async def _acquire(transaction: firestore.AsyncTransaction
+                       ) -> Tuple[Optional[Dict[str, Any]], bool]:
+      snapshot = await document_ref.get(transaction=transaction)
+      if snapshot.exists:
+        document = snapshot.to_dict()
+        holder = document.pop(LEASE_FIELD, None)
+        if is_fresh(document):
+          return document, False
+        if holder and holder.get('expires', 0) > time.time():
+          return None, False
+
+      transaction.set(document_ref,
+                      {LEASE_FIELD: {'owner': owner,
+                                     'expires': time.time() + lease}},
+                      merge=True)
+      return None, True
+
+    @firestore.async_transactional
+    async def _release(transaction: firestore.AsyncTransaction,
+                       data: Dict[str, Any]) -> None:
+      snapshot = await document_ref.get(transaction=transaction)
+      holder = (snapshot.to_dict() or {}).get(LEASE_FIELD) \
+          if snapshot.exists else None
+      if holder and holder.get('owner') == owner:
+        data = {**data, LEASE_FIELD: firestore.DELETE_FIELD}
+      if data:
+        transaction.set(document_ref, data, merge=True)
+
+    deadline = time.monotonic() + (4 * lease if timeout is None else timeout)
+    while True:
+      document, acquired = await _acquire(self.client.transaction())
+      if document is not None:
+        return document
+      if acquired:
+        break
+      if time.monotonic() >= deadline:
+        raise TimeoutError(f'Document {id} is still being refreshed by '
+                           'another process.')
+      await asyncio.sleep(poll_interval)
+
+    try:
+      document = await refresh()
+    except Exception:
+      await _release(self.client.transaction(), {})
+      raise
+
+    await _release(self.client.transaction(), document)
+    return document
+
+  async def delete_document(self, id: str,
+                            key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    See `Firestore.delete_document`.
+    """
+    document_ref = self.client.collection('auth').document(document_id=id)
+    if key:
+      await document_ref.update({key: firestore.DELETE_FIELD})
+    else:
+      await document_ref.delete()
+
+  async def list_documents(self, key: str = None, page_size: int = PAGE_SIZE,
+                           start_after: Optional[str] = None) -> List[str]:
+    """Lists documents in a collection.
+
+    See `Firestore.list_documents`.
+    """
+    if key:
+      return list(await self.get_document(key) or {})
+
+    return [id async for id in self.iter_documents(page_size, start_after)]
+
+  async def iter_documents(self, page_size: int = PAGE_SIZE,
+                           start_after: Optional[str] = None
+                           ) -> AsyncIterator[str]:
+    """Lists the document ids in the collection, lazily.
+
+    See `Firestore.iter_documents`.
+    """
+    async for snapshot in self._scan(page_size, start_after,
+                                     fields=[FieldPath.document_id()]):
+      yield snapshot.id
@@ -0,0 +1,810 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import copy
+import itertools
+import os
+import time
+import unittest
+import uuid
+from concurrent import futures
+from typing import Any, Dict, List
+from unittest import mock
+
+from auth.datastore import firestore
+from google.cloud.firestore_v1.watch import ChangeType
+
+# Tests that need a real Firestore only run against the emulator, eg:
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=test pytest
+EMULATOR = os.environ.get('FIRESTORE_EMULATOR_HOST')
+
+
+def _snapshot(data):
+  snapshot = mock.MagicMock()
+  snapshot.exists = data is not None
+  snapshot.to_dict.return_value = data
+  return snapshot
+
+
+class _FakeQuery(object):
+  """An id-ordered query over the 'auth' collection, holding `ids`.
+
+  Every query `stream()`ed is recorded in `streamed` as (limit, after).
+  """
+
+  def __init__(self, ids: List[str], asynchronous: bool = False):
+    self.ids = sorted(ids)
+    self.asynchronous = asynchronous
+    self.streamed = []
+    self.fields = None
+    self._limit = None
+    self._after = None
+
+  def _copy(self, **changes) -> '_FakeQuery':
+    query = copy.copy(self)
+    query.__dict__.update(changes)
+    return query
+
+  def order_by(self, field: str) -> '_FakeQuery':
+    return self
+
+  def select(self, fields: List[str]) -> '_FakeQuery':
+    self.fields = fields
+    return self
+
+  def limit(self, limit: int) -> '_FakeQuery':
+    return self._copy(_limit=limit)
+
+  def start_after(self, fields: Dict[str, Any]) -> '_FakeQuery':
+    return self._copy(_after=fields['__name__'].id)
+
+  def _page(self) -> List[mock.MagicMock]:
+    self.streamed.append((self._limit, self._after))
+    ids = [id for id in self.ids if self._after is None or id > self._after]
+    snapshots = []
+    for id in ids[:self._limit]:
+      snapshot = _snapshot({'token': id})
+      snapshot.id = id
+      snapshot.reference.id = id
+      snapshots.append(snapshot)
+    return snapshots
+
+  def stream(self) -> Any:
+    if not self.asynchronous:
+      return iter(self._page())
+
+    async def _stream():
+      for snapshot in self._page():
+        yield snapshot
+    return _stream()
+
+
+def _reference(path: str) -> mock.MagicMock:
+  reference = mock.MagicMock()
+  reference.id = path.split('/')[1]
+  return reference
+
+
+class FirestoreTest(unittest.TestCase):
+  def setUp(self):
+    self.client = mock.patch('google.cloud.firestore.Client').start()
+
+  def tearDown(self):
+    mock.patch.stopall()
+
+  def test_get_documents(self):
+    found = _snapshot({'token': 'token'})
+    found.id = 'westley'
+    missing = _snapshot(None)
+    missing.id = 'vizzini'
+    self.client.return_value.get_all.return_value = iter([found, missing])
+
+    datastore = firestore.Firestore()
+    self.assertEqual({'westley': {'token': 'token'}},
+                     datastore.get_documents(['westley', 'vizzini']))
+    self.client.return_value.get_all.assert_called_once()
+
+  def test_get_document_key_field_mask(self):
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot({'refresh.token': 'token'})
+
+    self.assertEqual('token', firestore.Firestore().get_document(
+        'westley', 'refresh.token'))
+    ref.get.assert_called_once_with(field_paths=['`refresh.token`'])
+
+  def test_get_document_without_key(self):
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot({'token': 'token'})
+
+    self.assertEqual({'token': 'token'},
+                     firestore.Firestore().get_document('westley'))
+    ref.get.assert_called_once_with(field_paths=None)
+
+  def test_get_documents_field_mask(self):
+    self.client.return_value.get_all.return_value = iter([])
+
+    firestore.Firestore().get_documents(['westley', 'buttercup'],
+                                        keys=['access_token', '_key'])
+    self.assertEqual(['access_token', '_key'],
+                     self.client.return_value.get_all.call_args.kwargs[
+                         'field_paths'])
+
+  def test_stream_documents(self):
+    def _snapshots():
+      for id in ['buttercup', 'westley']:
+        snapshot = _snapshot({'token': id})
+        snapshot.id = id
+        yield snapshot
+    self.client.return_value.get_all.return_value = _snapshots()
+
+    stream = firestore.Firestore().stream_documents(['westley', 'buttercup'])
+    self.assertEqual(('buttercup', {'token': 'buttercup'}), next(stream))
+    self.assertEqual(('westley', {'token': 'westley'}), next(stream))
+    self.client.return_value.get_all.assert_called_once()
+
+  def test_list_documents_paginated(self):
+    query = _FakeQuery([f'user{i:02}' for i in range(25)])
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+
+    self.assertEqual([f'user{i:02}' for i in range(25)],
+                     firestore.Firestore().list_documents(page_size=10))
+    self.assertEqual([(10, None), (10, 'user09'), (10, 'user19')],
+                     query.streamed)
+
+  def test_iter_documents_paginated(self):
+    query = _FakeQuery([f'user{i:02}' for i in range(25)])
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+
+    ids = firestore.Firestore().iter_documents(page_size=10)
+    self.assertEqual([], query.streamed)      # nothing is read until needed
+    self.assertEqual([f'user{i:02}' for i in range(25)], list(ids))
+    self.assertEqual([(10, None), (10, 'user09'), (10, 'user19')],
+                     query.streamed)
+    self.assertEqual(['__name__'], query.fields)
+
+  def test_list_documents_start_after(self):
+    query = _FakeQuery(['buttercup', 'fezzik', 'inigo', 'westley'])
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+    self.client.return_value.document.side_effect = _reference
+
+    self.assertEqual(['inigo', 'westley'],
+                     firestore.Firestore().list_documents(
+                         start_after='fezzik'))
+
+  def test_list_documents_key(self):
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot({'access_token': 'a', '_key': 'k'})
+
+    self.assertEqual(['access_token', '_key'],
+                     firestore.Firestore().list_documents('westley'))
+    self.client.return_value.collection.assert_not_called()
+
+  def test_get_all_documents(self):
+    query = _FakeQuery(['westley', 'buttercup', 'inigo'])
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+
+    snapshots = firestore.Firestore().get_all_documents(page_size=2)
+    self.assertEqual(['buttercup', 'inigo', 'westley'],
+                     [snapshot.id for snapshot in snapshots])
+    self.assertEqual({'token': 'buttercup'}, snapshots[0].to_dict())
+    self.assertIsNone(query.fields)
+
+  def test_stream_all_documents(self):
+    query = _FakeQuery(['westley', 'buttercup', 'inigo'])
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+
+    snapshots = firestore.Firestore().stream_all_documents(page_size=2)
+    self.assertEqual([], query.streamed)
+    self.assertEqual({'token': 'buttercup'}, next(snapshots).to_dict())
+    self.assertEqual([(2, None)], query.streamed)
+    self.assertEqual(['inigo', 'westley'],
+                     [snapshot.id for snapshot in snapshots])
+
+  def test_get_documents_none(self):
+    self.assertEqual({}, firestore.Firestore().get_documents([]))
+    self.client.return_value.get_all.assert_not_called()
+
+
+  def test_store_documents_chunked(self):
+    batches = []
+
+    def _batch():
+      batches.append(mock.MagicMock())
+      return batches[-1]
+
+    self.client.return_value.batch.side_effect = _batch
+    documents = {f'user{i}': {'token': i} for i in range(1200)}
+
+    results = firestore.Firestore().store_documents(documents)
+
+    self.assertEqual(3, len(batches))
+    self.assertEqual([500, 500, 200],
+                     [b.set.call_count for b in batches])
+    self.assertTrue(all(b.commit.called for b in batches))
+    self.assertEqual(1200, len(results))
+    self.assertTrue(all(error is None for error in results.values()))
+
+  def test_update_documents_partial_failure(self):
+    batches = []
+
+    def _batch():
+      batches.append(mock.MagicMock())
+      if len(batches) == 2:
+        batches[-1].commit.side_effect = RuntimeError('inconceivable')
+      return batches[-1]
+
+    self.client.return_value.batch.side_effect = _batch
+    documents = {f'user{i}': {'token': i} for i in range(600)}
+
+    results = firestore.Firestore().update_documents(documents)
+
+    self.assertIsNone(results['user0'])
+    self.assertIsInstance(results['user599'], RuntimeError)
+    self.assertEqual(100, sum(1 for e in results.values() if e))
+    self.assertTrue(batches[0].set.call_args.kwargs['merge'])
+
+  def test_update_document_single_write(self):
+    document = self.client.return_value.document
+
+    firestore.Firestore().update_document('westley', {'token': 'new'})
+
+    document.assert_called_once_with('auth/westley')
+    document.return_value.set.assert_called_once_with({'token': 'new'},
+                                                      merge=True)
+    document.return_value.get.assert_not_called()
+
+  @mock.patch('google.cloud.firestore.transactional', lambda f: f)
+  def test_create_or_update_document(self):
+    ref = self.client.return_value.document.return_value
+    transaction = self.client.return_value.transaction.return_value
+    datastore = firestore.Firestore()
+
+    ref.get.return_value = _snapshot(None)
+    self.assertTrue(datastore.create_or_update_document('westley', {'t': 1}))
+    transaction.create.assert_called_once_with(ref, {'t': 1})
+    ref.get.assert_called_with(transaction=transaction)
+
+    ref.get.return_value = _snapshot({'t': 1})
+    self.assertFalse(datastore.create_or_update_document('westley', {'t': 2}))
+    transaction.update.assert_called_once_with(ref, {'t': 2})
+
+
+  @mock.patch('google.cloud.firestore.transactional', lambda f: f)
+  def test_refresh_document_takes_lease(self):
+    ref = self.client.return_value.document.return_value
+    transaction = self.client.return_value.transaction.return_value
+    ref.get.side_effect = lambda transaction: _snapshot(
+        transaction.set.call_args[0][1] if transaction.set.called
+        else {'token': 'stale'})
+
+    document = firestore.Firestore().refresh_document(
+        'westley', lambda: {'token': 'fresh'},
+        lambda document: document['token'] == 'fresh')
+
+    self.assertEqual({'token': 'fresh'}, document)
+    (_, lease), _ = transaction.set.call_args_list[0]
+    (_, written), _ = transaction.set.call_args_list[1]
+    self.assertIn(firestore.LEASE_FIELD, lease)
+    self.assertEqual({'token': 'fresh',
+                      firestore.LEASE_FIELD: firestore.firestore.DELETE_FIELD},
+                     written)
+
+  @mock.patch('google.cloud.firestore.transactional', lambda f: f)
+  def test_refresh_document_waits_for_holder(self):
+    ref = self.client.return_value.document.return_value
+    transaction = self.client.return_value.transaction.return_value
+    held = {'token': 'stale',
+            firestore.LEASE_FIELD: {'owner': 'inigo',
+                                    'expires': time.time() + 60}}
+    ref.get.side_effect = [_snapshot(copy.deepcopy(held)),
+                           _snapshot(copy.deepcopy(held)),
+                           _snapshot({'token': 'fresh'})]
+    refresh = mock.Mock()
+
+    document = firestore.Firestore().refresh_document(
+        'westley', refresh, lambda document: document['token'] == 'fresh',
+        poll_interval=0)
+
+    self.assertEqual({'token': 'fresh'}, document)
+    refresh.assert_not_called()
+    transaction.set.assert_not_called()
+
+  @mock.patch('google.cloud.firestore.transactional', lambda f: f)
+  def test_refresh_document_times_out(self):
+    ref = self.client.return_value.document.return_value
+    transaction = self.client.return_value.transaction.return_value
+    ref.get.side_effect = lambda transaction: _snapshot(
+        {'token': 'stale',
+         firestore.LEASE_FIELD: {'owner': 'inigo',
+                                 'expires': time.time() + 60}})
+    refresh = mock.Mock()
+
+    with mock.patch('time.sleep') as sleep:
+      with self.assertRaises(TimeoutError):
+        firestore.Firestore().refresh_document(
+            'westley', refresh, lambda document: False, timeout=0)
+
+    sleep.assert_not_called()
+    refresh.assert_not_called()
+    transaction.set.assert_not_called()
+
+  @mock.patch('google.cloud.firestore.transactional', lambda f: f)
+  def test_refresh_document_takes_expired_lease(self):
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot(
+        {'token': 'stale',
+         firestore.LEASE_FIELD: {'owner': 'inigo', 'expires': 0}})
+
+    self.assertEqual({'token': 'fresh'}, firestore.Firestore().refresh_document(
+        'westley', lambda: {'token': 'fresh'}, lambda document: False))
+
+  @mock.patch('google.cloud.firestore.transactional', lambda f: f)
+  def test_refresh_document_failure_releases(self):
+    ref = self.client.return_value.document.return_value
+    transaction = self.client.return_value.transaction.return_value
+    ref.get.side_effect = lambda transaction: _snapshot(
+        copy.deepcopy(transaction.set.call_args[0][1])
+        if transaction.set.called else {'token': 'stale'})
+
+    def _refresh():
+      raise RuntimeError('token endpoint unavailable')
+
+    with self.assertRaises(RuntimeError):
+      firestore.Firestore().refresh_document('westley', _refresh,
+                                             lambda document: False)
+
+    (_, released), _ = transaction.set.call_args
+    self.assertEqual({firestore.LEASE_FIELD: firestore.firestore.DELETE_FIELD},
+                     released)
+
+
+def _document(id: str, data: Dict[str, Any]) -> mock.MagicMock:
+  document = _snapshot(data)
+  document.id = id
+  return document
+
+
+def _change(type: ChangeType, id: str,
+            data: Dict[str, Any] = None) -> mock.MagicMock:
+  change = mock.MagicMock()
+  change.type = type
+  change.document = _document(id, data)
+  return change
+
+
+class FirestoreMirrorTest(unittest.TestCase):
+  def setUp(self):
+    self.client = mock.patch('google.cloud.firestore.Client').start()
+    self.collection = self.client.return_value.collection.return_value
+    self.listeners = []
+    self.watches = []
+
+    def _on_snapshot(callback):
+      watch = mock.MagicMock()
+      watch.is_active = True
+      self.listeners.append(callback)
+      self.watches.append(watch)
+      return watch
+
+    self.collection.on_snapshot.side_effect = _on_snapshot
+    self.collection.where.return_value.on_snapshot.side_effect = _on_snapshot
+    self.datastore = firestore.Firestore()
+
+  def tearDown(self):
+    self.datastore.unwatch()
+    mock.patch.stopall()
+
+  def _watch(self, **kwargs):
+    self.datastore.watch(check_interval=3600, **kwargs)
+    self.listeners[-1]([_document('westley', {'token': 'w', 'scope': 's'}),
+                        _document('buttercup', {'token': 'b'})],
+                       [], None)
+
+  def test_reads_without_rpc(self):
+    self._watch()
+
+    self.assertEqual({'token': 'w', 'scope': 's'},
+                     self.datastore.get_document('westley'))
+    self.assertEqual('b', self.datastore.get_document('buttercup', 'token'))
+    self.assertIsNone(self.datastore.get_document('vizzini'))
+    self.assertEqual({'westley': {'token': 'w'}},
+                     self.datastore.get_documents(['westley', 'vizzini'],
+                                                  keys=['token']))
+    self.client.return_value.document.return_value.get.assert_not_called()
+    self.client.return_value.get_all.assert_not_called()
+    self.assertEqual(5, self.datastore.mirror_stats.hits)
+    self.assertEqual(0, self.datastore.mirror_stats.misses)
+
+  def test_changes_applied(self):
+    self._watch()
+    self.listeners[-1]([], [_change(ChangeType.MODIFIED, 'westley',
+                                    {'token': 'new'}),
+                            _change(ChangeType.ADDED, 'inigo', {'token': 'i'}),
+                            _change(ChangeType.REMOVED, 'buttercup')], None)
+
+    self.assertEqual({'token': 'new'}, self.datastore.get_document('westley'))
+    self.assertEqual({'token': 'i'}, self.datastore.get_document('inigo'))
+    self.assertIsNone(self.datastore.get_document('buttercup'))
+    self.assertEqual(3, self.datastore.mirror_stats.changes)
+
+  def test_copies_returned(self):
+    self._watch()
+    self.datastore.get_document('westley')['token'] = 'changed'
+
+    self.assertEqual('w', self.datastore.get_document('westley', 'token'))
+
+  def test_rpc_until_synced(self):
+    self.datastore.watch(check_interval=3600)
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot({'token': 'rpc'})
+
+    self.assertFalse(self.datastore.mirror_stats.synced)
+    self.assertEqual({'token': 'rpc'}, self.datastore.get_document('westley'))
+    ref.get.assert_called_once()
+
+  def test_own_writes_applied(self):
+    self._watch()
+    self.datastore.update_document('westley', {'token': 'new'})
+    self.datastore.store_document('fezzik', {'token': 'f'})
+    self.datastore.delete_document('buttercup')
+
+    self.assertEqual({'token': 'new', 'scope': 's'},
+                     self.datastore.get_document('westley'))
+    self.assertEqual({'token': 'f'}, self.datastore.get_document('fezzik'))
+    self.assertIsNone(self.datastore.get_document('buttercup'))
+
+  @mock.patch('google.cloud.firestore.transactional', lambda f: f)
+  def test_own_update_field_paths(self):
+    self._watch()
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot({'token': 'w'})
+
+    self.datastore.create_or_update_document(
+        'westley', {'refresh.token': 'r', 'refresh.expiry': 1,
+                    '`a.b`': 'quoted', 'scope': {'s': 1}})
+    self.assertEqual({'token': 'w', 'scope': {'s': 1}, 'a.b': 'quoted',
+                      'refresh': {'token': 'r', 'expiry': 1}},
+                     self.datastore.get_document('westley'))
+
+    self.datastore.create_or_update_document('westley', {'scope.s': 2})
+    self.assertEqual({'s': 2}, self.datastore.get_document('westley', 'scope'))
+
+    self.datastore.delete_document('westley', 'refresh.token')
+    self.assertEqual({'expiry': 1},
+                     self.datastore.get_document('westley', 'refresh'))
+
+  def test_reconnects(self):
+    self._watch()
+    self.watches[0].is_active = False
+    self.datastore._mirror._check()
+
+    self.assertEqual(2, len(self.listeners))
+    self.watches[0].close.assert_called_once()
+    self.assertFalse(self.datastore.mirror_stats.synced)
+
+    # A late push from the stopped listener is ignored.
+    self.listeners[0]([], [_change(ChangeType.ADDED, 'vizzini', {})], None)
+    self.assertFalse(self.datastore.mirror_stats.synced)
+
+    # The new listener's first snapshot resyncs the whole mirror.
+    self.listeners[1]([_document('westley', {'token': 'w2'})], [], None)
+    self.assertEqual({'token': 'w2'}, self.datastore.get_document('westley'))
+    self.assertIsNone(self.datastore.get_document('buttercup'))
+    self.assertEqual(1, self.datastore.mirror_stats.reconnects)
+
+  def test_overflow(self):
+    self._watch(max_documents=2)
+    self.listeners[-1]([], [_change(ChangeType.ADDED, 'inigo', {})], None)
+
+    stats = self.datastore.mirror_stats
+    self.assertTrue(stats.overflowed)
+    self.assertEqual(0, stats.documents)
+
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot({'token': 'rpc'})
+    self.assertEqual({'token': 'rpc'}, self.datastore.get_document('westley'))
+
+  def test_overflow_on_first_snapshot(self):
+    self.datastore.watch(check_interval=3600, max_documents=1)
+    westley = _document('westley', {'token': 'w'})
+    buttercup = _document('buttercup', {'token': 'b'})
+    self.listeners[-1]([westley, buttercup], [], None)
+
+    stats = self.datastore.mirror_stats
+    self.assertTrue(stats.overflowed)
+    self.assertEqual(0, stats.documents)
+    westley.to_dict.assert_not_called()       # nothing was copied
+    buttercup.to_dict.assert_not_called()
+
+  def test_overflow_stops_applying_changes(self):
+    self._watch(max_documents=3)
+    inigo = _change(ChangeType.ADDED, 'inigo', {})
+    fezzik = _change(ChangeType.ADDED, 'fezzik', {})
+    vizzini = _change(ChangeType.ADDED, 'vizzini', {})
+    self.listeners[-1]([], [inigo, fezzik, vizzini], None)
+
+    self.assertTrue(self.datastore.mirror_stats.overflowed)
+    vizzini.document.to_dict.assert_not_called()
+
+  def test_overflow_on_own_write(self):
+    self._watch(max_documents=2)
+    self.datastore.store_document('fezzik', {'token': 'f'})
+
+    self.assertTrue(self.datastore.mirror_stats.overflowed)
+
+  def test_chosen_ids(self):
+    ids = [f'guard{i:02}' for i in range(firestore.MAX_IN_FILTER + 1)]
+    self.datastore.watch(ids=ids, check_interval=3600)
+
+    self.assertEqual(2, len(self.listeners))
+    self.listeners[0]([_document('guard00', {'token': 'g'})], [], None)
+
+    ref = self.client.return_value.document.return_value
+    ref.get.return_value = _snapshot({'token': 'rpc'})
+    self.assertEqual({'token': 'g'}, self.datastore.get_document('guard00'))
+    self.assertIsNone(self.datastore.get_document('guard01'))
+    # Not yet synced, and not mirrored at all.
+    self.assertEqual({'token': 'rpc'}, self.datastore.get_document(ids[-1]))
+    self.assertEqual({'token': 'rpc'}, self.datastore.get_document('westley'))
+    self.assertEqual(2, ref.get.call_count)
+
+  def test_too_many_ids(self):
+    with self.assertRaises(ValueError):
+      self.datastore.watch(ids=['westley', 'buttercup'], max_documents=1)
+
+  def test_unwatch(self):
+    self._watch()
+    self.datastore.unwatch()
+
+    self.watches[0].close.assert_called_once()
+    self.assertIsNone(self.datastore.mirror_stats)
+
+
+class AsyncFirestoreTest(unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    self.client = mock.patch('google.cloud.firestore.AsyncClient').start()
+    self.document = self.client.return_value.collection.return_value.document
+    self.document.return_value.get = mock.AsyncMock()
+    self.document.return_value.update = mock.AsyncMock()
+    self.document.return_value.create = mock.AsyncMock()
+    self.document.return_value.delete = mock.AsyncMock()
+
+  def tearDown(self):
+    mock.patch.stopall()
+
+  async def test_get_document(self):
+    ref = self.client.return_value.document.return_value
+    ref.get = mock.AsyncMock(return_value=_snapshot({'token': 'token'}))
+
+    datastore = firestore.AsyncFirestore()
+    self.assertEqual({'token': 'token'}, await datastore.get_document('id'))
+    self.assertEqual('token', await datastore.get_document('id', 'token'))
+    self.client.return_value.document.assert_called_with('auth/id')
+
+  async def test_get_documents(self):
+    async def _snapshots(references, field_paths=None):
+      for reference in references:
+        snapshot = _snapshot({'token': 'token'})
+        snapshot.id = reference.split('/')[1]
+        yield snapshot
+    self.client.return_value.document.side_effect = lambda path: path
+    self.client.return_value.get_all = _snapshots
+
+    self.assertEqual({'westley': {'token': 'token'}},
+                     await firestore.AsyncFirestore().get_documents(
+                         ['westley'], keys=['token']))
+
+  async def test_update_document(self):
+    ref = self.client.return_value.document.return_value
+    ref.set = mock.AsyncMock()
+    ref.get = mock.AsyncMock()
+
+    await firestore.AsyncFirestore().update_document('id', {'token': 'new'})
+    ref.set.assert_awaited_once_with({'token': 'new'}, merge=True)
+    ref.get.assert_not_awaited()
+
+  @mock.patch('google.cloud.firestore.async_transactional', lambda f: f)
+  async def test_create_or_update_document(self):
+    ref = self.client.return_value.document.return_value
+    ref.get = mock.AsyncMock(return_value=_snapshot(None))
+    transaction = self.client.return_value.transaction.return_value
+
+    self.assertTrue(await firestore.AsyncFirestore().create_or_update_document(
+        'id', {'token': 'new'}))
+    transaction.create.assert_called_once_with(ref, {'token': 'new'})
+
+  @mock.patch('google.cloud.firestore.async_transactional', lambda f: f)
+  async def test_refresh_document_takes_lease(self):
+    ref = self.client.return_value.document.return_value
+    transaction = self.client.return_value.transaction.return_value
+    ref.get = mock.AsyncMock(side_effect=lambda transaction: _snapshot(
+        transaction.set.call_args[0][1] if transaction.set.called
+        else {'token': 'stale'}))
+
+    async def _refresh():
+      return {'token': 'fresh'}
+
+    document = await firestore.AsyncFirestore().refresh_document(
+        'westley', _refresh, lambda document: document['token'] == 'fresh')
+
+    self.assertEqual({'token': 'fresh'}, document)
+    (_, lease), _ = transaction.set.call_args_list[0]
+    (_, written), _ = transaction.set.call_args_list[1]
+    self.assertIn(firestore.LEASE_FIELD, lease)
+    self.assertEqual({'token': 'fresh',
+                      firestore.LEASE_FIELD: firestore.firestore.DELETE_FIELD},
+                     written)
+
+  @mock.patch('google.cloud.firestore.async_transactional', lambda f: f)
+  async def test_refresh_document_waits_for_holder(self):
+    ref = self.client.return_value.document.return_value
+    transaction = self.client.return_value.transaction.return_value
+    held = {'token': 'stale',
+            firestore.LEASE_FIELD: {'owner': 'inigo',
+                                    'expires': time.time() + 60}}
+    ref.get = mock.AsyncMock(side_effect=[_snapshot(copy.deepcopy(held)),
+                                          _snapshot({'token': 'fresh'})])
+    refresh = mock.AsyncMock()
+
+    document = await firestore.AsyncFirestore().refresh_document(
+        'westley', refresh, lambda document: document['token'] == 'fresh',
+        poll_interval=0)
+
+    self.assertEqual({'token': 'fresh'}, document)
+    refresh.assert_not_awaited()
+    transaction.set.assert_not_called()
+
+  async def test_delete_document(self):
+    await firestore.AsyncFirestore().delete_document('id')
+    self.document.return_value.delete.assert_awaited_once()
+
+  async def test_list_documents(self):
+    query = _FakeQuery(['westley', 'buttercup', 'inigo'], asynchronous=True)
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+
+    self.assertEqual(['buttercup', 'inigo', 'westley'],
+                     await firestore.AsyncFirestore().list_documents(
+                         page_size=2))
+    self.assertEqual([(2, None), (2, 'inigo')], query.streamed)
+
+  async def test_iter_documents(self):
+    query = _FakeQuery(['westley', 'buttercup', 'inigo'], asynchronous=True)
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+
+    self.assertEqual(['buttercup', 'inigo', 'westley'],
+                     [id async for id in
+                      firestore.AsyncFirestore().iter_documents(page_size=2)])
+    self.assertEqual(['__name__'], query.fields)
+
+  async def test_stream_all_documents(self):
+    query = _FakeQuery(['westley', 'buttercup'], asynchronous=True)
+    self.client.return_value.collection.return_value.order_by.return_value = \
+        query
+
+    self.assertEqual(['buttercup', 'westley'],
+                     [snapshot.id async for snapshot in
+                      firestore.AsyncFirestore().stream_all_documents()])
+
+@unittest.skipUnless(EMULATOR, 'FIRESTORE_EMULATOR_HOST is not set')
+class FirestoreEmulatorTest(unittest.TestCase):
+  def setUp(self):
+    self.datastore = firestore.Firestore()
+    self.id = uuid.uuid4().hex
+
+  def tearDown(self):
+    self.datastore.delete_document(self.id)
+
+  def test_concurrent_updates_merge(self):
+    names = ['westley', 'buttercup', 'inigo', 'fezzik', 'vizzini']
+    with futures.ThreadPoolExecutor(max_workers=len(names)) as pool:
+      list(pool.map(lambda name: self.datastore.update_document(
+          self.id, {name: 'token'}), names))
+
+    self.assertEqual({name: 'token' for name in names},
+                     self.datastore.get_document(self.id))
+
+  def test_field_mask(self):
+    self.datastore.store_document(self.id, {'access_token': 'a',
+                                            'refresh_token': 'r'})
+
+    self.assertEqual('a', self.datastore.get_document(self.id, 'access_token'))
+    self.assertEqual({self.id: {'access_token': 'a'}},
+                     self.datastore.get_documents([self.id],
+                                                  keys=['access_token']))
+
+  def test_list_documents_paginated(self):
+    ids = [f'{self.id}-{i}' for i in range(5)]
+    self.datastore.store_documents({id: {'token': id} for id in ids})
+    try:
+      listed = self.datastore.iter_documents(page_size=2,
+                                             start_after=f'{self.id}-')
+      self.assertEqual(ids, list(itertools.islice(listed, 5)))
+
+      snapshots = self.datastore.stream_all_documents(page_size=2,
+                                                      start_after=ids[2])
+      self.assertEqual({'token': ids[3]}, next(snapshots).to_dict())
+    finally:
+      for id in ids:
+        self.datastore.delete_document(id)
+
+  def test_concurrent_create_or_update(self):
+    with futures.ThreadPoolExecutor(max_workers=5) as pool:
+      created = list(pool.map(
+          lambda i: self.datastore.create_or_update_document(
+              self.id, {f'key{i}': i}), range(5)))
+
+    self.assertEqual(1, created.count(True))
+    self.assertEqual({f'key{i}': i for i in range(5)},
+                     self.datastore.get_document(self.id))
+
+  def test_watch(self):
+    self.datastore.store_document(self.id, {'token': 'old'})
+    try:
+      self.assertTrue(self.datastore.watch(ids=[self.id], timeout=30))
+      self.assertEqual({'token': 'old'}, self.datastore.get_document(self.id))
+
+      firestore.Firestore().update_document(self.id, {'token': 'new'})
+      deadline = time.time() + 30
+      while self.datastore.get_document(self.id, 'token') != 'new':
+        self.assertLess(time.time(), deadline)
+        time.sleep(0.1)
+      self.assertEqual(0, self.datastore.mirror_stats.misses)
+    finally:
+      self.datastore.unwatch()
+
+  def test_concurrent_refresh_document(self):
+    self.datastore.store_document(self.id, {'token': 'stale'})
+    refreshes = []
+
+    def _refresh():
+      refreshes.append(1)
+      time.sleep(0.5)
+      return {'token': 'fresh'}
+
+    def _worker(unused):
+      return firestore.Firestore().refresh_document(
+          self.id, _refresh, lambda document: document['token'] == 'fresh',
+          poll_interval=0.05)
+
+    with futures.ThreadPoolExecutor(max_workers=16) as pool:
+      documents = list(pool.map(_worker, range(16)))
+
+    self.assertEqual(1, len(refreshes))
+    self.assertEqual([{'token': 'fresh'}] * 16, documents)
+    self.assertEqual({'token': 'fresh'}, self.datastore.get_document(self.id))
+
+
+@unittest.skipUnless(EMULATOR, 'FIRESTORE_EMULATOR_HOST is not set')
+class AsyncFirestoreEmulatorTest(unittest.IsolatedAsyncioTestCase):
+  async def test_round_trip(self):
+    datastore = firestore.AsyncFirestore()
+    id = uuid.uuid4().hex
+
+    await datastore.update_document(id, {'token': 'old'})
+    await datastore.update_document(id, {'token': 'new'})
+    self.assertEqual({'token': 'new'}, await datastore.get_document(id))
+
+    await datastore.delete_document(id)
+    self.assertIsNone(await datastore.get_document(id))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,371 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import struct
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from auth.abstract_datastore import AbstractDatastore
+from auth.datastore import codecs
+from auth.datastore.batching import WriteCoalescing, persist
+from auth.datastore.local_file import Durability, write_atomic
+
+MAGIC = b'OTMIDX\x00\x01'
+
+# The file is the magic number, then each document's id and JSON back to back,
+# then the index: one fixed-size entry per document, sorted by id, holding the
+# offset and length of the id and of the document. A trailer at the very end
+# gives the number of entries and where the index starts, so the file can be
+# written in one pass.
+_ENTRY = struct.Struct('>QIQI')           # id offset/length, doc offset/length
+_TRAILER = struct.Struct('>QQ8s')         # count, index offset, magic
+
+
+def write_indexed(path: str,
+                  documents: Iterator[Tuple[str, bytes]],
+                  durability: Durability = Durability.FULL) -> None:
+  """Writes an indexed file atomically.
+
+  Args:
+      path (str): the file to write
+      documents (Iterator[Tuple[str, bytes]]): (id, encoded JSON document)
+                                               pairs, sorted by id
+      durability (Durability): what to `fsync`
+  """
+  def _chunks() -> Iterator[bytes]:
+    entries = []
+    offset = len(MAGIC)
+    yield MAGIC
+    for id, document in documents:
+      encoded_id = id.encode('utf-8')
+      entries.append(_ENTRY.pack(offset, len(encoded_id),
+                                 offset + len(encoded_id), len(document)))
+      yield encoded_id
+      yield document
+      offset += len(encoded_id) + len(document)
+    yield b''.join(entries)
+    yield _TRAILER.pack(len(entries), offset, MAGIC)
+
+  write_atomic(path, _chunks(), durability)
+
+
+def convert(source: str, destination: str) -> None:
+  """Converts a `LocalFile` store to an indexed file.
+
+  Args:
+      source (str): the `LocalFile` file, in any codec
+      destination (str): the indexed file to write
+  """
+  with open(source, 'rb') as store:
+    documents = codecs.decode(store.read())
+
+  write_indexed(destination,
+                ((id, json.dumps(documents[id]).encode('utf-8'))
+                 for id in sorted(documents, key=lambda id: id.encode())))
+
+
+class IndexedFile(WriteCoalescing, AbstractDatastore):
+  """A read-optimized local datastore that decodes only what is read.
+
+  The file is memory-mapped, and only its fixed-size trailer is read when it
+  is opened. `get_document(id)` binary searches the sorted index in the
+  mapping and decodes that one document, so opening even a very large store
+  is immediate and a process only pages in the documents it touches. Use
+  `convert` to create one from an existing `LocalFile` JSON store.
+
+  Writes are held in memory and the file is rebuilt by copying the unchanged
+  documents' bytes (nothing is decoded) with the changes merged in, then
+  atomically replacing it. As with `LocalFile`, use `batch()` or
+  `write_behind()` to coalesce many writes into one rebuild. There should be
+  a single writing process; readers remap the file when it is replaced.
+
+  Args:
+      datastore_file (str): the indexed file
+      durability (Durability): how far each rebuild must reach
+  """
+
+  def __init__(self,
+               email: str = None,
+               project: str = None,
+               datastore_file: str = 'datastore.idx',
+               durability: Durability = Durability.FULL) -> AbstractDatastore:
+    self._email = email
+    self._project = project
+    self._datastore_file = datastore_file
+    self._durability = Durability(durability)
+    self._map: Optional[mmap.mmap] = None
+    self._count = 0
+    self._index_offset = 0
+    self._signature: Optional[Tuple[int, int, int]] = None
+    self._changes: Dict[str, Optional[Dict[str, Any]]] = {}
+    super().__init__()
+
+  @property
+  def datastore_file(self) -> str:
+    return self._datastore_file
+
+  def _file_signature(self) -> Optional[Tuple[int, int, int]]:
+    try:
+      stat = os.stat(self._datastore_file)
+      return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    except FileNotFoundError:
+      return None
+
+  def _mapped(self) -> Optional[mmap.mmap]:
+    """The current mapping of the file, remapped if it has been replaced.
+
+    The caller must hold the lock.
+    """
+    if self._map is None or self._file_signature() != self._signature:
+      self._unmap()
+      self._signature = self._file_signature()
+      if self._signature is None or self._signature[1] == 0:
+        # Missing, or empty (as from `touch`, which cannot be mapped).
+        return None
+
+      with open(self._datastore_file, 'rb') as store:
+        self._map = mmap.mmap(store.fileno(), 0, access=mmap.ACCESS_READ)
+
+      count, index_offset, magic = \
+          _TRAILER.unpack_from(self._map, len(self._map) - _TRAILER.size) \
+          if len(self._map) >= len(MAGIC) + _TRAILER.size else (0, 0, None)
+      if magic != MAGIC or self._map[:len(MAGIC)] != MAGIC:
+        self._unmap()
+        raise ValueError(f'{self._datastore_file} is not an indexed file.')
+      self._count, self._index_offset = count, index_offset
+
+    return self._map
+
+  def _unmap(self) -> None:
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+      self._count = 0
+
+  def _entry(self, i: int) -> Tuple[int, int, int, int]:
+    return _ENTRY.unpack_from(self._map, self._index_offset + i * _ENTRY.size)
+
+  def _id(self, i: int) -> bytes:
+    id_offset, id_length, _, _ = self._entry(i)
+    return self._map[id_offset:id_offset + id_length]
+
+  def _stored(self) -> Iterator[Tuple[str, bytes]]:
+    """Yields each stored (id, encoded document), in id order."""
+    for i in range(self._count):
+      id_offset, id_length, doc_offset, doc_length = self._entry(i)
+      yield (self._map[id_offset:id_offset + id_length].decode('utf-8'),
+             self._map[doc_offset:doc_offset + doc_length])
+
+  def _read(self, id: str) -> Optional[Dict[str, Any]]:
+    with self._lock:
+      if id in self._changes:
+        document = self._changes[id]
+        return None if document is None else dict(document)
+
+      if self._mapped() is None:
+        return None
+
+      key = id.encode('utf-8')
+      low, high = 0, self._count
+      while low < high:
+        middle = (low + high) // 2
+        if self._id(middle) < key:
+          low = middle + 1
+        else:
+          high = middle
+
+      if low < self._count and self._id(low) == key:
+        _, _, doc_offset, doc_length = self._entry(low)
+        return json.loads(self._map[doc_offset:doc_offset + doc_length])
+
+  def _ids(self) -> List[str]:
+    with self._lock:
+      ids = []
+      if self._mapped() is not None:
+        ids = [id for id, _ in self._stored()]
+      stored = set(ids)
+      ids = [id for id in ids if self._changes.get(id, True) is not None]
+      return ids + [id for id, document in self._changes.items()
+                    if document is not None and id not in stored]
+
+  def _persist(self) -> None:
+    if not self._changes:
+      return
+
+    changes = {id.encode('utf-8'): document
+               for id, document in self._changes.items()}
+
+    def _merged() -> Iterator[Tuple[str, bytes]]:
+      stored = self._stored() if self._mapped() is not None else iter(())
+      changed = iter(sorted(changes))
+      current = next(stored, None)
+      change = next(changed, None)
+      while current is not None or change is not None:
+        key = current[0].encode('utf-8') if current is not None else None
+        if change is None or (key is not None and key < change):
+          yield current
+          current = next(stored, None)
+        else:
+          if changes[change] is not None:
+            yield (change.decode('utf-8'),
+                   json.dumps(changes[change]).encode('utf-8'))
+          if key == change:
+            current = next(stored, None)
+          change = next(changed, None)
+
+    write_indexed(self._datastore_file, _merged(), self._durability)
+    self._changes.clear()
+    self._unmap()
+
+  def close(self) -> None:
+    """Writes any pending changes and unmaps the file."""
+    super().close()
+    with self._lock:
+      self._unmap()
+
+  def get_document(self, id: str, key: Optional[str] = None) -> Dict[str, Any]:
+    """Fetches a document, decoding only that document.
+
+    Arguments:
+        id (str): document id
+        key: Optional(str): the document collection sub-key
+
+    Returns:
+        Dict[str, Any]: stored configuration dictionary, or None
+                          if not present
+    """
+    if parent := self._read(id):
+      if key:
+        value = parent.get(key)
+        return {key: value} if value else None
+      else:
+        return {id: parent}
+
+  def get_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents, decoding only those asked for.
+
+    Arguments:
+        ids (List[str]): the document ids
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id
+    """
+    return {id: document for id in ids
+            if (document := self._read(id)) is not None}
+
+  @persist
+  def store_document(self, id: str, document: Dict[str, Any]) -> None:
+    """Stores a document, replacing any with the same id.
+
+    Args:
+        id (str): the document id
+        document (Dict[str, Any]): the document
+    """
+    self._changes[id] = document
+
+  @persist
+  def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    If the document is not already there, it will be created as a net-new
+    document. If it is, it will be updated.
+
+    Args:
+        id (str): the id of the document within the collection.
+        new_data (Dict[str, Any]): the document content.
+    """
+    self._changes[id] = (self._read(id) or {}) | new_data
+
+  @persist
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents with a single rebuild of the file.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    self._changes.update(documents)
+    return {id: None for id in documents}
+
+  @persist
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents with a single rebuild of the file.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    for id, new_data in documents.items():
+      self._changes[id] = (self._read(id) or {}) | new_data
+    return {id: None for id in documents}
+
+  @persist
+  def delete_document(self, id: str, key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    If a key is supplied, then just that key is removed from the document. If
+    no key is given, the entire document is removed. If neither is present,
+    nothing will happen.
+
+    Args:
+        id (str): the id of the document.
+        key (str, optional): the key to remove. Defaults to None.
+    """
+    if (document := self._read(id)) is None:
+      return
+
+    if key:
+      if key in document:
+        document.pop(key)
+        self._changes[id] = document
+    else:
+      self._changes[id] = None
+
+  def list_documents(self, key: Optional[str] = None) -> List[str]:
+    """Lists documents.
+
+    Args:
+        key (str, optional): list the keys of this document instead of the
+                             document ids. Defaults to None.
+
+    Returns:
+        List[str]: the list
+    """
+    if key:
+      if document := self._read(key):
+        return list(document.keys())
+      return None
+
+    return self._ids() or None
+
+  def get_all_documents(self) -> Dict[str, Dict[str, Any]]:
+    """Fetches (and decodes) every document.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: all the documents, keyed by id
+    """
+    return self.get_documents(self._ids())
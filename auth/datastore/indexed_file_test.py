@@ -0,0 +1,119 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import tempfile
+import unittest
+from typing import Optional
+from unittest import mock
+
+from auth.datastore import indexed_file
+from auth.datastore.contract_test import DatastoreContract, MASTER_CONFIG
+
+
+class IndexedFileTest(DatastoreContract, unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+    self.datastore_file = os.path.join(self.directory.name, 'datastore.idx')
+    self.datastore = self._open()
+    self.datastore.store_documents(MASTER_CONFIG)
+
+  def _open(self,
+            datastore_file: Optional[str] = None) -> indexed_file.IndexedFile:
+    datastore = indexed_file.IndexedFile(
+        datastore_file=datastore_file or self.datastore_file,
+        durability='none')
+    self.addCleanup(datastore.close)
+    return datastore
+
+  def _reader(self) -> indexed_file.IndexedFile:
+    return self._open()
+
+  def test_get_document_missing_file(self):
+    datastore = self._open(os.path.join(self.directory.name, 'missing.idx'))
+    self.assertIsNone(datastore.get_document('auth'))
+    self.assertIsNone(datastore.list_documents())
+
+  def test_empty_file(self):
+    empty = os.path.join(self.directory.name, 'empty.idx')
+    open(empty, 'wb').close()
+
+    datastore = self._open(empty)
+    self.assertIsNone(datastore.get_document('auth'))
+    self.assertIsNone(datastore.list_documents())
+
+    datastore.store_document(id='westley', document={'token': 'w'})
+    self.assertEqual({'westley': {'token': 'w'}},
+                     self._open(empty).get_document('westley'))
+
+  def test_decodes_only_requested_document(self):
+    self.datastore.store_documents({f'user{i}': {'token': i}
+                                    for i in range(1000)})
+    datastore = self._open()
+
+    with mock.patch('json.loads', wraps=json.loads) as loads:
+      self.assertEqual({'user500': {'token': 500}},
+                       datastore.get_document('user500'))
+    loads.assert_called_once_with(b'{"token": 500}')
+
+  def test_list_documents_sorted(self):
+    self.datastore.store_documents({'westley': {}, 'buttercup': {}})
+    self.assertEqual(['auth', 'buttercup', 'westley'],
+                     self._open().list_documents())
+
+  def test_batch_rebuilds_once(self):
+    with mock.patch.object(indexed_file, 'write_indexed',
+                           wraps=indexed_file.write_indexed) as write:
+      with self.datastore.batch():
+        self.datastore.store_document(id='westley', document={})
+        self.datastore.delete_document(id='auth')
+        self.assertEqual(['westley'], self.datastore.list_documents())
+        self.assertIsNone(self._open().get_document('westley'))
+
+    write.assert_called_once()
+    self.assertEqual(['westley'], self._open().list_documents())
+
+  def test_reader_remaps_on_change(self):
+    reader = self._open()
+    self.assertIsNone(reader.get_document('westley'))
+
+    self.datastore.store_document(id='westley', document={'token': 'w'})
+
+    self.assertEqual({'westley': {'token': 'w'}},
+                     reader.get_document('westley'))
+
+  def test_convert(self):
+    source = os.path.join(self.directory.name, 'datastore.json')
+    with open(source, 'w') as f:
+      f.write(json.dumps(MASTER_CONFIG | {'westley': {'token': 'w'}}))
+
+    destination = os.path.join(self.directory.name, 'converted.idx')
+    indexed_file.convert(source, destination)
+
+    with indexed_file.IndexedFile(datastore_file=destination) as datastore:
+      self.assertEqual(MASTER_CONFIG | {'westley': {'token': 'w'}},
+                       datastore.get_all_documents())
+
+  def test_not_an_indexed_file(self):
+    other = os.path.join(self.directory.name, 'datastore.json')
+    with open(other, 'w') as f:
+      f.write(json.dumps(MASTER_CONFIG))
+
+    with self.assertRaises(ValueError):
+      self._open(other).get_document('auth')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -13,46 +13,128 @@
 # limitations under the License.
 from __future__ import annotations
 
-import json
-from typing import Any, Callable, Dict, List, Mapping, Optional
+import asyncio
+import contextlib
+import copy
+import enum
+import errno
+import os
+import tempfile
+from typing import (Any, Dict, Iterable, Iterator, List, Mapping, Optional,
+                    Tuple, Union)
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 from auth import decorators
 from auth.abstract_datastore import AbstractDatastore
+from auth.async_abstract_datastore import AsyncAbstractDatastore
+from auth.datastore import codecs
+from auth.datastore.batching import WriteCoalescing, persist
 
 
-def persist(f: Callable) -> Any:
-  """Decorator to write the key/value pairs to the storage file.
+class Durability(enum.Enum):
+  """How far a write must reach before it is considered done.
 
-  This avoids code duplication of the `persist` behaviour, and if the
-  function is wrapped in the decorator, we can't forget to persist the map!
+  Every level replaces the file atomically, so a reader (or a process killed
+  mid-write) only ever sees the old or the new contents.
+
+  NONE: write a temporary file and rename it over the store. A power loss
+        can still lose the write, or, on some filesystems, leave an empty
+        file.
+  FILE: also `fsync` the temporary file before renaming it, so the new
+        contents are on disk before they become visible.
+  FULL: also `fsync` the directory after renaming, so the rename itself
+        survives a power loss.
+  """
+  NONE = 'none'
+  FILE = 'file'
+  FULL = 'full'
+
+
+def write_atomic(path: str,
+                 data: Union[str, bytes, Iterable[bytes]],
+                 durability: Durability = Durability.FULL) -> None:
+  """Replaces the contents of a file atomically.
+
+  The data is written to a temporary file in the same directory, which is
+  then renamed over `path` with `os.replace`. The file keeps its permissions
+  if it already existed; a new one is only readable by its owner.
 
   Args:
-      f (Callable): the function to wrap
+      path (str): the file to replace
+      data (Union[str, bytes, Iterable[bytes]]): the new contents, as text,
+                                                 bytes or binary chunks
+      durability (Durability): what to `fsync`
+  """
+  path = os.path.abspath(path)
+  directory, name = os.path.split(path)
+  fd, temp = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.tmp')
+  try:
+    with open(fd, 'w' if isinstance(data, str) else 'wb') as storage:
+      if isinstance(data, (str, bytes)):
+        storage.write(data)
+      else:
+        storage.writelines(data)
+      if durability is not Durability.NONE:
+        storage.flush()
+        os.fsync(fd)
+
+    with contextlib.suppress(FileNotFoundError):
+      os.chmod(temp, os.stat(path).st_mode)
+    os.replace(temp, path)
 
-  Returns:
-      Any: the return value of `f`
+  except BaseException:
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(temp)
+    raise
+
+  if durability is Durability.FULL:
+    sync_directory(directory)
+
+
+def sync_directory(directory: str) -> None:
+  """Flushes a directory's entries (new, renamed or removed files) to disk.
+
+  This is a no-op where directories cannot be opened, as on Windows.
+
+  Args:
+      directory (str): the directory
   """
-  def f_persist(*args: Mapping[str, Any], **kw: Mapping[str, Any]) -> Any:
-    datastore = args[0]
+  if hasattr(os, 'O_DIRECTORY'):
+    dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
     try:
-      return f(*args, **kw)
+      os.fsync(dir_fd)
     finally:
-      with open(datastore.datastore_file, 'w') as storage:
-        storage.write(json.dumps(datastore.datastore, indent=2))
-  return f_persist
+      os.close(dir_fd)
 
 
-class LocalFile(AbstractDatastore):
-  @decorators.lazy_property
+class LocalFile(WriteCoalescing, AbstractDatastore):
+  """A datastore for storing auth credentials in a local JSON file.
+
+  Many processes can share one file. Each mutation is applied in memory and
+  recorded; a writer then takes an exclusive `fcntl` lock on a companion
+  `<datastore_file>.lock` file, re-reads the store if another process has
+  replaced it, replays the recorded mutations on what it read (a key-level
+  update changes only its keys) and writes it back, all under the lock, so no
+  process overwrites another's tokens or keys. Reads check
+  the file's mtime, size and inode, and reload it (under a shared lock) when
+  it has changed. Without `fcntl` (on Windows) the locks are skipped.
+
+  The file is written with `codec` (compact JSON by default; see
+  `auth.datastore.codecs`), and read whatever codec wrote it.
+  """
+
+  @property
   def datastore(self) -> Dict[str, Any]:
-    try:
-      with open(self.datastore_file, 'r') as store:
-        if data := store.read():
-          return json.loads(data)
-        else:
-          return {}
-    except FileNotFoundError:
-      return {}
+    """The document map, reloaded if the file has changed since it was read."""
+    with self._lock:
+      if self._datastore is None or self._stale():
+        with self._file_lock(exclusive=False):
+          self._reload()
+      return self._datastore
 
   @decorators.lazy_property
   def datastore_file(self) -> str:
@@ -65,10 +147,146 @@ class LocalFile(AbstractDatastore):
   def __init__(self,
                email: str = None,
                project: str = None,
-               datastore_file: str = 'datastore.json') -> AbstractDatastore:
+               datastore_file: str = 'datastore.json',
+               durability: Durability = Durability.FULL,
+               codec: Optional[codecs.Codec] = None) -> AbstractDatastore:
     self._project = project
     self._email = email
     self.datastore_file = datastore_file
+    self._durability = Durability(durability)
+    self._codec = codec or codecs.Codec()
+    self._datastore: Optional[Dict[str, Any]] = None
+    self._signature: Optional[Tuple[int, int, int]] = None
+    self._pending: List[Tuple[str, str, Any]] = []
+    super().__init__()
+
+  @property
+  def durability(self) -> Durability:
+    """How far each write of the file must reach; see `Durability`."""
+    return self._durability
+
+  def _file_signature(self) -> Optional[Tuple[int, int, int]]:
+    try:
+      stat = os.stat(self.datastore_file)
+      return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    except FileNotFoundError:
+      return None
+
+  def _stale(self) -> bool:
+    return self._file_signature() != self._signature
+
+  @contextlib.contextmanager
+  def _file_lock(self, exclusive: bool) -> Iterator[None]:
+    """Holds a shared or exclusive lock on the companion lock file.
+
+    A shared lock is taken on the lock file opened read-only. If this process
+    may not create or open it (a store it can read in a directory it cannot
+    write, or on a read-only filesystem) the read goes ahead without the
+    lock: the file is only ever replaced atomically, so it still sees whole
+    contents.
+    """
+    if not fcntl:
+      yield
+      return
+
+    lock_file = f'{self.datastore_file}.lock'
+    if exclusive:
+      fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+    else:
+      fd = self._open_shared(lock_file)
+      if fd is None:
+        yield
+        return
+
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      yield
+    finally:
+      os.close(fd)
+
+  @staticmethod
+  def _open_shared(lock_file: str) -> Optional[int]:
+    """Opens the lock file for a shared lock, creating it if it can.
+
+    Returns:
+        Optional[int]: the file descriptor, or None if it cannot be opened
+    """
+    try:
+      try:
+        return os.open(lock_file, os.O_RDONLY)
+      except FileNotFoundError:
+        return os.open(lock_file, os.O_RDONLY | os.O_CREAT, 0o600)
+    except OSError as e:
+      if e.errno in (errno.EACCES, errno.EPERM, errno.EROFS):
+        return None
+      raise
+
+  def _reload(self) -> None:
+    """Re-reads the file, replaying the mutations made here but not written.
+
+    The caller must hold the file lock.
+    """
+    signature = self._file_signature()
+    try:
+      with open(self.datastore_file, 'rb') as store:
+        stored = codecs.decode(store.read())
+    except FileNotFoundError:
+      stored = {}
+
+    for mutation in self._pending:
+      self._apply(stored, *mutation)
+
+    self._datastore = stored
+    self._signature = signature
+
+  def _persist(self) -> None:
+    """Writes the pending mutations: under the exclusive lock, reloads the
+    file if another process has changed it (replaying them on its contents)
+    and writes it back.
+    """
+    with self._file_lock(exclusive=True):
+      if self._datastore is None or self._stale():
+        self._reload()
+
+      write_atomic(self.datastore_file,
+                   self._codec.encode(self._datastore),
+                   self._durability)
+      self._signature = self._file_signature()
+      self._pending.clear()
+
+  @staticmethod
+  def _apply(datastore: Dict[str, Any], operation: str, id: str,
+             value: Any) -> None:
+    """Applies one mutation to a document map.
+
+    The map is given copies of documents and new data, so it never shares
+    them with the caller or with another map the mutation is replayed on.
+
+    Args:
+        datastore (Dict[str, Any]): the document map
+        operation (str): 'store', 'update' or 'delete'
+        id (str): the document id
+        value (Any): the document, the new data, or the key to delete (None
+                     for the whole document)
+    """
+    if operation == 'store':
+      datastore[id] = copy.deepcopy(value)
+    elif operation == 'update':
+      if document := datastore.get(id):
+        document.update(copy.deepcopy(value))
+      else:
+        datastore[id] = copy.deepcopy(dict(value))
+    elif value:
+      if document := datastore.get(id):
+        document.pop(value, None)
+    else:
+      datastore.pop(id, None)
+
+  def _mutate(self, operation: str, id: str, value: Any) -> None:
+    """Applies a mutation in memory and records it for `_persist`."""
+    value = copy.deepcopy(value)
+    self._apply(self.datastore, operation, id, value)
+    self._pending.append((operation, id, value))
 
   def get_document(self, id: str, key: Optional[str] = None) -> Dict[str, Any]:
     """Fetches a document (could be anything, 'type' identifies the root.)
@@ -90,6 +308,21 @@ class LocalFile(AbstractDatastore):
       else:
         return {id: parent}
 
+  def get_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents at once.
+
+    The whole store is held in memory after a single read of the file, so
+    this is a lookup per id with no further I/O.
+
+    Arguments:
+        ids (List[str]): the document ids
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id
+    """
+    return {id: document for id in ids
+            if (document := self.datastore.get(id)) is not None}
+
   @persist
   def store_document(self, id: str, document: Dict[str, Any]) -> None:
     """Stores a document.
@@ -102,7 +335,7 @@ class LocalFile(AbstractDatastore):
         id (str): report id
         report_data (Dict[str, Any]): report configuration
     """
-    self.datastore.update({id: document})
+    self._mutate('store', id, document)
 
   @persist
   def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
@@ -115,10 +348,41 @@ class LocalFile(AbstractDatastore):
         id (str): the id of the document within the collection.
         new_data (Dict[str, Any]): the document content.
     """
-    if document := self.datastore.get(id):
-      document.update(new_data)
-    else:
-      self.store_document(id, new_data)
+    self._mutate('update', id, new_data)
+
+  @persist
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents with a single write of the file.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    for id, document in documents.items():
+      self._mutate('store', id, document)
+    return {id: None for id in documents}
+
+  @persist
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents with a single write of the file.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    for id, new_data in documents.items():
+      self._mutate('update', id, new_data)
+    return {id: None for id in documents}
 
   @persist
   def delete_document(self, id: str, key: Optional[str] = None) -> None:
@@ -133,15 +397,7 @@ class LocalFile(AbstractDatastore):
         id (str): the id of the document within the collection.
         key (str, optional): the key to remove. Defaults to None.
     """
-    try:
-      if key:
-        if doc := self.datastore.get(id):
-          doc.pop(key)
-      else:
-        self.datastore.pop(id)
-
-    except KeyError:
-      None
+    self._mutate('delete', id, key)
 
   def list_documents(self, key: Optional[str] = None) -> List[str]:
     """Lists documents in a collection.
@@ -163,18 +419,98 @@ class LocalFile(AbstractDatastore):
     if self.datastore:
       if key:
         if sub_docs := self.datastore.get(key):
-          keys = sub_docs.keys()
+          keys = list(sub_docs.keys())
       else:
-        keys = self.datastore
+        keys = list(self.datastore)
 
     return keys
 
-  def get_all_documents(self) -> List[Dict[str, Any]]:
-    """Lists all documents
-
-    Lists all documents of a given Type
+  def get_all_documents(self) -> Dict[str, Dict[str, Any]]:
+    """Fetches every document.
 
     Returns:
-        documents (List[DocumentReference]): list of all documents
+        Dict[str, Dict[str, Any]]: a copy of all the documents, keyed by id
+    """
+    return copy.deepcopy(self.datastore)
+
+
+class AsyncLocalFile(AsyncAbstractDatastore):
+  """The asyncio version of `LocalFile`.
+
+  Every call is made on a `LocalFile` on a worker thread, so the event loop
+  never waits for the disk and the file is shared with other processes
+  exactly as `LocalFile` shares it: reads reload the file when it has
+  changed, and each write takes the exclusive lock, re-reads the file and
+  replays its change on what it read.
+  """
+
+  def __init__(self,
+               email: str = None,
+               project: str = None,
+               datastore_file: str = 'datastore.json',
+               durability: Durability = Durability.FULL,
+               codec: Optional[codecs.Codec] = None
+               ) -> AsyncAbstractDatastore:
+    self._project = project
+    self._email = email
+    self._local = LocalFile(email=email, project=project,
+                            datastore_file=datastore_file,
+                            durability=durability, codec=codec)
+
+  @property
+  def datastore_file(self) -> str:
+    return self._local.datastore_file
+
+  @property
+  def durability(self) -> Durability:
+    return self._local.durability
+
+  async def datastore(self) -> Dict[str, Any]:
+    """The document map, reloaded if the file has changed since it was read.
+
+    See `LocalFile.datastore`.
+    """
+    return await asyncio.to_thread(lambda: self._local.datastore)
+
+  async def get_document(self, id: str,
+                         key: Optional[str] = None) -> Dict[str, Any]:
+    """Fetches a document.
+
+    See `LocalFile.get_document`.
+    """
+    return await asyncio.to_thread(self._local.get_document, id, key)
+
+  async def store_document(self, id: str, document: Dict[str, Any]) -> None:
+    """Stores a document.
+
+    See `LocalFile.store_document`.
+    """
+    await asyncio.to_thread(self._local.store_document, id, document)
+
+  async def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    See `LocalFile.update_document`.
+    """
+    await asyncio.to_thread(self._local.update_document, id, new_data)
+
+  async def delete_document(self, id: str, key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    See `LocalFile.delete_document`.
+    """
+    await asyncio.to_thread(self._local.delete_document, id, key)
+
+  async def list_documents(self, key: Optional[str] = None) -> List[str]:
+    """Lists documents in a collection.
+
+    See `LocalFile.list_documents`.
+    """
+    return await asyncio.to_thread(self._local.list_documents, key)
+
+  async def get_all_documents(self) -> Dict[str, Dict[str, Any]]:
+    """Fetches every document.
+
+    See `LocalFile.get_all_documents`.
     """
-    return self.list_documents()
+    return await asyncio.to_thread(self._local.get_all_documents)
@@ -12,11 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import json
+import multiprocessing
+import os
+import tempfile
+import threading
 import unittest
 from unittest import mock
 
 from auth import local_file
+from auth.datastore import codecs
+from auth.datastore.contract_test import DatastoreContract
 from google.oauth2 import credentials as oauth
 
 from copy import deepcopy
@@ -39,6 +46,14 @@ CLASS_UNDER_TEST = 'auth.local_file'
 class LocalFileTest(unittest.TestCase):
   def setUp(self):
     self.open = mock.mock_open(read_data=json.dumps(MASTER_CONFIG))
+    # Writes replace the file atomically, so run in a scratch directory.
+    self.directory = tempfile.TemporaryDirectory()
+    self.cwd = os.getcwd()
+    os.chdir(self.directory.name)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    self.directory.cleanup()
 
   def test_get_document_with_key(self):
     with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
@@ -67,6 +82,13 @@ class LocalFileTest(unittest.TestCase):
       datastore = local_file.LocalFile()
       self.assertEqual(None, datastore.get_document('auth', 'foo'))
 
+  def test_get_documents(self):
+    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
+      datastore = local_file.LocalFile()
+      self.assertEqual({'auth': MASTER_CONFIG['auth']},
+                       datastore.get_documents(['auth', '10011']))
+      self.open.assert_called_once()
+
   def test_store_new_document(self):
     with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
       datastore = local_file.LocalFile()
@@ -74,8 +96,8 @@ class LocalFileTest(unittest.TestCase):
 
       expected = deepcopy(MASTER_CONFIG)
       expected.update({'0000': {'id': '0000'}})
-      self.open.assert_called_with('datastore.json', 'w')
-      self.open().write.assert_called_with(json.dumps(expected, indent=2))
+      self.assertIn('datastore.json', os.listdir())
+      self.open().write.assert_called_with(codecs.Codec().encode(expected))
 
   def test_store_new_document_new_name(self):
     with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
@@ -85,16 +107,37 @@ class LocalFileTest(unittest.TestCase):
 
       expected = deepcopy(MASTER_CONFIG)
       expected.update({'0000': {'id': '0000'}})
-      self.open.assert_called_with('new_datastore.json', 'w')
-      self.open().write.assert_called_with(json.dumps(expected, indent=2))
+      self.assertIn('new_datastore.json', os.listdir())
+      self.open().write.assert_called_with(codecs.Codec().encode(expected))
+
+  def test_store_documents_single_write(self):
+    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
+      datastore = local_file.LocalFile()
+      results = datastore.store_documents({'0000': {'id': '0000'},
+                                           '0001': {'id': '0001'}})
+
+      expected = deepcopy(MASTER_CONFIG)
+      expected.update({'0000': {'id': '0000'}, '0001': {'id': '0001'}})
+      self.assertEqual({'0000': None, '0001': None}, results)
+      self.open().write.assert_called_once_with(codecs.Codec().encode(expected))
+
+  def test_update_documents_single_write(self):
+    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
+      datastore = local_file.LocalFile()
+      datastore.update_documents({'auth': {'api_key': 'new api key'},
+                                  '0000': {'id': '0000'}})
+
+      self.open().write.assert_called_once()
+      self.assertEqual('new api key',
+                       datastore.datastore['auth']['api_key'])
+      self.assertEqual({'id': '0000'}, datastore.datastore['0000'])
 
   def test_list_documents_all(self):
     with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
       datastore = local_file.LocalFile()
 
       _docs = datastore.list_documents()
-      expected = MASTER_CONFIG
-      self.assertDictEqual(expected, _docs)
+      self.assertEqual(['auth'], _docs)
 
   def test_list_documents_auth(self):
     with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
@@ -102,7 +145,7 @@ class LocalFileTest(unittest.TestCase):
 
       _docs = datastore.list_documents('auth')
       expected = MASTER_CONFIG.get('auth')
-      self.assertEqual(expected.keys(), _docs)
+      self.assertEqual(list(expected.keys()), _docs)
 
   def test_list_documents_none(self):
     with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
@@ -158,3 +201,346 @@ class LocalFileTest(unittest.TestCase):
       self.open().write.assert_called_once()
       self.assertEqual(expected.get('api_key'),
                        datastore.datastore.get('auth').get('api_key'))
+
+  def test_update_document_new_single_write(self):
+    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
+      datastore = local_file.LocalFile()
+      datastore.update_document(id='0000', new_data={'id': '0000'})
+
+      self.open().write.assert_called_once()
+      self.assertEqual({'0000': {'id': '0000'}},
+                       datastore.get_document('0000'))
+
+  def test_batch_single_write(self):
+    with mock.patch(f'{CLASS_UNDER_TEST}.open', self.open):
+      datastore = local_file.LocalFile()
+      with datastore.batch():
+        datastore.store_document(id='0000', document={'id': '0000'})
+        datastore.update_document(id='auth', new_data={'api_key': 'new'})
+        datastore.delete_document(id='0000')
+        self.open().write.assert_not_called()
+
+      expected = deepcopy(MASTER_CONFIG)
+      expected['auth']['api_key'] = 'new'
+      self.open().write.assert_called_once_with(codecs.Codec().encode(expected))
+
+
+class LocalFileContractTest(DatastoreContract, unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self.directory.cleanup)
+    self.datastore_file = os.path.join(self.directory.name, 'datastore.json')
+    self.datastore = self._open()
+    self.datastore.store_documents(deepcopy(MASTER_CONFIG))
+
+  def _open(self) -> local_file.LocalFile:
+    return local_file.LocalFile(datastore_file=self.datastore_file,
+                                durability='none')
+
+  def _reader(self) -> local_file.LocalFile:
+    return self._open()
+
+  def test_stores_copies(self):
+    document = {'token': 'w'}
+    self.datastore.store_document(id='westley', document=document)
+    document['token'] = 'changed'
+    self.datastore.update_document(id='westley', new_data=document)
+    document['scope'] = 'changed'
+
+    self.assertEqual({'westley': {'token': 'changed'}},
+                     self.datastore.get_document('westley'))
+
+
+class WriteAtomicTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.datastore_file = os.path.join(self.directory.name, 'datastore.json')
+    with open(self.datastore_file, 'w') as f:
+      f.write(json.dumps(MASTER_CONFIG))
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def _stored(self) -> Dict[str, Any]:
+    with open(self.datastore_file, 'r') as f:
+      return json.loads(f.read())
+
+  def test_replaces_file(self):
+    datastore = local_file.LocalFile(datastore_file=self.datastore_file)
+    datastore.store_document(id='0000', document={'id': '0000'})
+
+    expected = deepcopy(MASTER_CONFIG)
+    expected.update({'0000': {'id': '0000'}})
+    self.assertEqual(expected, self._stored())
+    self.assertEqual([], [f for f in os.listdir(self.directory.name)
+                          if f.endswith('.tmp')])
+
+  def test_failed_write_keeps_old_contents(self):
+    datastore = local_file.LocalFile(datastore_file=self.datastore_file)
+    with mock.patch('os.replace', side_effect=OSError('inconceivable')):
+      with self.assertRaises(OSError):
+        datastore.store_document(id='0000', document={'id': '0000'})
+
+    self.assertEqual(MASTER_CONFIG, self._stored())
+    self.assertEqual([], [f for f in os.listdir(self.directory.name)
+                          if f.endswith('.tmp')])
+
+  def test_keeps_permissions(self):
+    os.chmod(self.datastore_file, 0o640)
+    local_file.write_atomic(self.datastore_file, '{}')
+    self.assertEqual(0o640, os.stat(self.datastore_file).st_mode & 0o777)
+
+  def test_durability(self):
+    for durability, syncs in [('none', 0), ('file', 1), ('full', 2)]:
+      with self.subTest(durability=durability):
+        datastore = local_file.LocalFile(datastore_file=self.datastore_file,
+                                         durability=durability)
+        with mock.patch('os.fsync') as fsync:
+          datastore.store_document(id='0000', document={'id': '0000'})
+        self.assertEqual(syncs, fsync.call_count)
+
+
+def _update_many(datastore_file: str, prefix: str, count: int) -> None:
+  datastore = local_file.LocalFile(datastore_file=datastore_file,
+                                   durability='none')
+  for i in range(count):
+    datastore.update_document(id=f'{prefix}{i}', new_data={'token': i})
+
+
+class SharedFileTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.datastore_file = os.path.join(self.directory.name, 'datastore.json')
+    with open(self.datastore_file, 'w') as f:
+      f.write(json.dumps(MASTER_CONFIG))
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def _stored(self) -> Dict[str, Any]:
+    with open(self.datastore_file, 'r') as f:
+      return json.loads(f.read())
+
+  def _datastore(self) -> local_file.LocalFile:
+    return local_file.LocalFile(datastore_file=self.datastore_file)
+
+  def test_codec(self):
+    datastore = local_file.LocalFile(
+        datastore_file=self.datastore_file,
+        codec=codecs.Codec(compression='gzip'))
+    self.assertEqual(MASTER_CONFIG, datastore.get_document('auth'))
+    datastore.store_document(id='westley', document={'token': 'w'})
+
+    with open(self.datastore_file, 'rb') as f:
+      self.assertTrue(f.read().startswith(codecs.MAGIC))
+    self.assertEqual({'westley': {'token': 'w'}},
+                     self._datastore().get_document('westley'))
+
+  def test_no_lost_update(self):
+    westley = self._datastore()
+    buttercup = self._datastore()
+    self.assertIsNotNone(westley.get_document('auth'))
+    self.assertIsNotNone(buttercup.get_document('auth'))
+
+    westley.store_document(id='westley', document={'token': 'w'})
+    buttercup.store_document(id='buttercup', document={'token': 'b'})
+
+    stored = self._stored()
+    self.assertEqual({'token': 'w'}, stored['westley'])
+    self.assertEqual({'token': 'b'}, stored['buttercup'])
+    self.assertIn('auth', stored)
+
+  def test_no_lost_key_update(self):
+    westley = self._datastore()
+    buttercup = self._datastore()
+    self.assertIsNotNone(westley.get_document('auth'))
+    self.assertIsNotNone(buttercup.get_document('auth'))
+
+    westley.update_document(id='auth', new_data={'westley': {'token': 'w'}})
+    buttercup.update_document(id='auth',
+                              new_data={'buttercup': {'token': 'b'}})
+
+    stored = self._stored()['auth']
+    self.assertEqual({'token': 'w'}, stored['westley'])
+    self.assertEqual({'token': 'b'}, stored['buttercup'])
+    self.assertIn('api_key', stored)
+
+  def test_no_lost_key_delete(self):
+    westley = self._datastore()
+    buttercup = self._datastore()
+    self.assertIsNotNone(westley.get_document('auth'))
+    self.assertIsNotNone(buttercup.get_document('auth'))
+
+    westley.update_document(id='auth', new_data={'westley': {'token': 'w'}})
+    buttercup.delete_document(id='auth', key='api_key')
+
+    stored = self._stored()['auth']
+    self.assertEqual({'token': 'w'}, stored['westley'])
+    self.assertNotIn('api_key', stored)
+
+  def test_reload_on_change(self):
+    westley = self._datastore()
+    self.assertIsNone(westley.get_document('buttercup'))
+
+    self._datastore().store_document(id='buttercup', document={'token': 'b'})
+
+    self.assertEqual({'buttercup': {'token': 'b'}},
+                     westley.get_document('buttercup'))
+
+  def test_delete_merged(self):
+    westley = self._datastore()
+    buttercup = self._datastore()
+    westley.get_document('auth')
+    buttercup.store_document(id='buttercup', document={'token': 'b'})
+
+    westley.delete_document(id='auth')
+
+    self.assertEqual({'buttercup': {'token': 'b'}}, self._stored())
+
+  def test_pending_changes_survive_reload(self):
+    westley = self._datastore()
+    with westley.batch():
+      westley.store_document(id='westley', document={'token': 'w'})
+      self._datastore().store_document(id='inigo', document={'token': 'i'})
+
+      self.assertIsNotNone(westley.get_document('inigo'))
+      self.assertIsNotNone(westley.get_document('westley'))
+
+    stored = self._stored()
+    self.assertIn('westley', stored)
+    self.assertIn('inigo', stored)
+
+  @unittest.skipUnless(local_file.fcntl, 'needs fcntl')
+  def test_read_without_lock_file_access(self):
+    open_file = os.open
+
+    def _open(path, flags, *args):
+      if path.endswith('.lock'):
+        raise PermissionError(13, 'Permission denied', path)
+      return open_file(path, flags, *args)
+
+    with mock.patch('os.open', side_effect=_open):
+      self.assertIsNotNone(self._datastore().get_document('auth'))
+
+  @unittest.skipUnless(local_file.fcntl, 'needs fcntl')
+  def test_read_on_read_only_filesystem(self):
+    with mock.patch('os.open',
+                    side_effect=OSError(local_file.errno.EROFS, 'Read-only')):
+      self.assertIsNotNone(self._datastore().get_document('auth'))
+
+  @unittest.skipUnless(local_file.fcntl, 'needs fcntl')
+  def test_shared_lock_opens_read_only(self):
+    self.assertIsNotNone(self._datastore().get_document('auth'))
+
+    open_file = os.open
+    with mock.patch('os.open', side_effect=open_file) as opened:
+      self._datastore().get_document('auth')
+
+    (path, flags), _ = opened.call_args
+    self.assertEqual(f'{self.datastore_file}.lock', path)
+    self.assertEqual(os.O_RDONLY, flags & (os.O_RDONLY | os.O_WRONLY |
+                                           os.O_RDWR))
+
+  @unittest.skipUnless(local_file.fcntl, 'needs fcntl')
+  def test_processes(self):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_update_many,
+                                 args=(self.datastore_file, name, 25))
+                 for name in ['westley', 'buttercup', 'inigo', 'fezzik']]
+    for process in processes:
+      process.start()
+    for process in processes:
+      process.join(30)
+
+    stored = self._stored()
+    self.assertEqual(101, len(stored))
+    self.assertEqual({'token': 24}, stored['fezzik24'])
+
+
+class AsyncLocalFileTest(unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.datastore_file = os.path.join(self.directory.name, 'datastore.json')
+    with open(self.datastore_file, 'w') as f:
+      f.write(json.dumps(MASTER_CONFIG))
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def _stored(self) -> Dict[str, Any]:
+    with open(self.datastore_file, 'r') as f:
+      return json.loads(f.read())
+
+  async def test_get_document_with_key(self):
+    datastore = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    self.assertEqual({'api_key': 'api_key'},
+                     await datastore.get_document('auth', 'api_key'))
+
+  async def test_get_document_missing_file(self):
+    datastore = local_file.AsyncLocalFile(
+        datastore_file=os.path.join(self.directory.name, 'missing.json'))
+    self.assertIsNone(await datastore.get_document('auth'))
+
+  async def test_store_new_document(self):
+    datastore = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    await datastore.store_document(id='0000', document={'id': '0000'})
+
+    expected = deepcopy(MASTER_CONFIG)
+    expected.update({'0000': {'id': '0000'}})
+    self.assertEqual(expected, self._stored())
+
+  async def test_update_document_concurrently(self):
+    datastore = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    await asyncio.gather(*[
+        datastore.update_document(id=f'user{i}', new_data={'token': i})
+        for i in range(50)])
+
+    stored = self._stored()
+    self.assertEqual(51, len(stored))
+    self.assertEqual({'token': 49}, stored['user49'])
+
+  async def test_concurrent_first_reads_share_load(self):
+    datastore = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    with mock.patch.object(datastore._local, '_reload',
+                           wraps=datastore._local._reload) as reload:
+      await asyncio.gather(
+          datastore.get_document('auth'),
+          datastore.store_document(id='0000', document={'id': '0000'}))
+
+    reload.assert_called_once()
+    self.assertEqual({'0000': {'id': '0000'}},
+                     await datastore.get_document('0000'))
+    self.assertEqual({'id': '0000'}, self._stored()['0000'])
+
+  async def test_sees_other_writers(self):
+    datastore = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    self.assertIsNone(await datastore.get_document('westley'))
+
+    local_file.LocalFile(datastore_file=self.datastore_file).store_document(
+        id='westley', document={'token': 'w'})
+
+    self.assertEqual({'westley': {'token': 'w'}},
+                     await datastore.get_document('westley'))
+
+  async def test_no_lost_update(self):
+    westley = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    buttercup = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    await westley.get_document('auth')
+    await buttercup.get_document('auth')
+
+    await westley.update_document(id='auth', new_data={'westley': 'w'})
+    await buttercup.update_document(id='auth', new_data={'buttercup': 'b'})
+
+    stored = self._stored()['auth']
+    self.assertEqual('w', stored['westley'])
+    self.assertEqual('b', stored['buttercup'])
+
+  async def test_delete_document_key(self):
+    datastore = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    await datastore.delete_document(id='auth', key='api_key')
+    self.assertNotIn('api_key', self._stored()['auth'])
+
+  async def test_list_documents_auth(self):
+    datastore = local_file.AsyncLocalFile(datastore_file=self.datastore_file)
+    self.assertEqual(list(MASTER_CONFIG['auth'].keys()),
+                     await datastore.list_documents('auth'))
@@ -0,0 +1,422 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from auth.abstract_datastore import AbstractDatastore
+from auth.datastore.local_file import Durability, sync_directory
+
+MAGIC = b'OTMLOG\x00\x01'
+
+# Each record is its payload's length and CRC-32, then the payload.
+_RECORD_HEADER = struct.Struct('>II')
+
+
+def _encode(id: str, document: Optional[Dict[str, Any]]) -> bytes:
+  """Encodes one record; a document of None is a deletion."""
+  payload = {'id': id} if document is None else {'id': id, 'doc': document}
+  data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+  return _RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def _decode(buffer: bytes, offset: int) -> Optional[Tuple[Dict[str, Any], int]]:
+  """Decodes the record at `offset`.
+
+  Returns:
+      Optional[Tuple[Dict[str, Any], int]]: the payload and the record's total
+                                            length, or None if the record is
+                                            truncated or corrupt
+  """
+  if len(buffer) - offset < _RECORD_HEADER.size:
+    return None
+
+  length, crc = _RECORD_HEADER.unpack_from(buffer, offset)
+  start = offset + _RECORD_HEADER.size
+  data = buffer[start:start + length]
+  if len(data) != length or zlib.crc32(data) != crc:
+    return None
+
+  return json.loads(data), _RECORD_HEADER.size + length
+
+
+def _records(buffer: bytes,
+             offset: int) -> Iterator[Tuple[int, Dict[str, Any], int]]:
+  """Yields (offset, payload, length) for each intact record from `offset`."""
+  while (record := _decode(buffer, offset)) is not None:
+    payload, length = record
+    yield offset, payload, length
+    offset += length
+
+
+class LogStructured(AbstractDatastore):
+  """A local datastore which appends every change to a log file.
+
+  Writing a document appends one small, checksummed record holding the
+  document's new contents (or a deletion marker) instead of rewriting the
+  whole store, so the cost of a write does not grow with the number of
+  documents. An in-memory index maps each id to its latest record, and a read
+  decodes only that record.
+
+  Superseded records are removed by compaction, which copies the live records
+  to a new file and swaps it in atomically. It starts on a background thread
+  once more than `compact_ratio` of a log of at least `compact_min_size`
+  bytes is garbage, and can be run directly with `compact()`.
+
+  On opening, the log is replayed to rebuild the index; a torn or corrupt
+  record at the end (left by a crash mid-append) is discarded and the file
+  truncated back to the last intact record.
+
+  The log is owned by one process; threads within it can share an instance.
+
+  Args:
+      datastore_file (str): the log file
+      durability (Durability): NONE leaves appends to the OS to flush; FILE
+                               and FULL `fsync` after each append
+      compact_ratio (float): the fraction of garbage which starts compaction
+      compact_min_size (int): the smallest log, in bytes, to compact
+  """
+
+  def __init__(self,
+               email: str = None,
+               project: str = None,
+               datastore_file: str = 'datastore.log',
+               durability: Durability = Durability.FILE,
+               compact_ratio: float = 0.5,
+               compact_min_size: int = 1 << 20) -> AbstractDatastore:
+    self._email = email
+    self._project = project
+    self._datastore_file = datastore_file
+    self._durability = Durability(durability)
+    self._compact_ratio = compact_ratio
+    self._compact_min_size = compact_min_size
+
+    self._lock = threading.RLock()
+    self._compaction_lock = threading.Lock()
+    self._compaction: Optional[threading.Thread] = None
+    self._index: Dict[str, Tuple[int, int]] = {}
+    self._garbage = 0
+    self._fd = self._open()
+
+  @property
+  def datastore_file(self) -> str:
+    return self._datastore_file
+
+  @property
+  def garbage(self) -> int:
+    """The number of bytes taken by superseded records."""
+    return self._garbage
+
+  @property
+  def size(self) -> int:
+    """The size of the log in bytes."""
+    return self._end
+
+  def _open(self) -> int:
+    """Opens the log and replays it into the index."""
+    fd = os.open(self._datastore_file, os.O_RDWR | os.O_CREAT, 0o600)
+    with open(fd, 'rb', closefd=False) as log:
+      buffer = log.read()
+
+    if not buffer:
+      os.write(fd, MAGIC)
+      buffer = MAGIC
+    elif not buffer.startswith(MAGIC):
+      os.close(fd)
+      raise ValueError(f'{self._datastore_file} is not a datastore log.')
+
+    end = len(MAGIC)
+    for offset, payload, length in _records(buffer, len(MAGIC)):
+      self._apply(payload['id'], 'doc' in payload, offset, length)
+      end = offset + length
+
+    if end < len(buffer):
+      # A torn or corrupt append, most likely from a crash.
+      os.ftruncate(fd, end)
+      os.fsync(fd)
+
+    self._end = end
+    return fd
+
+  def _apply(self, id: str, live: bool, offset: int, length: int) -> None:
+    """Points the index at a new record. The caller must hold the lock."""
+    if previous := self._index.pop(id, None):
+      self._garbage += previous[1]
+    if live:
+      self._index[id] = (offset, length)
+    else:
+      self._garbage += length
+
+  def _read(self, id: str) -> Optional[Dict[str, Any]]:
+    with self._lock:
+      if not (location := self._index.get(id)):
+        return None
+      offset, length = location
+      buffer = os.pread(self._fd, length, offset)
+
+    payload, _ = _decode(buffer, 0)
+    return payload['doc']
+
+  def _append(self,
+              changes: Mapping[str, Optional[Dict[str, Any]]]) -> None:
+    """Appends a record per change with a single write.
+
+    The caller must hold the lock.
+    """
+    records = [(id, document is not None, _encode(id, document))
+               for id, document in changes.items()]
+    os.pwrite(self._fd,
+              b''.join(record for _, _, record in records),
+              self._end)
+    if self._durability is not Durability.NONE:
+      os.fsync(self._fd)
+
+    for id, live, record in records:
+      self._apply(id, live, self._end, len(record))
+      self._end += len(record)
+
+    self._maybe_compact()
+
+  def _maybe_compact(self) -> None:
+    if self._end >= self._compact_min_size and \
+            self._garbage > self._compact_ratio * self._end and \
+            not (self._compaction and self._compaction.is_alive()):
+      self._compaction = threading.Thread(target=self._compact_in_background,
+                                          daemon=True)
+      self._compaction.start()
+
+  def _compact_in_background(self) -> None:
+    """Compacts the log, logging a failure: the old log is left in use."""
+    try:
+      self.compact()
+    except Exception as e:
+      logging.warning('Compacting %s failed: %s', self._datastore_file, e)
+
+  def compact(self) -> None:
+    """Rewrites the log with only its live records.
+
+    The live records are copied without holding the datastore's lock, so
+    reads and writes carry on meanwhile; records appended during the copy are
+    then carried over under the lock, and the new log replaces the old one
+    atomically. Once it has, the new log is used even if flushing the
+    directory entry to disk then fails, as the old one is no longer there.
+    """
+    with self._compaction_lock:
+      with self._lock:
+        index = dict(self._index)
+        end = self._end
+        fd = self._fd
+
+      temp = f'{self._datastore_file}.compact'
+      new_fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+      try:
+        new_index = {}
+        chunks = [MAGIC]
+        position = len(MAGIC)
+        for id, (offset, length) in sorted(index.items(),
+                                           key=lambda item: item[1][0]):
+          chunks.append(os.pread(fd, length, offset))
+          new_index[id] = (position, length)
+          position += length
+        os.write(new_fd, b''.join(chunks))
+
+        with self._lock:
+          garbage = 0
+          if self._end > end:
+            tail = os.pread(fd, self._end - end, end)
+            for offset, payload, length in _records(tail, 0):
+              if previous := new_index.pop(payload['id'], None):
+                garbage += previous[1]
+              if 'doc' in payload:
+                new_index[payload['id']] = (position, length)
+              else:
+                garbage += length
+              position += length
+            os.write(new_fd, tail)
+
+          os.fsync(new_fd)
+          os.replace(temp, self._datastore_file)
+          self._fd, self._index, self._end, self._garbage = \
+              new_fd, new_index, position, garbage
+
+      except BaseException:
+        os.close(new_fd)
+        if os.path.exists(temp):
+          os.unlink(temp)
+        raise
+
+      os.close(fd)
+      try:
+        sync_directory(
+            os.path.dirname(os.path.abspath(self._datastore_file)))
+      except OSError as e:
+        logging.warning('Syncing the directory of %s failed: %s',
+                        self._datastore_file, e)
+
+  def close(self) -> None:
+    """Waits for any compaction and closes the log."""
+    if self._compaction:
+      self._compaction.join()
+    with self._lock:
+      if self._fd is not None:
+        os.close(self._fd)
+        self._fd = None
+
+  def __enter__(self) -> LogStructured:
+    return self
+
+  def __exit__(self, *unused) -> None:
+    self.close()
+
+  def get_document(self, id: str, key: Optional[str] = None) -> Dict[str, Any]:
+    """Fetches a document.
+
+    Arguments:
+        id (str): document id
+        key: Optional(str): the document collection sub-key
+
+    Returns:
+        Dict[str, Any]: stored configuration dictionary, or None
+                          if not present
+    """
+    if parent := self._read(id):
+      if key:
+        value = parent.get(key)
+        return {key: value} if value else None
+      else:
+        return {id: parent}
+
+  def get_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents at once, decoding only those asked for.
+
+    Arguments:
+        ids (List[str]): the document ids
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id
+    """
+    return {id: document for id in ids
+            if (document := self._read(id)) is not None}
+
+  def store_document(self, id: str, document: Dict[str, Any]) -> None:
+    """Stores a document, replacing any with the same id.
+
+    Args:
+        id (str): the document id
+        document (Dict[str, Any]): the document
+    """
+    with self._lock:
+      self._append({id: document})
+
+  def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    If the document is not already there, it will be created as a net-new
+    document. If it is, it will be updated.
+
+    Args:
+        id (str): the id of the document within the collection.
+        new_data (Dict[str, Any]): the document content.
+    """
+    with self._lock:
+      self._append({id: (self._read(id) or {}) | new_data})
+
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents with a single append.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    with self._lock:
+      self._append(documents)
+    return {id: None for id in documents}
+
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents with a single append.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    with self._lock:
+      self._append({id: (self._read(id) or {}) | new_data
+                    for id, new_data in documents.items()})
+    return {id: None for id in documents}
+
+  def delete_document(self, id: str, key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    If a key is supplied, then just that key is removed from the document. If
+    no key is given, the entire document is removed. If neither is present,
+    nothing will happen.
+
+    Args:
+        id (str): the id of the document.
+        key (str, optional): the key to remove. Defaults to None.
+    """
+    with self._lock:
+      if (document := self._read(id)) is None:
+        return
+
+      if key:
+        if key in document:
+          document.pop(key)
+          self._append({id: document})
+      else:
+        self._append({id: None})
+
+  def list_documents(self, key: Optional[str] = None) -> List[str]:
+    """Lists documents.
+
+    Args:
+        key (str, optional): list the keys of this document instead of the
+                             document ids. Defaults to None.
+
+    Returns:
+        List[str]: the list
+    """
+    if key:
+      if document := self._read(key):
+        return list(document.keys())
+      return None
+
+    with self._lock:
+      return list(self._index) or None
+
+  def get_all_documents(self) -> Dict[str, Dict[str, Any]]:
+    """Fetches every document.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: all the documents, keyed by id
+    """
+    with self._lock:
+      return self.get_documents(list(self._index))
+
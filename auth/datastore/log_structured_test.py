@@ -0,0 +1,174 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from auth.datastore import log_structured
+from auth.datastore.contract_test import DatastoreContract, MASTER_CONFIG
+
+
+class LogStructuredTest(DatastoreContract, unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.datastore_file = os.path.join(self.directory.name, 'datastore.log')
+    self.datastore = self._open()
+    self.datastore.store_documents(MASTER_CONFIG)
+
+  def tearDown(self):
+    self.datastore.close()
+    self.directory.cleanup()
+
+  def _open(self, **kwargs) -> log_structured.LogStructured:
+    return log_structured.LogStructured(datastore_file=self.datastore_file,
+                                        durability='none', **kwargs)
+
+  def _reopen(self, **kwargs) -> log_structured.LogStructured:
+    self.datastore.close()
+    self.datastore = self._open(**kwargs)
+    return self.datastore
+
+  def _reader(self) -> log_structured.LogStructured:
+    return self._reopen()
+
+  def test_delete_document_missing(self):
+    size = self.datastore.size
+    self.datastore.delete_document(id='10011')
+    self.datastore.delete_document(id='auth', key='foo')
+    self.assertEqual(size, self.datastore.size)
+
+  def test_list_documents_in_write_order(self):
+    self.datastore.store_document(id='0000', document={'id': '0000'})
+    self.assertEqual(['auth', '0000'], self.datastore.list_documents())
+
+  def test_recovers_from_torn_append(self):
+    self.datastore.store_document(id='westley', document={'token': 'w'})
+    size = self.datastore.size
+    self.datastore.store_document(id='buttercup', document={'token': 'b'})
+    self.datastore.close()
+    os.truncate(self.datastore_file, self.datastore.size - 3)
+
+    datastore = self._reopen()
+    self.assertEqual(size, datastore.size)
+    self.assertEqual(size, os.path.getsize(self.datastore_file))
+    self.assertIsNotNone(datastore.get_document('westley'))
+    self.assertIsNone(datastore.get_document('buttercup'))
+
+    datastore.store_document(id='inigo', document={'token': 'i'})
+    self.assertIsNotNone(self._reopen().get_document('inigo'))
+
+  def test_recovers_from_corrupt_record(self):
+    size = self.datastore.size
+    self.datastore.store_document(id='westley', document={'token': 'w'})
+    self.datastore.close()
+    with open(self.datastore_file, 'r+b') as log:
+      log.seek(-2, os.SEEK_END)
+      log.write(b'!!')
+
+    datastore = self._reopen()
+    self.assertEqual(size, datastore.size)
+    self.assertIsNone(datastore.get_document('westley'))
+    self.assertEqual(MASTER_CONFIG, datastore.get_document('auth'))
+
+  def test_not_a_log(self):
+    other = os.path.join(self.directory.name, 'datastore.json')
+    with open(other, 'w') as f:
+      f.write('{}')
+
+    with self.assertRaises(ValueError):
+      log_structured.LogStructured(datastore_file=other)
+
+  def test_compact(self):
+    for i in range(100):
+      self.datastore.store_document(id='westley', document={'token': i})
+    self.datastore.delete_document(id='auth')
+    size = self.datastore.size
+
+    self.datastore.compact()
+
+    self.assertEqual(0, self.datastore.garbage)
+    self.assertLess(self.datastore.size, size / 10)
+    self.assertEqual(self.datastore.size, os.path.getsize(self.datastore_file))
+    datastore = self._reopen()
+    self.assertEqual({'westley': {'token': 99}},
+                     datastore.get_document('westley'))
+    self.assertIsNone(datastore.get_document('auth'))
+
+  def test_compact_directory_sync_fails(self):
+    for i in range(100):
+      self.datastore.store_document(id='westley', document={'token': i})
+
+    with mock.patch.object(log_structured, 'sync_directory',
+                           side_effect=OSError('inconceivable')):
+      with self.assertLogs(level='WARNING'):
+        self.datastore.compact()
+
+    self.assertEqual(0, self.datastore.garbage)
+    self.datastore.store_document(id='inigo', document={'token': 'i'})
+    datastore = self._reopen()
+    self.assertEqual({'westley': {'token': 99}},
+                     datastore.get_document('westley'))
+    self.assertIsNotNone(datastore.get_document('inigo'))
+
+  def test_background_compaction_failure_logged(self):
+    datastore = self._reopen(compact_min_size=1024, compact_ratio=0.5)
+    with mock.patch.object(log_structured.os, 'replace',
+                           side_effect=OSError('inconceivable')):
+      with self.assertLogs(level='WARNING') as logs:
+        for i in range(200):
+          datastore.store_document(id=f'user{i % 10}', document={'token': i})
+        datastore.close()
+
+    self.assertIn('Compacting', logs.output[0])
+    self.assertFalse(os.path.exists(f'{self.datastore_file}.compact'))
+    datastore = self._reopen()
+    self.assertEqual({'user9': {'token': 199}}, datastore.get_document('user9'))
+
+  def test_background_compaction(self):
+    datastore = self._reopen(compact_min_size=1024, compact_ratio=0.5)
+    for i in range(200):
+      datastore.store_document(id=f'user{i % 10}', document={'token': i})
+    datastore.close()
+
+    self.assertLess(os.path.getsize(self.datastore_file), 4096)
+    datastore = self._reopen()
+    self.assertEqual({'user9': {'token': 199}}, datastore.get_document('user9'))
+    self.assertEqual(11, len(datastore.list_documents()))
+
+  def test_writes_during_compaction(self):
+    datastore = self._reopen(compact_min_size=1024, compact_ratio=0.2)
+
+    def _write(name: str) -> None:
+      for i in range(200):
+        datastore.update_document(id=f'{name}{i % 20}', new_data={'token': i})
+
+    threads = [threading.Thread(target=_write, args=(name,))
+               for name in ['westley', 'buttercup', 'inigo', 'fezzik']]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    datastore.compact()
+
+    datastore = self._reopen()
+    self.assertEqual(81, len(datastore.list_documents()))
+    for name in ['westley', 'buttercup', 'inigo', 'fezzik']:
+      self.assertEqual({'token': 199},
+                       datastore.get_document(f'{name}19')[f'{name}19'])
+
+
+if __name__ == '__main__':
+  unittest.main()
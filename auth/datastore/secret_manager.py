@@ -14,23 +14,134 @@
 from __future__ import annotations
 from io import BytesIO
 
+import asyncio
 import json
-from typing import Any, List, Mapping, Optional, Type
+import logging
+import threading
+from concurrent import futures
+from typing import Any, Callable, Dict, List, Mapping, Optional, Type
 
+from google.api_core import exceptions
 from google.cloud import secretmanager, secretmanager_v1
 from google.cloud.secretmanager_v1.types import resources
 from google.cloud.secretmanager_v1.services.secret_manager_service import pagers
 
 from auth import decorators
 from auth.abstract_datastore import AbstractDatastore
+from auth.async_abstract_datastore import AsyncAbstractDatastore
+
+
+# Clients shared by every `SecretManager(shared_client=True)` in the process,
+# keyed by project.
+_shared_clients: Dict[str, secretmanager.SecretManagerServiceClient] = {}
+_shared_clients_lock = threading.Lock()
+
+
+class _Janitor(object):
+  """Prunes old secret versions on a background thread.
+
+  `schedule` records that a secret's versions older than a time should be
+  destroyed and returns at once. Several updates of one secret before the
+  thread gets to it are pruned together, by the newest of their times.
+  """
+
+  def __init__(self, prune: Callable[[str, Any], None]) -> _Janitor:
+    self._prune = prune
+    self._pending: Dict[str, Any] = {}
+    self._active = 0
+    self._condition = threading.Condition()
+    self._stopping = False
+    self._thread: Optional[threading.Thread] = None
+
+  def schedule(self, id: str, before: Any) -> None:
+    """Queues the pruning of the versions of `id` created before `before`."""
+    with self._condition:
+      if id not in self._pending or self._pending[id] < before:
+        self._pending[id] = before
+      if not self._thread:
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='secret-manager-janitor',
+                                        daemon=True)
+        self._thread.start()
+      self._condition.notify_all()
+
+  def _run(self) -> None:
+    while True:
+      with self._condition:
+        self._condition.wait_for(lambda: self._pending or self._stopping)
+        if not self._pending:
+          return
+        id = next(iter(self._pending))
+        before = self._pending.pop(id)
+        self._active += 1
+
+      try:
+        self._prune(id, before)
+      except Exception as e:
+        logging.warning('Pruning the old versions of %s failed: %s', id, e)
+      finally:
+        with self._condition:
+          self._active -= 1
+          self._condition.notify_all()
+
+  def flush(self, timeout: Optional[float] = None) -> bool:
+    """Waits for everything queued to be pruned.
+
+    Returns:
+        bool: True if nothing is left, False if `timeout` passed first
+    """
+    with self._condition:
+      return self._condition.wait_for(
+          lambda: not self._pending and not self._active, timeout)
+
+  def stop(self) -> None:
+    """Prunes everything queued, then stops the thread."""
+    with self._condition:
+      thread, self._thread = self._thread, None
+      self._stopping = True
+      self._condition.notify_all()
+    if thread:
+      thread.join()
 
 
 class SecretManager(AbstractDatastore):
+  """A datastore for storing auth credentials in Secret Manager.
+
+  Each `SecretManagerServiceClient` opens its own gRPC channel, so the client
+  is created once, on first use, and reused for every call the datastore
+  makes. With `shared_client` set, one client per project is shared by every
+  such datastore in the process instead.
+
+  Every update adds a new version and then destroys the older ones, as each
+  enabled version is billed. They are destroyed in parallel, at most
+  `prune_workers` at a time across the datastore. With `defer_pruning` set,
+  `update_document` returns as soon as the new version is added and a
+  background thread destroys the old ones; `flush` waits for it.
+
+  The datastore can be used as a context manager, closing its client (unless
+  shared) on exit.
+  """
 
   def __init__(self, email: str = None,
-               project: str = None) -> AbstractDatastore:
+               project: str = None,
+               shared_client: bool = False,
+               prune_workers: int = 8,
+               defer_pruning: bool = False) -> AbstractDatastore:
     self._project = project
     self._email = email
+    self._shared_client = shared_client
+    self._client: Optional[secretmanager.SecretManagerServiceClient] = None
+    self._client_lock = threading.Lock()
+    self._prune_workers = prune_workers
+    self._pruner: Optional[futures.ThreadPoolExecutor] = None
+    self._janitor = _Janitor(self._prune) if defer_pruning else None
+
+  def __enter__(self) -> SecretManager:
+    return self
+
+  def __exit__(self, *unused) -> None:
+    self.close()
 
   @decorators.lazy_property
   def parent(self) -> str:
@@ -38,7 +149,42 @@ class SecretManager(AbstractDatastore):
 
   @property
   def client(self) -> secretmanager.SecretManagerServiceClient:
-    return secretmanager.SecretManagerServiceClient()
+    """The Secret Manager client, created on first use."""
+    if self._client is None:
+      with self._client_lock:
+        if self._client is None:
+          self._client = self._shared() if self._shared_client \
+              else secretmanager.SecretManagerServiceClient()
+    return self._client
+
+  def _shared(self) -> secretmanager.SecretManagerServiceClient:
+    """Fetches (creating if need be) the process-wide client for the project.
+    """
+    with _shared_clients_lock:
+      if (client := _shared_clients.get(self._project)) is None:
+        client = _shared_clients[self._project] = \
+            secretmanager.SecretManagerServiceClient()
+      return client
+
+  def close(self) -> None:
+    """Closes the client's channel.
+
+    Any deferred pruning is finished first. A shared client is left open, as
+    other datastores may be using it. The next call made through this
+    datastore creates a new client.
+    """
+    if self._janitor:
+      self._janitor.stop()
+
+    with self._client_lock:
+      client, self._client = self._client, None
+      pruner, self._pruner = self._pruner, None
+
+    if pruner is not None:
+      pruner.shutdown()
+
+    if client is not None and not self._shared_client:
+      client.transport.close()
 
   def list_documents(self, report_type: Optional[Type] = None,
                      key: Optional[str] = None) -> List[str]:
@@ -47,7 +193,7 @@ class SecretManager(AbstractDatastore):
     secrets = list([secret.name for secret in all_secrets])
     return secrets
 
-  def create_secret(self, id: str,
+  def create_secret(self, id: str, *unused_args: Any,
                     **unused: Mapping[str, Any]) -> resources.Secret:
     """
     Create a new secret with the given name. A secret is a logical wrapper
@@ -94,7 +240,8 @@ class SecretManager(AbstractDatastore):
     Update a document in Secret Manager. If the document is not already there,
     it will be created as a net-new document. If it is, it will be updated.
 
-    As this is a specific 'update' request, remove any other enabled versions.
+    As this is a specific 'update' request, remove any other enabled versions:
+    at once, or by the background janitor if pruning is deferred.
 
     Args:
         id (str): the id of the document.
@@ -104,42 +251,107 @@ class SecretManager(AbstractDatastore):
     new_version: resources.SecretVersion = self.store_document(
         id=id, type=type, document=new_data)
 
-    latest = self._get_latest(id)
+    if self._janitor:
+      self._janitor.schedule(id, new_version.create_time)
+    else:
+      self._prune(id, new_version.create_time)
+
+  def flush(self, timeout: Optional[float] = None) -> bool:
+    """Waits for deferred pruning to finish.
+
+    Args:
+        timeout (float, optional): the most seconds to wait, None for ever
+
+    Returns:
+        bool: True if no pruning is left to do
+    """
+    return self._janitor.flush(timeout) if self._janitor else True
 
-    # Destroy all versions other than the latest for cost reasons..
+  def _prune(self, id: str, before: Any) -> None:
+    """Destroys the enabled versions of a secret created before `before`.
+
+    The versions are listed a page at a time and destroyed in parallel, in
+    the datastore's pool of `prune_workers` threads. The new version is
+    already written, so one failing does not stop the others; failures are
+    logged.
+    """
     request = secretmanager_v1.ListSecretVersionsRequest(
         parent=self.client.secret_path(project=self._project, secret=id),
-        filter=f'state:enabled'  # AND name!="{latest.name}"'
-    )
+        filter='state:enabled')
     version_list = self.client.list_secret_versions(request=request)
-    for page in version_list.pages:
-      for version in page.versions:
-        # Only delete older versions
-        if version.create_time < new_version.create_time:
-          self.client.destroy_secret_version(
-              secretmanager_v1.DestroySecretVersionRequest(
-                  name=version.name
-              ))
-
-  def _get_latest(self, id: str) -> resources.SecretVersion:
-    """Fetches the latest secret version.
+    names = [version.name
+             for page in version_list.pages
+             for version in page.versions
+             if version.create_time < before]
+
+    def destroy(name: str) -> Optional[Exception]:
+      try:
+        self.client.destroy_secret_version(
+            secretmanager_v1.DestroySecretVersionRequest(name=name))
+        return None
+      except Exception as e:
+        return e
+
+    if len(names) > 1:
+      results = list(self._pruning_pool().map(destroy, names))
+    else:
+      results = [destroy(name) for name in names]
+
+    for name, result in zip(names, results):
+      if result is not None:
+        logging.warning('Destroying %s failed: %s', name, result)
+
+  def _pruning_pool(self) -> futures.ThreadPoolExecutor:
+    """The pool old versions are destroyed in, created on first use."""
+    with self._client_lock:
+      if self._pruner is None:
+        self._pruner = futures.ThreadPoolExecutor(
+            max_workers=self._prune_workers,
+            thread_name_prefix='secret-manager-pruner')
+      return self._pruner
+
+  def store_documents(self, documents: Mapping[str, Mapping[str, Any]],
+                      max_workers: int = 16) -> Dict[str, Optional[Exception]]:
+    """Stores many documents, adding their versions in parallel.
 
     Arguments:
-        id (str): document id.
+        documents (Mapping[str, Mapping[str, Any]]): the documents, keyed by id
+        max_workers (int): the maximum number of concurrent writes
 
     Returns:
-        SecretVersion: the latest version of the stored secret.
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that stopped it
     """
-    secret = self.client.secret_version_path(project=self._project,
-                                             secret=id,
-                                             secret_version='latest')
-    try:
-      request = secretmanager_v1.GetSecretVersionRequest(name=secret)
-      response = self.client.get_secret_version(request=request)
-      return response
-    except Exception as e:
-      print(e)
-      return None
+    return self._write_parallel(self.store_document, documents, max_workers)
+
+  def update_documents(self, documents: Mapping[str, Mapping[str, Any]],
+                       max_workers: int = 16
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates many documents in parallel.
+
+    Arguments:
+        documents (Mapping[str, Mapping[str, Any]]): the new data, keyed by id
+        max_workers (int): the maximum number of concurrent writes
+
+    Returns:
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that stopped it
+    """
+    return self._write_parallel(self.update_document, documents, max_workers)
+
+  def _write_parallel(self, write: Callable[..., Any],
+                      documents: Mapping[str, Mapping[str, Any]],
+                      max_workers: int) -> Dict[str, Optional[Exception]]:
+    """Runs `write` for each document in a bounded pool."""
+    def _write(id: str) -> Optional[Exception]:
+      try:
+        write(id, documents[id])
+        return None
+      except Exception as e:
+        return e
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+      return dict(zip(documents, pool.map(_write, documents)))
 
   def get_document(self, id: str, type: Optional[Type] = None,
                    key: Optional[str] = None) -> Mapping[str, Any]:
@@ -167,6 +379,25 @@ class SecretManager(AbstractDatastore):
       print(e)
       return None
 
+  def get_documents(self, ids: List[str],
+                    max_workers: int = 16) -> Dict[str, Mapping[str, Any]]:
+    """Fetches many documents.
+
+    Secret Manager has no batch read, so the secrets are accessed in parallel,
+    at most `max_workers` at a time, over the datastore's single client.
+
+    Arguments:
+        ids (List[str]): the document ids
+        max_workers (int): the maximum number of concurrent reads
+
+    Returns:
+        Dict[str, Mapping[str, Any]]: the documents found, keyed by id
+    """
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+      documents = pool.map(lambda id: self.get_document(id=id), ids)
+      return {id: document for id, document in zip(ids, documents)
+              if document is not None}
+
   def delete_document(self, id: str, type: Optional[Type] = None,
                       key: Optional[str] = None) -> None:
     """Deletes a document.
@@ -191,3 +422,199 @@ class SecretManager(AbstractDatastore):
       delete = self.client.delete_secret
 
     delete(request=request)
+
+
+class AsyncSecretManager(AsyncAbstractDatastore):
+  """The asyncio version of `SecretManager`.
+
+  This uses `SecretManagerServiceAsyncClient`, so every call is made on the
+  event loop over the client's asynchronous gRPC channel. Old versions are
+  pruned as in `SecretManager`: at most `prune_workers` are destroyed at a
+  time and, with `defer_pruning` set, `update_document` returns as soon as
+  the new version is added while a background task destroys the old ones;
+  `flush` waits for it.
+
+  The datastore can be used as an async context manager, closing its client
+  on exit.
+  """
+
+  def __init__(self, email: str = None,
+               project: str = None,
+               prune_workers: int = 8,
+               defer_pruning: bool = False) -> AsyncAbstractDatastore:
+    self._project = project
+    self._email = email
+    self._prune_workers = prune_workers
+    self._defer_pruning = defer_pruning
+    self._pending: Dict[str, Any] = {}
+    self._janitor: Optional[asyncio.Task] = None
+    self._client: Optional[secretmanager.SecretManagerServiceAsyncClient] = \
+        None
+
+  async def __aenter__(self) -> AsyncSecretManager:
+    return self
+
+  async def __aexit__(self, *unused) -> None:
+    await self.close()
+
+  @decorators.lazy_property
+  def parent(self) -> str:
+    return f'projects/{self._project}'
+
+  @property
+  def client(self) -> secretmanager.SecretManagerServiceAsyncClient:
+    """The Secret Manager client, created on first use."""
+    if self._client is None:
+      self._client = secretmanager.SecretManagerServiceAsyncClient()
+    return self._client
+
+  async def close(self) -> None:
+    """Closes the client's channel.
+
+    Any deferred pruning is finished first. The next call made through this
+    datastore creates a new client.
+    """
+    await self.flush()
+
+    client, self._client = self._client, None
+    if client is not None:
+      await client.transport.close()
+
+  async def list_documents(self, report_type: Optional[Type] = None,
+                           key: Optional[str] = None) -> List[str]:
+    request = secretmanager_v1.ListSecretsRequest(parent=self.parent)
+    all_secrets = await self.client.list_secrets(request=request)
+    return [secret.name async for secret in all_secrets]
+
+  async def create_secret(self, id: str, *unused_args: Any,
+                          **unused: Mapping[str, Any]) -> resources.Secret:
+    """Creates a new secret with the given name.
+
+    See `SecretManager.create_secret`.
+    """
+    secret = secretmanager.Secret(replication=secretmanager.Replication(
+        automatic=secretmanager.Replication.Automatic()))
+    request = secretmanager_v1.CreateSecretRequest(parent=self.parent,
+                                                   secret_id=id,
+                                                   secret=secret)
+    return await self.client.create_secret(request=request)
+
+  @decorators.async_implicit_create(creator=create_secret)
+  async def store_document(self, id: str, document: Mapping[str, Any],
+                           type: Optional[Type] = None
+                           ) -> resources.SecretVersion:
+    """Stores a document.
+
+    See `SecretManager.store_document`.
+    """
+    payload = secretmanager_v1.SecretPayload(
+        data=bytes(json.dumps(document), 'utf-8'))
+    request = secretmanager_v1.AddSecretVersionRequest(
+        parent=self.client.secret_path(self._project, id),
+        payload=payload)
+    return await self.client.add_secret_version(request=request)
+
+  async def update_document(self, id: str, new_data: Mapping[str, Any],
+                            type: Optional[Type] = None) -> None:
+    """Updates a document.
+
+    Adds a new version, then destroys all older enabled versions
+    concurrently. See `SecretManager.update_document`.
+    """
+    new_version: resources.SecretVersion = await self.store_document(
+        id=id, type=type, document=new_data)
+
+    if self._defer_pruning:
+      self._schedule(id, new_version.create_time)
+    else:
+      await self._prune(id, new_version.create_time)
+
+  def _schedule(self, id: str, before: Any) -> None:
+    """Queues the pruning of the versions of `id` created before `before`.
+
+    As with `SecretManager`'s janitor, updates of one secret made before the
+    task gets to it are pruned together.
+    """
+    if id not in self._pending or self._pending[id] < before:
+      self._pending[id] = before
+    if self._janitor is None or self._janitor.done():
+      self._janitor = asyncio.ensure_future(self._run_janitor())
+
+  async def _run_janitor(self) -> None:
+    while self._pending:
+      id = next(iter(self._pending))
+      before = self._pending.pop(id)
+      try:
+        await self._prune(id, before)
+      except Exception as e:
+        logging.warning('Pruning the old versions of %s failed: %s', id, e)
+
+  async def flush(self) -> None:
+    """Waits for deferred pruning to finish."""
+    if self._janitor is not None:
+      await asyncio.shield(self._janitor)
+
+  async def _prune(self, id: str, before: Any) -> None:
+    """Destroys the enabled versions of a secret created before `before`.
+
+    At most `prune_workers` destroys are in flight at once. One failing does
+    not stop the others; failures are logged.
+    """
+    request = secretmanager_v1.ListSecretVersionsRequest(
+        parent=self.client.secret_path(project=self._project, secret=id),
+        filter='state:enabled')
+    version_list = await self.client.list_secret_versions(request=request)
+    names = [version.name async for version in version_list
+             if version.create_time < before]
+    semaphore = asyncio.Semaphore(self._prune_workers)
+
+    async def _destroy(name: str) -> None:
+      async with semaphore:
+        await self.client.destroy_secret_version(
+            secretmanager_v1.DestroySecretVersionRequest(name=name))
+
+    results = await asyncio.gather(*[_destroy(name) for name in names],
+                                   return_exceptions=True)
+    for name, result in zip(names, results):
+      if isinstance(result, Exception):
+        logging.warning('Destroying %s failed: %s', name, result)
+
+  async def get_document(self, id: str, type: Optional[Type] = None,
+                         key: Optional[str] = None) -> Mapping[str, Any]:
+    """Fetches a document.
+
+    See `SecretManager.get_document`.
+    """
+    secret = self.client.secret_version_path(project=self._project,
+                                             secret=id,
+                                             secret_version='latest')
+    try:
+      request = secretmanager_v1.AccessSecretVersionRequest(name=secret)
+      response = await self.client.access_secret_version(request=request)
+      return json.loads(response.payload.data.decode('utf-8'))
+
+    except exceptions.NotFound:
+      return None
+
+    except Exception as e:
+      logging.error('Reading secret %s failed: %s', id, e)
+      raise
+
+  async def delete_document(self, id: str, type: Optional[Type] = None,
+                            key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    See `SecretManager.delete_document`.
+    """
+    if key:
+      request = secretmanager_v1.DestroySecretVersionRequest(
+          name=self.client.secret_version_path(project=self._project,
+                                               secret=id, secret_version=key))
+      delete = self.client.destroy_secret_version
+
+    else:
+      request = secretmanager_v1.DeleteSecretRequest(
+          name=self.client.secret_path(project=self._project, secret=id))
+      delete = self.client.delete_secret
+
+    await delete(request=request)
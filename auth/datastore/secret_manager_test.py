@@ -0,0 +1,315 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import json
+import threading
+import unittest
+from typing import List
+from unittest import mock
+
+from google.api_core import exceptions
+from google.cloud.secretmanager_v1.types import resources
+from google.protobuf import timestamp_pb2
+
+from auth.datastore import secret_manager
+
+CLIENT = 'google.cloud.secretmanager.SecretManagerServiceClient'
+ASYNC_CLIENT = 'google.cloud.secretmanager.SecretManagerServiceAsyncClient'
+
+
+def _version(name: str, seconds: int) -> resources.SecretVersion:
+  return resources.SecretVersion(
+      name=name, create_time=timestamp_pb2.Timestamp(seconds=seconds))
+
+
+def _payload(document):
+  response = mock.MagicMock()
+  response.payload.data = json.dumps(document).encode('utf-8')
+  return response
+
+
+class SecretManagerTest(unittest.TestCase):
+  def setUp(self):
+    self.client_class = mock.patch(CLIENT).start()
+    client = self.client_class.return_value
+    client.secret_path.side_effect = \
+        lambda project, secret: f'projects/{project}/secrets/{secret}'
+    client.secret_version_path.side_effect = \
+        lambda project, secret, secret_version: \
+        f'projects/{project}/secrets/{secret}/versions/{secret_version}'
+    client.add_secret_version.return_value = _version('new', 100)
+    client.list_secret_versions.return_value.pages = []
+    secret_manager._shared_clients.clear()
+
+  def tearDown(self):
+    mock.patch.stopall()
+    secret_manager._shared_clients.clear()
+
+  def test_client_created_once(self):
+    datastore = secret_manager.SecretManager(project='florin')
+    datastore.update_document('id', {'token': 'token'})
+    datastore.get_document('id')
+    self.client_class.assert_called_once()
+
+  def test_get_documents(self):
+    client = self.client_class.return_value
+    client.access_secret_version.side_effect = lambda request: \
+        _payload({'name': request.name}) if 'westley' in request.name \
+        else (_ for _ in ()).throw(exceptions.NotFound('missing'))
+
+    datastore = secret_manager.SecretManager(project='florin')
+    documents = datastore.get_documents(['westley', 'vizzini'])
+
+    self.assertEqual(['westley'], list(documents))
+    self.client_class.assert_called_once()
+
+  def test_store_documents_partial_failure(self):
+    client = self.client_class.return_value
+    client.add_secret_version.side_effect = lambda request: \
+        _version('new', 100) if 'westley' in request.parent \
+        else (_ for _ in ()).throw(RuntimeError('inconceivable'))
+    client.create_secret.return_value = None
+
+    datastore = secret_manager.SecretManager(project='florin')
+    results = datastore.store_documents({'westley': {'token': 'token'},
+                                         'vizzini': {'token': 'token'}})
+
+    self.assertIsNone(results['westley'])
+    self.assertIsInstance(results['vizzini'], RuntimeError)
+
+  def test_shared_client(self):
+    first = secret_manager.SecretManager(project='florin', shared_client=True)
+    second = secret_manager.SecretManager(project='florin', shared_client=True)
+    other = secret_manager.SecretManager(project='guilder', shared_client=True)
+
+    self.assertIs(first.client, second.client)
+    other.client
+    self.assertEqual(2, self.client_class.call_count)
+
+  def test_close(self):
+    with secret_manager.SecretManager(project='florin') as datastore:
+      client = datastore.client
+    client.transport.close.assert_called_once()
+
+  def test_close_shared_client_left_open(self):
+    with secret_manager.SecretManager(project='florin',
+                                      shared_client=True) as datastore:
+      client = datastore.client
+    client.transport.close.assert_not_called()
+
+
+  def _versions(self, *versions: resources.SecretVersion) -> None:
+    page = mock.MagicMock()
+    page.versions = list(versions)
+    self.client_class.return_value.list_secret_versions.return_value.pages = \
+        [page]
+
+  def _destroyed(self) -> List[str]:
+    client = self.client_class.return_value
+    return sorted(c.args[0].name
+                  for c in client.destroy_secret_version.call_args_list)
+
+  def test_update_document_destroys_older_versions(self):
+    self._versions(_version('old1', 10), _version('old2', 20),
+                   _version('old3', 30), _version('new', 100))
+
+    datastore = secret_manager.SecretManager(project='florin')
+    datastore.update_document('westley', {'token': 'token'})
+
+    self.assertEqual(['old1', 'old2', 'old3'], self._destroyed())
+    self.client_class.return_value.get_secret_version.assert_not_called()
+
+  def test_update_document_destroy_failure_logged(self):
+    self._versions(_version('old1', 10), _version('old2', 20),
+                   _version('new', 100))
+
+    def _destroy(request):
+      if request.name == 'old1':
+        raise RuntimeError('inconceivable')
+
+    self.client_class.return_value.destroy_secret_version.side_effect = \
+        _destroy
+
+    with secret_manager.SecretManager(project='florin') as datastore:
+      with self.assertLogs(level='WARNING') as logs:
+        datastore.update_document('westley', {'token': 'token'})
+
+    self.assertEqual(['old1', 'old2'], self._destroyed())
+    self.assertIn('old1', logs.output[0])
+
+  def test_deferred_pruning(self):
+    self._versions(_version('old', 10), _version('new', 100))
+    release = threading.Event()
+    client = self.client_class.return_value
+    client.destroy_secret_version.side_effect = lambda request: release.wait()
+
+    with secret_manager.SecretManager(project='florin',
+                                      defer_pruning=True) as datastore:
+      datastore.update_document('westley', {'token': 'token'})
+      client.add_secret_version.assert_called_once()
+      self.assertFalse(datastore.flush(timeout=0.1))
+
+      release.set()
+      self.assertTrue(datastore.flush(timeout=5))
+      self.assertEqual(['old'], self._destroyed())
+
+  def test_deferred_pruning_failure_logged(self):
+    self._versions(_version('old', 10), _version('new', 100))
+    client = self.client_class.return_value
+    client.destroy_secret_version.side_effect = RuntimeError('inconceivable')
+
+    datastore = secret_manager.SecretManager(project='florin',
+                                             defer_pruning=True)
+    with self.assertLogs(level='WARNING'):
+      datastore.update_document('westley', {'token': 'token'})
+      self.assertTrue(datastore.flush(timeout=5))
+    datastore.close()
+
+
+class AsyncSecretManagerTest(unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    self.client = mock.patch(ASYNC_CLIENT).start().return_value
+    self.client.secret_path.side_effect = \
+        lambda project, secret: f'projects/{project}/secrets/{secret}'
+    self.client.secret_version_path.side_effect = \
+        lambda project, secret, secret_version: \
+        f'projects/{project}/secrets/{secret}/versions/{secret_version}'
+    self.client.add_secret_version = mock.AsyncMock(
+        return_value=_version('new', 100))
+    self.client.create_secret = mock.AsyncMock()
+    self.client.access_secret_version = mock.AsyncMock()
+    self.client.destroy_secret_version = mock.AsyncMock()
+
+  def tearDown(self):
+    mock.patch.stopall()
+
+  async def test_get_document(self):
+    self.client.access_secret_version.return_value = \
+        _payload({'token': 'token'})
+
+    datastore = secret_manager.AsyncSecretManager(project='florin')
+    self.assertEqual({'token': 'token'}, await datastore.get_document('id'))
+
+  async def test_close(self):
+    self.client.transport.close = mock.AsyncMock()
+
+    async with secret_manager.AsyncSecretManager(project='florin') \
+        as datastore:
+      self.assertIs(self.client, datastore.client)
+
+    self.client.transport.close.assert_awaited_once()
+
+  async def test_close_unused_client(self):
+    async with secret_manager.AsyncSecretManager(project='florin'):
+      pass
+
+    self.assertFalse(self.client.transport.close.called)
+
+  async def test_get_document_missing(self):
+    self.client.access_secret_version.side_effect = \
+        exceptions.NotFound('missing')
+
+    datastore = secret_manager.AsyncSecretManager(project='florin')
+    self.assertIsNone(await datastore.get_document('id'))
+
+  async def test_store_document_creates_secret(self):
+    self.client.add_secret_version.side_effect = [
+        exceptions.NotFound('missing'), _version('new', 100)]
+
+    datastore = secret_manager.AsyncSecretManager(project='florin')
+    version = await datastore.store_document('id', {'token': 'token'})
+
+    self.client.create_secret.assert_awaited_once()
+    self.assertEqual('new', version.name)
+
+  async def test_update_document_destroys_older_versions(self):
+    async def _versions():
+      for version in [_version('new', 100), _version('old1', 50),
+                      _version('old2', 60)]:
+        yield version
+
+    self.client.list_secret_versions = mock.AsyncMock(
+        return_value=_versions())
+
+    datastore = secret_manager.AsyncSecretManager(project='florin')
+    await datastore.update_document('id', {'token': 'token'})
+
+    destroyed = [c.args[0].name for c in
+                 self.client.destroy_secret_version.await_args_list]
+    self.assertEqual(['old1', 'old2'], destroyed)
+
+  async def test_update_document_bounded_destroys(self):
+    async def _versions():
+      for i in range(20):
+        yield _version(f'old{i}', i)
+
+    in_flight = peak = 0
+
+    async def _destroy(request):
+      nonlocal in_flight, peak
+      in_flight += 1
+      peak = max(peak, in_flight)
+      await asyncio.sleep(0.01)
+      in_flight -= 1
+      if request.name == 'old3':
+        raise exceptions.PermissionDenied('inconceivable')
+
+    self.client.list_secret_versions = mock.AsyncMock(
+        return_value=_versions())
+    self.client.destroy_secret_version.side_effect = _destroy
+
+    datastore = secret_manager.AsyncSecretManager(project='florin',
+                                                  prune_workers=4)
+    with self.assertLogs(level='WARNING'):
+      await datastore.update_document('id', {'token': 'token'})
+
+    self.assertEqual(4, peak)
+    self.assertEqual(20, self.client.destroy_secret_version.await_count)
+
+  async def test_deferred_pruning(self):
+    release = asyncio.Event()
+
+    async def _versions():
+      yield _version('old', 10)
+
+    async def _destroy(request):
+      await release.wait()
+
+    self.client.list_secret_versions = mock.AsyncMock(
+        side_effect=lambda request: _versions())
+    self.client.destroy_secret_version.side_effect = _destroy
+
+    datastore = secret_manager.AsyncSecretManager(project='florin',
+                                                  defer_pruning=True)
+    await datastore.update_document('id', {'token': 'token'})
+    await datastore.update_document('id', {'token': 'token'})
+    self.client.add_secret_version.assert_awaited()
+    self.assertEqual(0, self.client.destroy_secret_version.await_count)
+
+    release.set()
+    await datastore.flush()
+    self.assertEqual(1, self.client.list_secret_versions.await_count)
+    self.assertEqual(1, self.client.destroy_secret_version.await_count)
+
+  async def test_get_document_error_raised(self):
+    self.client.access_secret_version.side_effect = \
+        exceptions.PermissionDenied('inconceivable')
+
+    datastore = secret_manager.AsyncSecretManager(project='florin')
+    with self.assertRaises(exceptions.PermissionDenied):
+      await datastore.get_document('id')
+
+
+if __name__ == '__main__':
+  unittest.main()
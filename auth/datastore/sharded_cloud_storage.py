@@ -0,0 +1,421 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import dataclasses
+import itertools
+import random
+import threading
+import time
+import zlib
+from concurrent import futures
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, \
+    Tuple
+from urllib import parse
+
+import gcsfs
+from auth.abstract_datastore import AbstractDatastore
+from auth.datastore import codecs
+from auth.datastore.cloud_storage import ContentionStats, api_url, filesystem
+
+
+class ShardedCloudStorage(AbstractDatastore):
+  """A datastore keeping its documents in many GCS objects under a prefix.
+
+  By default every document is its own object, `<prefix><id>`, so
+  refreshing one user's token uploads only that token, and writers of
+  different documents never contend for an object (GCS allows about one
+  write a second to any one object). With `shards`, ids are instead hashed
+  into that many objects, `<prefix><shard>`, each holding a map of id to
+  document; that bounds the number of objects for very many small documents.
+  Names carry no extension: the codec is read from each object's header, so
+  the codec can change without renaming any object.
+
+  Every change other than replacing a whole single-document object is a read
+  followed by an upload conditional on the generation read, retried (up to
+  `max_attempts` times, with a randomized exponential backoff) if another
+  writer got there first, just as `CloudStorage` does. The methods taking
+  many ids read and write their objects in parallel. With one object per
+  document, `list_documents` only lists the prefix; with `shards` it has to
+  read every shard.
+
+  Nothing is cached: every read goes to GCS.
+
+  Args:
+      project (str): the GCP project
+      bucket (str): the bucket
+      prefix (str): the object name prefix
+      shards (int): hash ids into this many objects; None (the default)
+                    gives each document its own object
+      max_workers (int): the most objects read or written at once
+      max_attempts (int): uploads to try before a write fails
+      backoff (float): the longest wait, in seconds, before the first retry;
+                       it doubles for each retry after that
+      codec (codecs.Codec): how objects are written; compact JSON by default
+  """
+
+  def __init__(self,
+               project: str,
+               bucket: str,
+               email: str = None,
+               prefix: str = 'datastore/',
+               shards: Optional[int] = None,
+               max_workers: int = 16,
+               max_attempts: int = 5,
+               backoff: float = 0.1,
+               codec: Optional[codecs.Codec] = None) -> AbstractDatastore:
+    self._project = project
+    self._email = email
+    self._bucket = bucket
+    self._prefix = prefix
+    self._shards = shards
+    self._max_workers = max_workers
+    self._max_attempts = max_attempts
+    self._backoff = backoff
+    self._codec = codec or codecs.Codec()
+    self._lock = threading.Lock()
+    self._stats = ContentionStats()
+
+  @property
+  def project(self) -> str:
+    return self._project
+
+  @property
+  def bucket(self) -> str:
+    return self._bucket
+
+  @property
+  def prefix(self) -> str:
+    return self._prefix
+
+  @property
+  def fs(self) -> gcsfs.GCSFileSystem:
+    """The project's shared GCS filesystem."""
+    return filesystem(self._project)
+
+  @property
+  def stats(self) -> ContentionStats:
+    """A snapshot of the datastore's write contention metrics."""
+    with self._lock:
+      return dataclasses.replace(self._stats)
+
+  def object_name(self, id: str) -> str:
+    """The name of the object, within the bucket, holding a document.
+
+    Args:
+        id (str): the document id
+
+    Returns:
+        str: the object name
+    """
+    if self._shards:
+      shard = zlib.crc32(id.encode('utf-8')) % self._shards
+      return f'{self._prefix}{shard:04x}'
+    return f'{self._prefix}{parse.quote(id, safe="")}'
+
+  def _by_object(self, ids: Iterator[str]) -> Dict[str, List[str]]:
+    objects = {}
+    for id in ids:
+      objects.setdefault(self.object_name(id), []).append(id)
+    return objects
+
+  def _map(self, f: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+    """Calls `f` on each item, in parallel if there are several."""
+    if len(items) < 2:
+      return [f(item) for item in items]
+
+    with futures.ThreadPoolExecutor(
+            max_workers=min(self._max_workers, len(items))) as pool:
+      return list(pool.map(f, items))
+
+  def _read(self, name: str) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Reads an object.
+
+    Args:
+        name (str): the object name
+
+    Returns:
+        Tuple[Dict[str, Any], Optional[str]]: the documents it holds, keyed
+                                              by id, and its generation
+                                              (None if it does not exist)
+    """
+    try:
+      headers, data = self.fs.call(
+          'GET', self.fs.url(f'{self._bucket}/{name}'))
+    except FileNotFoundError:
+      return {}, None
+
+    return codecs.decode(data), headers.get('x-goog-generation')
+
+  def _write(self, name: str, documents: Dict[str, Any],
+             generation: Optional[str] = None,
+             conditional: bool = True) -> None:
+    """Uploads an object, or deletes it if it would be empty.
+
+    Args:
+        name (str): the object name
+        documents (Dict[str, Any]): the documents, keyed by id
+        generation (str): the generation the object must still be, or None
+                          if it must not exist
+        conditional (bool): False to write regardless of generation
+
+    Raises:
+        FileExistsError: if the object is no longer `generation` (HTTP 412)
+    """
+    conditions = {'ifGenerationMatch': generation or '0'} if conditional \
+        else {}
+
+    if not documents:
+      if generation is None and conditional:
+        return
+      try:
+        self.fs.call('DELETE', api_url(self.fs, 'b', self._bucket, 'o', name),
+                     **conditions)
+      except FileNotFoundError:
+        if conditional:
+          raise FileExistsError(name)
+
+    else:
+      self.fs.call(
+          'POST', api_url(self.fs, 'b', self._bucket, 'o', upload=True),
+          uploadType='media', name=name,
+          data=self._codec.encode(documents),
+          headers={'Content-Type': self._codec.content_type}, json_out=True,
+          **conditions)
+
+    with self._lock:
+      self._stats.writes += 1
+
+  def _modify(self, name: str,
+              change: Callable[[Dict[str, Any]], bool]) -> None:
+    """Applies a change to the documents in an object, safely.
+
+    The object is read, `change` applied to its documents in place and the
+    result uploaded conditional on the object being unchanged; on a conflict
+    this is repeated after a randomized backoff.
+
+    Args:
+        name (str): the object name
+        change (Callable[[Dict[str, Any]], bool]): the change, returning
+                                                   False if it changed nothing
+    """
+    for attempt in itertools.count(1):
+      documents, generation = self._read(name)
+      if not change(documents):
+        return
+
+      try:
+        self._write(name, documents, generation)
+        break
+
+      except FileExistsError:
+        with self._lock:
+          self._stats.conflicts += 1
+          if attempt >= self._max_attempts:
+            self._stats.failed += 1
+            raise
+          delay = random.uniform(0, self._backoff * 2 ** (attempt - 1))
+          self._stats.backoff += delay
+        time.sleep(delay)
+
+    with self._lock:
+      self._stats.max_attempts = max(self._stats.max_attempts, attempt)
+
+  def _object_names(self) -> List[str]:
+    """The names of the objects under the prefix."""
+    names = []
+    params = {'prefix': self._prefix, 'fields': 'items(name),nextPageToken'}
+    while True:
+      page = self.fs.call('GET', api_url(self.fs, 'b', self._bucket, 'o'),
+                          json_out=True, **params)
+      names.extend(item['name'] for item in page.get('items', []))
+      if not (token := page.get('nextPageToken')):
+        break
+      params['pageToken'] = token
+    return names
+
+  def _read_all(self) -> Dict[str, Dict[str, Any]]:
+    """Reads every object under the prefix, in parallel."""
+    found = {}
+    for documents, _ in self._map(self._read, self._object_names()):
+      found.update(documents)
+    return found
+
+  def get_document(self, id: str, key: Optional[str] = None) -> Dict[str, Any]:
+    """Fetches a document.
+
+    Arguments:
+        id (str): document id
+        key: Optional(str): the document collection sub-key
+
+    Returns:
+        Dict[str, Any]: stored configuration dictionary, or None
+                          if not present
+    """
+    documents, _ = self._read(self.object_name(id))
+    if parent := documents.get(id):
+      if key:
+        value = parent.get(key)
+        return {key: value} if value else None
+      else:
+        return {id: parent}
+
+  def get_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents, reading their objects in parallel.
+
+    Arguments:
+        ids (List[str]): the document ids
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id
+    """
+    objects = self._by_object(ids)
+    found = {}
+    for (documents, _), wanted in zip(self._map(self._read, list(objects)),
+                                      objects.values()):
+      found.update({id: documents[id] for id in wanted if id in documents})
+    return {id: found[id] for id in ids if id in found}
+
+  def store_document(self, id: str, document: Dict[str, Any]) -> None:
+    """Stores a document, replacing any with the same id.
+
+    With one object per document this is a single upload.
+
+    Args:
+        id (str): the document id
+        document (Dict[str, Any]): the document
+    """
+    def _store(documents: Dict[str, Any]) -> bool:
+      documents[id] = document
+      return True
+
+    if self._shards:
+      self._modify(self.object_name(id), _store)
+    else:
+      self._write(self.object_name(id), {id: document}, conditional=False)
+
+  def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    If the document is not already there, it will be created as a net-new
+    document. If it is, it will be updated.
+
+    Args:
+        id (str): the id of the document within the collection.
+        new_data (Dict[str, Any]): the document content.
+    """
+    def _update(documents: Dict[str, Any]) -> bool:
+      documents[id] = documents.get(id, {}) | new_data
+      return True
+
+    self._modify(self.object_name(id), _update)
+
+  def _write_many(self, documents: Mapping[str, Dict[str, Any]],
+                  merge: bool) -> Dict[str, Optional[Exception]]:
+    """Writes many documents, one change per object, in parallel."""
+    objects = self._by_object(documents)
+
+    def _change(documents_in_object: Dict[str, Any], ids: List[str]) -> bool:
+      for id in ids:
+        documents_in_object[id] = \
+            (documents_in_object.get(id, {}) if merge else {}) | documents[id]
+      return True
+
+    def _write_object(name: str) -> Optional[Exception]:
+      try:
+        if not merge and not self._shards:
+          id, = objects[name]
+          self._write(name, {id: documents[id]}, conditional=False)
+        else:
+          self._modify(name, lambda stored: _change(stored, objects[name]))
+      except Exception as e:
+        return e
+
+    results = dict(zip(objects, self._map(_write_object, list(objects))))
+    return {id: results[self.object_name(id)] for id in documents}
+
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents, writing their objects in parallel.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that stopped it
+    """
+    return self._write_many(documents, merge=False)
+
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents, writing their objects in parallel.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: for each id, None if it was written or
+                                        the exception that stopped it
+    """
+    return self._write_many(documents, merge=True)
+
+  def delete_document(self, id: str, key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    If a key is supplied, then just that key is removed from the document. If
+    no key is given, the entire document is removed (and its object, once it
+    holds no documents). If neither is present, nothing will happen.
+
+    Args:
+        id (str): the id of the document.
+        key (str, optional): the key to remove. Defaults to None.
+    """
+    def _delete(documents: Dict[str, Any]) -> bool:
+      if key:
+        document = documents.get(id) or {}
+        return document.pop(key, None) is not None
+      return documents.pop(id, None) is not None
+
+    self._modify(self.object_name(id), _delete)
+
+  def list_documents(self, key: Optional[str] = None) -> List[str]:
+    """Lists documents.
+
+    Args:
+        key (str, optional): list the keys of this document instead of the
+                             document ids. Defaults to None.
+
+    Returns:
+        List[str]: the list
+    """
+    if key:
+      if document := self.get_document(key):
+        return list(document[key].keys())
+      return None
+
+    if self._shards:
+      ids = list(self._read_all())
+    else:
+      ids = [parse.unquote(name[len(self._prefix):])
+             for name in self._object_names()]
+    return ids or None
+
+  def get_all_documents(self) -> Dict[str, Dict[str, Any]]:
+    """Fetches every document, reading the objects in parallel.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: all the documents, keyed by id
+    """
+    return self._read_all()
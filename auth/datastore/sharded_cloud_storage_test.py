@@ -0,0 +1,294 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+import json
+import os
+import re
+import threading
+import unittest
+import uuid
+from concurrent import futures
+from typing import Any, Dict
+from unittest import mock
+from urllib import parse
+
+from auth.datastore import cloud_storage
+from auth.datastore import codecs
+from auth.datastore import sharded_cloud_storage
+
+MASTER_CONFIG = {
+    "auth": {
+        "api_key": "api_key",
+        "bHVrZUBza3l3YWxrZXIuY29t": {
+            "access_token": "access_token",
+            "refresh_token": "refresh_token",
+            "_key": "luke@skywalker.com"
+        },
+    },
+}
+
+LOCATION = 'https://storage.googleapis.com'
+
+
+class _FakeBucket(object):
+  """Answers the JSON API calls `ShardedCloudStorage` makes from memory.
+
+  Objects are kept as (data, generation), keyed by name. Preconditions are
+  honoured, listings are paged two names at a time and each call's method
+  (or 'LIST' for a listing) is recorded.
+  """
+
+  def __init__(self):
+    self.generations = itertools.count(1)
+    self.objects: Dict[str, Any] = {}
+    self.calls = []
+    self.lock = threading.Lock()
+
+  def url(self, path: str) -> str:
+    bucket, name = path.split('/', 1)
+    return f'{LOCATION}/download/storage/v1/b/{bucket}/o/{name}?alt=media'
+
+  def _check(self, name: str, params: Dict[str, Any]) -> None:
+    if (match := params.get('ifGenerationMatch')) is not None:
+      if match != str(self.objects.get(name, (None, 0))[1]):
+        raise FileExistsError(name)
+
+  def call(self, method: str, url: str, headers=None, data=None,
+           json_out=False, **params) -> Any:
+    with self.lock:
+      self.calls.append(method)
+      if match := re.match(r'.*/download/.*/o/(.*)\?alt=media', url):
+        if (name := match.group(1)) not in self.objects:
+          raise FileNotFoundError(name)
+        data, generation = self.objects[name]
+        return {'x-goog-generation': str(generation)}, data
+
+      if method == 'GET':
+        self.calls[-1] = 'LIST'
+        names = sorted(name for name in self.objects
+                       if name.startswith(params['prefix']))
+        start = int(params.get('pageToken', 0))
+        page = {'items': [{'name': name} for name in names[start:start + 2]]}
+        if start + 2 < len(names):
+          page['nextPageToken'] = str(start + 2)
+        return page
+
+      if method == 'DELETE':
+        name = parse.unquote(url.rsplit('/', 1)[1])
+        if name not in self.objects:
+          raise FileNotFoundError(name)
+        self._check(name, params)
+        del self.objects[name]
+        return {}, b''
+
+      self._check(params['name'], params)
+      generation = next(self.generations)
+      self.objects[params['name']] = (data, generation)
+      return {'generation': str(generation)}
+
+  def stored(self, name: str) -> Dict[str, Any]:
+    return json.loads(self.objects[name][0])
+
+
+class _ShardedCloudStorageTests(object):
+  """The behaviour every layout shares; mixed into a TestCase per layout."""
+  shards = None
+
+  def setUp(self):
+    cloud_storage._filesystems.clear()
+    self.fs = mock.patch('gcsfs.GCSFileSystem').start().return_value
+    self.bucket = _FakeBucket()
+    self.fs.base = f'{LOCATION}/storage/v1/'
+    self.fs.url.side_effect = self.bucket.url
+    self.fs.call.side_effect = self.bucket.call
+
+    self.datastore = self._datastore()
+    self.datastore.store_documents(MASTER_CONFIG)
+    self.bucket.calls.clear()
+
+  def tearDown(self):
+    mock.patch.stopall()
+    cloud_storage._filesystems.clear()
+
+  def _datastore(self, **kwargs) -> sharded_cloud_storage.ShardedCloudStorage:
+    return sharded_cloud_storage.ShardedCloudStorage(
+        project='westley', bucket='buttercup', shards=self.shards, **kwargs)
+
+  def test_get_document_with_key(self):
+    self.assertEqual({'api_key': 'api_key'},
+                     self.datastore.get_document('auth', 'api_key'))
+
+  def test_get_document_without_key(self):
+    self.assertEqual(MASTER_CONFIG, self.datastore.get_document('auth'))
+
+  def test_get_document_missing(self):
+    self.assertIsNone(self.datastore.get_document('10011'))
+    self.assertIsNone(self.datastore.get_document('auth', 'foo'))
+
+  def test_get_documents(self):
+    self.datastore.store_document(id='westley', document={'token': 'w'})
+    self.assertEqual({'auth': MASTER_CONFIG['auth'],
+                      'westley': {'token': 'w'}},
+                     self.datastore.get_documents(['auth', '10011',
+                                                   'westley']))
+
+  def test_store_document(self):
+    self.datastore.store_document(id='0000', document={'id': '0000'})
+    self.assertEqual({'0000': {'id': '0000'}},
+                     self.datastore.get_document('0000'))
+
+  def test_update_document_existing(self):
+    self.datastore.update_document(id='auth',
+                                   new_data={'api_key': 'new api key'})
+
+    auth = self.datastore.get_document('auth')['auth']
+    self.assertEqual('new api key', auth['api_key'])
+    self.assertIn('bHVrZUBza3l3YWxrZXIuY29t', auth)
+
+  def test_update_documents(self):
+    results = self.datastore.update_documents({'auth': {'api_key': 'new'},
+                                               '0000': {'id': '0000'}})
+
+    self.assertEqual({'auth': None, '0000': None}, results)
+    self.assertEqual({'api_key': 'new'},
+                     self.datastore.get_document('auth', 'api_key'))
+    self.assertEqual({'0000': {'id': '0000'}},
+                     self.datastore.get_document('0000'))
+
+  def test_delete_document(self):
+    self.datastore.delete_document(id='auth')
+    self.assertIsNone(self.datastore.get_document('auth'))
+    self.assertEqual({}, self.bucket.objects)
+
+  def test_delete_document_key(self):
+    self.datastore.delete_document(id='auth', key='api_key')
+    self.assertEqual(['bHVrZUBza3l3YWxrZXIuY29t'],
+                     self.datastore.list_documents('auth'))
+
+  def test_delete_document_missing_writes_nothing(self):
+    self.datastore.delete_document(id='auth', key='foo')
+    self.datastore.delete_document(id='10011')
+    self.assertNotIn('POST', self.bucket.calls)
+    self.assertNotIn('DELETE', self.bucket.calls)
+
+  def test_list_documents(self):
+    self.datastore.store_documents({'westley': {}, 'buttercup': {},
+                                    'inigo': {}, 'fezzik': {}})
+    self.assertEqual(['auth', 'buttercup', 'fezzik', 'inigo', 'westley'],
+                     sorted(self.datastore.list_documents()))
+
+  def test_list_documents_none(self):
+    self.datastore.delete_document(id='auth')
+    self.assertIsNone(self.datastore.list_documents())
+    self.assertIsNone(self.datastore.list_documents('foo'))
+
+  def test_get_all_documents(self):
+    self.datastore.store_document(id='westley', document={'token': 'w'})
+    self.assertEqual(MASTER_CONFIG | {'westley': {'token': 'w'}},
+                     self.datastore.get_all_documents())
+
+  def test_concurrent_updates_of_one_document(self):
+    with mock.patch('time.sleep'):
+      with futures.ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: self._datastore(max_attempts=100)
+                      .update_document(id='auth', new_data={f'key{i}': i}),
+                      range(20)))
+
+    self.assertEqual(22, len(self.datastore.list_documents('auth')))
+
+
+class OneObjectPerDocumentTest(_ShardedCloudStorageTests, unittest.TestCase):
+  def test_object_per_document(self):
+    self.datastore.store_document(id='a/b', document={'token': 'w'})
+
+    self.assertEqual({'datastore/auth', 'datastore/a%2Fb'},
+                     set(self.bucket.objects))
+    self.assertEqual({'a/b': {'token': 'w'}},
+                     self.bucket.stored('datastore/a%2Fb'))
+    self.assertIn('a/b', self.datastore.list_documents())
+
+  def test_codec_change_keeps_names(self):
+    gzipped = self._datastore(codec=codecs.Codec(compression='gzip'))
+    gzipped.update_document(id='auth', new_data={'api_key': 'new'})
+
+    self.assertEqual({'datastore/auth'}, set(self.bucket.objects))
+    self.assertTrue(
+        self.bucket.objects['datastore/auth'][0].startswith(codecs.MAGIC))
+    self.assertEqual({'api_key': 'new'},
+                     self.datastore.get_document('auth', 'api_key'))
+    self.assertEqual(['auth'], self.datastore.list_documents())
+
+  def test_store_document_single_upload(self):
+    self.datastore.store_document(id='westley', document={'token': 'w'})
+    self.assertEqual(['POST'], self.bucket.calls)
+
+  def test_list_documents_reads_nothing(self):
+    self.datastore.store_documents({'westley': {}, 'buttercup': {}})
+    self.bucket.calls.clear()
+    self.datastore.list_documents()
+
+    self.assertEqual(['LIST', 'LIST'], self.bucket.calls)   # two pages
+
+
+class HashedShardsTest(_ShardedCloudStorageTests, unittest.TestCase):
+  shards = 4
+
+  def test_bounded_objects(self):
+    self.datastore.store_documents({f'user{i}': {'token': i}
+                                    for i in range(100)})
+
+    self.assertLessEqual(len(self.bucket.objects), 4)
+    self.assertEqual(101, len(self.datastore.list_documents()))
+    self.assertEqual({'user42': {'token': 42}},
+                     self.datastore.get_document('user42'))
+
+  def test_one_write_per_shard(self):
+    self.datastore.store_documents({f'user{i}': {'token': i}
+                                    for i in range(100)})
+    self.assertEqual(4, self.bucket.calls.count('POST'))
+
+
+@unittest.skipUnless(os.environ.get('STORAGE_EMULATOR_HOST'),
+                     'needs a fake-gcs-server; set STORAGE_EMULATOR_HOST')
+class ShardedCloudStorageEmulatorTest(unittest.TestCase):
+  """Runs against a local fake GCS server; see `CloudStorageEmulatorTest`."""
+
+  def setUp(self):
+    cloud_storage._filesystems.clear()
+    self.bucket = f'florin-{uuid.uuid4().hex[:8]}'
+    cloud_storage.filesystem('florin').mkdir(self.bucket)
+
+  def tearDown(self):
+    cloud_storage.filesystem('florin').rm(self.bucket, recursive=True)
+    cloud_storage._filesystems.clear()
+
+  def test_parallel_writers(self):
+    datastore = sharded_cloud_storage.ShardedCloudStorage(
+        project='florin', bucket=self.bucket)
+    names = ['westley', 'buttercup', 'inigo', 'fezzik']
+
+    with futures.ThreadPoolExecutor(max_workers=len(names)) as pool:
+      list(pool.map(lambda name: datastore.store_document(
+          id=name, document={'token': name}), names))
+    datastore.update_document(id='westley', new_data={'farm': 'boy'})
+    datastore.delete_document(id='fezzik')
+
+    self.assertEqual({'westley': {'token': 'westley', 'farm': 'boy'},
+                      'buttercup': {'token': 'buttercup'},
+                      'inigo': {'token': 'inigo'}},
+                     datastore.get_all_documents())
+
+
+if __name__ == '__main__':
+  unittest.main()
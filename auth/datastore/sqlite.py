@@ -0,0 +1,276 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import contextlib
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+
+from auth.abstract_datastore import AbstractDatastore
+
+# The statements are constant, so sqlite3's statement cache prepares each one
+# only once per connection.
+_CREATE = '''
+CREATE TABLE IF NOT EXISTS documents (
+  id TEXT PRIMARY KEY,
+  document TEXT NOT NULL
+) WITHOUT ROWID'''
+_GET = 'SELECT document FROM documents WHERE id = ?'
+_GET_MANY = '''
+SELECT id, document FROM documents
+WHERE id IN (SELECT value FROM json_each(?))'''
+_GET_ALL = 'SELECT id, document FROM documents'
+_LIST = 'SELECT id FROM documents'
+_STORE = '''
+INSERT INTO documents (id, document) VALUES (?, ?)
+ON CONFLICT (id) DO UPDATE SET document = excluded.document'''
+_DELETE = 'DELETE FROM documents WHERE id = ?'
+_DELETE_KEY = '''
+UPDATE documents SET document = json_remove(document, ?) WHERE id = ?'''
+
+
+class SqliteDatastore(AbstractDatastore):
+  """A datastore for storing auth credentials in a local SQLite database.
+
+  Each document is one row, keyed by its id, so a read or write touches only
+  that row (an O(log n) primary key lookup) rather than the whole store. The
+  database runs in WAL mode, so readers do not block the writer, and it can
+  be shared by any number of threads (each gets its own connection) and
+  processes; writers wait up to `timeout` seconds for one another.
+
+  Behaves as `LocalFile` does.
+
+  Args:
+      datastore_file (str): the database file
+      timeout (float): how long to wait for another writer, in seconds
+      synchronous (str): the SQLite `synchronous` setting; NORMAL is durable
+                         against process crashes, FULL against power loss too
+  """
+
+  def __init__(self,
+               email: str = None,
+               project: str = None,
+               datastore_file: str = 'datastore.db',
+               timeout: float = 30.0,
+               synchronous: str = 'NORMAL') -> AbstractDatastore:
+    if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+      raise ValueError(f'Unknown synchronous setting: {synchronous}')
+
+    self._email = email
+    self._project = project
+    self._datastore_file = datastore_file
+    self._timeout = timeout
+    self._synchronous = synchronous.upper()
+    self._local = threading.local()
+    self._connections: List[sqlite3.Connection] = []
+    self._connections_lock = threading.Lock()
+
+    with self._transaction() as connection:
+      connection.execute(_CREATE)
+
+  @property
+  def datastore_file(self) -> str:
+    return self._datastore_file
+
+  @property
+  def connection(self) -> sqlite3.Connection:
+    """This thread's connection to the database, opened on first use."""
+    if (connection := getattr(self._local, 'connection', None)) is None:
+      connection = sqlite3.connect(self._datastore_file,
+                                   timeout=self._timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+      connection.execute('PRAGMA journal_mode = WAL')
+      connection.execute(f'PRAGMA synchronous = {self._synchronous}')
+      self._local.connection = connection
+      with self._connections_lock:
+        self._connections.append(connection)
+
+    return connection
+
+  @contextlib.contextmanager
+  def _transaction(self) -> Iterator[sqlite3.Connection]:
+    """Runs the block in a write transaction, taking the lock up front.
+
+    `BEGIN IMMEDIATE` makes a read-modify-write wait for other writers
+    before it reads, rather than failing when it comes to write.
+    """
+    connection = self.connection
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      yield connection
+    except BaseException:
+      connection.execute('ROLLBACK')
+      raise
+    connection.execute('COMMIT')
+
+  def close(self) -> None:
+    """Closes every thread's connection."""
+    with self._connections_lock:
+      for connection in self._connections:
+        connection.close()
+      self._connections.clear()
+    self._local = threading.local()
+
+  def __enter__(self) -> SqliteDatastore:
+    return self
+
+  def __exit__(self, *unused) -> None:
+    self.close()
+
+  def _read(self, connection: sqlite3.Connection,
+            id: str) -> Optional[Dict[str, Any]]:
+    if row := connection.execute(_GET, (id,)).fetchone():
+      return json.loads(row[0])
+
+  def get_document(self, id: str, key: Optional[str] = None) -> Dict[str, Any]:
+    """Fetches a document.
+
+    Arguments:
+        id (str): document id
+        key: Optional(str): the document collection sub-key
+
+    Returns:
+        Dict[str, Any]: stored configuration dictionary, or None
+                          if not present
+    """
+    if parent := self._read(self.connection, id):
+      if key:
+        value = parent.get(key)
+        return {key: value} if value else None
+      else:
+        return {id: parent}
+
+  def get_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetches many documents with a single query.
+
+    Arguments:
+        ids (List[str]): the document ids
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the documents found, keyed by id
+    """
+    rows = self.connection.execute(_GET_MANY, (json.dumps(list(ids)),))
+    return {id: json.loads(document) for id, document in rows}
+
+  def store_document(self, id: str, document: Dict[str, Any]) -> None:
+    """Stores a document, replacing any with the same id.
+
+    Args:
+        id (str): the document id
+        document (Dict[str, Any]): the document
+    """
+    self.connection.execute(_STORE, (id, json.dumps(document)))
+
+  def update_document(self, id: str, new_data: Dict[str, Any]) -> None:
+    """Updates a document.
+
+    If the document is not already there, it will be created as a net-new
+    document. If it is, the new data's keys replace its own, as in
+    `LocalFile`.
+
+    Args:
+        id (str): the id of the document within the collection.
+        new_data (Dict[str, Any]): the document content.
+    """
+    with self._transaction() as connection:
+      document = (self._read(connection, id) or {}) | new_data
+      connection.execute(_STORE, (id, json.dumps(document)))
+
+  def store_documents(self, documents: Mapping[str, Dict[str, Any]]
+                      ) -> Dict[str, Optional[Exception]]:
+    """Stores many documents in one transaction.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the documents, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    with self._transaction() as connection:
+      connection.executemany(_STORE, [(id, json.dumps(document))
+                                      for id, document in documents.items()])
+    return {id: None for id in documents}
+
+  def update_documents(self, documents: Mapping[str, Dict[str, Any]]
+                       ) -> Dict[str, Optional[Exception]]:
+    """Updates (or creates) many documents in one transaction.
+
+    Arguments:
+        documents (Mapping[str, Dict[str, Any]]): the new data, keyed by id
+
+    Returns:
+        Dict[str, Optional[Exception]]: None for each id; if the write fails
+                                        the exception is raised instead, as
+                                        no document was stored
+    """
+    with self._transaction() as connection:
+      for id, new_data in documents.items():
+        document = (self._read(connection, id) or {}) | new_data
+        connection.execute(_STORE, (id, json.dumps(document)))
+    return {id: None for id in documents}
+
+  def delete_document(self, id: str, key: Optional[str] = None) -> None:
+    """Deletes a document.
+
+    If a key is supplied, then just that key is removed from the document, in
+    place with `json_remove`. If no key is given, the entire document is
+    removed. If neither is present, nothing will happen.
+
+    Args:
+        id (str): the id of the document.
+        key (str, optional): the key to remove. Defaults to None.
+    """
+    if not key:
+      self.connection.execute(_DELETE, (id,))
+
+    elif '"' in key:
+      # A JSON path cannot quote this key, so rewrite the document instead.
+      with self._transaction() as connection:
+        if (document := self._read(connection, id)) and key in document:
+          document.pop(key)
+          connection.execute(_STORE, (id, json.dumps(document)))
+
+    else:
+      self.connection.execute(_DELETE_KEY, (f'$."{key}"', id))
+
+  def list_documents(self, key: Optional[str] = None) -> List[str]:
+    """Lists documents.
+
+    Args:
+        key (str, optional): list the keys of this document instead of the
+                             document ids. Defaults to None.
+
+    Returns:
+        List[str]: the list
+    """
+    if key:
+      if document := self._read(self.connection, key):
+        return list(document.keys())
+      return None
+
+    return [id for id, in self.connection.execute(_LIST)] or None
+
+  def get_all_documents(self) -> Dict[str, Dict[str, Any]]:
+    """Fetches every document.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: all the documents, keyed by id
+    """
+    return {id: json.loads(document)
+            for id, document in self.connection.execute(_GET_ALL)}
@@ -0,0 +1,83 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import multiprocessing
+import os
+import tempfile
+import unittest
+from concurrent import futures
+
+from auth.datastore import sqlite
+from auth.datastore.contract_test import DatastoreContract, MASTER_CONFIG
+
+
+def _update_many(datastore_file: str, prefix: str, count: int) -> None:
+  with sqlite.SqliteDatastore(datastore_file=datastore_file) as datastore:
+    for i in range(count):
+      datastore.update_document(id=f'{prefix}{i}', new_data={'token': i})
+
+
+class SqliteDatastoreTest(DatastoreContract, unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.datastore_file = os.path.join(self.directory.name, 'datastore.db')
+    self.datastore = sqlite.SqliteDatastore(datastore_file=self.datastore_file)
+    self.datastore.store_documents(MASTER_CONFIG)
+
+  def tearDown(self):
+    self.datastore.close()
+    self.directory.cleanup()
+
+  def test_delete_document_quoted_key(self):
+    self.datastore.update_document(id='auth', new_data={'"vizzini"': 1})
+    self.datastore.delete_document(id='auth', key='"vizzini"')
+    self.assertEqual(MASTER_CONFIG, self.datastore.get_all_documents())
+
+  def test_persists(self):
+    self.datastore.store_document(id='0000', document={'id': '0000'})
+    self.datastore.close()
+
+    with sqlite.SqliteDatastore(datastore_file=self.datastore_file) as other:
+      self.assertEqual({'0000': {'id': '0000'}}, other.get_document('0000'))
+
+  def test_bad_synchronous(self):
+    with self.assertRaises(ValueError):
+      sqlite.SqliteDatastore(datastore_file=self.datastore_file,
+                             synchronous='; DROP TABLE documents')
+
+  def test_threads(self):
+    def _update(i: int) -> None:
+      self.datastore.update_document(id='counter', new_data={f'key{i}': i})
+
+    with futures.ThreadPoolExecutor(max_workers=8) as pool:
+      list(pool.map(_update, range(100)))
+
+    self.assertEqual(100, len(self.datastore.list_documents('counter')))
+
+  def test_processes(self):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_update_many,
+                                 args=(self.datastore_file, name, 25))
+                 for name in ['westley', 'buttercup', 'inigo', 'fezzik']]
+    for process in processes:
+      process.start()
+    for process in processes:
+      process.join(30)
+
+    self.assertEqual(101, len(self.datastore.list_documents()))
+    self.assertEqual({'token': 24},
+                     self.datastore.get_document('fezzik24')['fezzik24'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -63,3 +63,31 @@ def implicit_create(creator: Callable) -> Any:
           ran_creator = True
     return wrapper
   return the_real_decorator
+
+
+def async_implicit_create(creator: Callable) -> Any:
+  """The coroutine version of `implicit_create`.
+
+  Both the decorated function and the `creator` must be coroutine functions.
+
+  Args:
+      creator (Callable): the coroutine function to execute
+
+  Returns:
+      Any: the result of the main function
+  """
+  def the_real_decorator(f: Callable) -> Any:
+    @wraps(f)
+    async def wrapper(*args, **kwargs) -> Any:
+      ran_creator = False
+      while True:
+        try:
+          value = await f(*args, **kwargs)
+          return value
+        except exceptions.NotFound:
+          if ran_creator:
+            return None
+          await creator(*args, **kwargs)
+          ran_creator = True
+    return wrapper
+  return the_real_decorator
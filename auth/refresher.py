@@ -0,0 +1,266 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent import futures
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple, Union
+
+from auth.credentials import Credentials
+
+
+@dataclass
+class RefresherStats(object):
+  """RefresherStats
+
+  A snapshot of the state of a `TokenRefresher`.
+
+  queue_depth is the number of refreshes that are due but have not yet been
+  started; lag is how late (in seconds) a refresh started after it was due.
+  """
+  tracked: int = 0
+  queue_depth: int = 0
+  in_flight: int = 0
+  refreshed: int = 0
+  failed: int = 0
+  last_lag: float = 0.0
+  max_lag: float = 0.0
+
+
+class TokenRefresher(object):
+  """Refreshes tracked users' tokens ahead of their expiry.
+
+  Every tracked `Credentials` is scheduled for a refresh `lead_time` before
+  its token expires, brought forward by a random amount up to `jitter` so
+  that tokens issued together are not all refreshed together. Due refreshes
+  are run in a pool of at most `max_workers` threads; the refreshed token is
+  stored through the `Credentials` object's datastore and placed in its token
+  cache, so request-path calls to `Credentials.credentials` find a valid
+  token and never wait for a refresh themselves. `lead_time` should therefore
+  be longer than the token cache's `skew`.
+
+  A failed refresh is retried after `retry_delay`.
+
+  The refresher can be used as a context manager; leaving the context shuts
+  it down, waiting for in-flight refreshes to finish.
+  """
+
+  def __init__(self,
+               lead_time: timedelta = timedelta(minutes=10),
+               jitter: timedelta = timedelta(minutes=2),
+               max_workers: int = 4,
+               retry_delay: timedelta = timedelta(seconds=30)
+               ) -> TokenRefresher:
+    self._lead_time = lead_time
+    self._jitter = jitter
+    self._max_workers = max_workers
+    self._retry_delay = retry_delay
+
+    self._tracked: Dict[str, Credentials] = {}
+    self._schedule: List[Tuple[float, int, str]] = []
+    self._pending: Dict[str, int] = {}
+    self._sequence = itertools.count()
+    self._condition = threading.Condition()
+    self._stats = RefresherStats()
+    self._stopping = False
+    self._executor: Optional[futures.ThreadPoolExecutor] = None
+    self._scheduler: Optional[threading.Thread] = None
+
+  def __enter__(self) -> TokenRefresher:
+    self.start()
+    return self
+
+  def __exit__(self, *unused) -> None:
+    self.shutdown()
+
+  @property
+  def stats(self) -> RefresherStats:
+    """A snapshot of the refresher's metrics."""
+    with self._condition:
+      now = time.time()
+      return RefresherStats(
+          tracked=len(self._tracked),
+          queue_depth=sum(1 for due, sequence, key in self._schedule
+                          if due <= now and self._pending.get(key) == sequence),
+          in_flight=self._stats.in_flight,
+          refreshed=self._stats.refreshed,
+          failed=self._stats.failed,
+          last_lag=self._stats.last_lag,
+          max_lag=self._stats.max_lag)
+
+  def start(self) -> None:
+    """Starts the scheduler and the worker pool."""
+    with self._condition:
+      if self._scheduler:
+        return
+
+      self._stopping = False
+      self._executor = futures.ThreadPoolExecutor(
+          max_workers=self._max_workers,
+          thread_name_prefix='token-refresher')
+      self._scheduler = threading.Thread(target=self._run,
+                                         name='token-refresher-scheduler',
+                                         daemon=True)
+      self._scheduler.start()
+
+  def shutdown(self, wait: bool = True) -> None:
+    """Stops the refresher.
+
+    No new refreshes are started. In-flight refreshes are allowed to finish,
+    and if `wait` is set this blocks until they have.
+
+    Args:
+        wait (bool): wait for in-flight refreshes to finish
+    """
+    with self._condition:
+      if not self._scheduler:
+        return
+
+      self._stopping = True
+      self._condition.notify_all()
+      scheduler, self._scheduler = self._scheduler, None
+      executor, self._executor = self._executor, None
+
+    scheduler.join()
+    executor.shutdown(wait=wait)
+
+  def track(self, credentials: Credentials) -> None:
+    """Starts refreshing a user's token ahead of its expiry.
+
+    If the token is already in the credentials' token cache, the refresh is
+    scheduled from its expiry; otherwise the token is loaded (and refreshed
+    if necessary) by a worker straight away.
+
+    Credentials are tracked by their `cache_key`, so the same user's tokens
+    in different datastores or projects are refreshed independently.
+
+    Args:
+        credentials (Credentials): the user's credentials
+    """
+    key = credentials.cache_key
+    expiry = credentials.token_cache.expiry(key)
+
+    with self._condition:
+      self._tracked[key] = credentials
+      self._push(key, self._due(expiry) if expiry else time.time())
+
+  def untrack(self, credentials: Union[Credentials, str]) -> None:
+    """Stops refreshing a user's token.
+
+    Args:
+        credentials (Union[Credentials, str]): the credentials given to
+            `track`, or a user's email to stop refreshing that user's tokens
+            in every datastore
+    """
+    with self._condition:
+      if isinstance(credentials, str):
+        keys = [key for key, tracked in self._tracked.items()
+                if tracked.email == credentials]
+      else:
+        keys = [credentials.cache_key]
+
+      for key in keys:
+        self._tracked.pop(key, None)
+        self._pending.pop(key, None)
+
+  def _latest(self, expiry: datetime) -> float:
+    """The latest time to refresh a token with the given (naive UTC) expiry.
+    """
+    return (expiry.replace(tzinfo=timezone.utc) - self._lead_time).timestamp()
+
+  def _due(self, expiry: datetime) -> float:
+    """When to refresh a token with the given (naive UTC) expiry."""
+    return self._latest(expiry) - random.uniform(0,
+                                                 self._jitter.total_seconds())
+
+  def _push(self, key: str, due: float) -> None:
+    """Schedules the refresh of a key, replacing any previously scheduled
+    one. The caller must hold the lock.
+    """
+    self._pending[key] = sequence = next(self._sequence)
+    heapq.heappush(self._schedule, (due, sequence, key))
+    self._condition.notify_all()
+
+  def _run(self) -> None:
+    """The scheduler loop.
+
+    Waits for the next refresh to fall due and for a worker to be free, then
+    hands the refresh to the pool. Refreshes for keys that have since been
+    untracked or rescheduled are dropped when they reach the head of the
+    schedule.
+    """
+    with self._condition:
+      while not self._stopping:
+        if not self._schedule:
+          self._condition.wait()
+          continue
+
+        due, _, key = self._schedule[0]
+        if (delay := due - time.time()) > 0:
+          self._condition.wait(timeout=delay)
+          continue
+
+        if self._stats.in_flight >= self._max_workers:
+          self._condition.wait()
+          continue
+
+        _, sequence, _ = heapq.heappop(self._schedule)
+        if self._pending.get(key) != sequence:
+          continue
+
+        del self._pending[key]
+        if credentials := self._tracked.get(key):
+          self._stats.in_flight += 1
+          self._executor.submit(self._refresh, key, credentials, due)
+
+  def _refresh(self, key: str, credentials: Credentials, due: float) -> None:
+    """Refreshes one token and schedules the next refresh.
+
+    Args:
+        key (str): the credentials' cache key
+        credentials (Credentials): the user's credentials
+        due (float): when the refresh was due, as a timestamp
+    """
+    lag = max(time.time() - due, 0.0)
+    refreshed = failed = 0
+    try:
+      creds = credentials.credentials
+      if self._latest(creds.expiry) <= time.time():
+        creds = credentials.refresh()
+        refreshed = 1
+      next_due = self._due(creds.expiry)
+
+    except Exception as e:
+      logging.warning('Token refresh for %s failed: %s', key, e)
+      next_due = time.time() + self._retry_delay.total_seconds()
+      failed = 1
+
+    with self._condition:
+      self._stats.in_flight -= 1
+      self._stats.refreshed += refreshed
+      self._stats.failed += failed
+      self._stats.last_lag = lag
+      self._stats.max_lag = max(self._stats.max_lag, lag)
+
+      if key in self._tracked and key not in self._pending:
+        self._push(key, next_due)
+      else:
+        self._condition.notify_all()
@@ -0,0 +1,162 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from google.oauth2 import credentials as oauth
+
+from auth.credentials_helpers import encode_key
+from auth.refresher import TokenRefresher
+from auth.token_cache import TokenCache
+
+
+def _now() -> datetime:
+  return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class _FakeCredentials(object):
+  """Just enough of `Credentials` for the refresher."""
+
+  def __init__(self, email: str, expires_in: timedelta,
+               release: threading.Event = None, fail: bool = False,
+               datastore: str = 'auth.datastore.local_file.LocalFile') -> None:
+    self.email = email
+    self.cache_key = f'{datastore}/{encode_key(email)}'
+    self.token_cache = TokenCache()
+    self.refreshes = 0
+    self._expiry = _now() + expires_in
+    self._release = release
+    self._fail = fail
+
+  @property
+  def credentials(self) -> oauth.Credentials:
+    return oauth.Credentials(token='token', expiry=self._expiry)
+
+  def refresh(self) -> oauth.Credentials:
+    if self._release:
+      self._release.wait(5)
+    if self._fail:
+      raise RuntimeError('inconceivable')
+    self.refreshes += 1
+    self._expiry = _now() + timedelta(hours=1)
+    return self.credentials
+
+
+def _wait_for(condition: Callable[[], bool]) -> None:
+  deadline = time.time() + 5
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+
+
+class TokenRefresherTest(unittest.TestCase):
+  def test_refreshes_ahead_of_expiry(self):
+    creds = _FakeCredentials('westley@princessbride.com',
+                             timedelta(minutes=5))
+    with TokenRefresher(lead_time=timedelta(minutes=10)) as refresher:
+      refresher.track(creds)
+      _wait_for(lambda: refresher.stats.refreshed == 1)
+      stats = refresher.stats
+
+    self.assertEqual(1, creds.refreshes)
+    self.assertEqual(1, stats.tracked)
+    self.assertEqual(0, stats.queue_depth)
+    self.assertEqual(0, stats.failed)
+
+  def test_not_refreshed_before_lead_time(self):
+    creds = _FakeCredentials('inigo@princessbride.com', timedelta(minutes=55))
+    with TokenRefresher(lead_time=timedelta(minutes=10)) as refresher:
+      refresher.track(creds)
+      time.sleep(0.2)
+
+    self.assertEqual(0, creds.refreshes)
+
+  def test_bounded_pool(self):
+    release = threading.Event()
+    all_creds = [_FakeCredentials(f'user{i}@princessbride.com',
+                                  timedelta(minutes=1), release=release)
+                 for i in range(5)]
+    with TokenRefresher(max_workers=2) as refresher:
+      for creds in all_creds:
+        refresher.track(creds)
+      _wait_for(lambda: refresher.stats.in_flight == 2)
+      time.sleep(0.1)
+      stats = refresher.stats
+      release.set()
+      _wait_for(lambda: refresher.stats.refreshed == 5)
+
+    self.assertEqual(2, stats.in_flight)
+    self.assertEqual(3, stats.queue_depth)
+    self.assertEqual(5, sum(c.refreshes for c in all_creds))
+
+  def test_shutdown_drains_in_flight(self):
+    release = threading.Event()
+    creds = _FakeCredentials('fezzik@princessbride.com',
+                             timedelta(minutes=1), release=release)
+    refresher = TokenRefresher()
+    refresher.start()
+    refresher.track(creds)
+    _wait_for(lambda: refresher.stats.in_flight == 1)
+
+    stopper = threading.Thread(target=refresher.shutdown)
+    stopper.start()
+    time.sleep(0.1)
+    self.assertTrue(stopper.is_alive())
+
+    release.set()
+    stopper.join(5)
+    self.assertFalse(stopper.is_alive())
+    self.assertEqual(1, creds.refreshes)
+
+  def test_failed_refresh_retried(self):
+    creds = _FakeCredentials('vizzini@princessbride.com',
+                             timedelta(minutes=1), fail=True)
+    with TokenRefresher(retry_delay=timedelta(seconds=0.05)) as refresher:
+      refresher.track(creds)
+      _wait_for(lambda: refresher.stats.failed >= 2)
+      stats = refresher.stats
+
+    self.assertGreaterEqual(stats.failed, 2)
+    self.assertEqual(0, stats.refreshed)
+
+  def test_untrack(self):
+    creds = _FakeCredentials('humperdinck@princessbride.com',
+                             timedelta(minutes=55))
+    with TokenRefresher() as refresher:
+      refresher.track(creds)
+      refresher.untrack(creds.email)
+      self.assertEqual(0, refresher.stats.tracked)
+
+  def test_same_user_in_two_datastores(self):
+    local = _FakeCredentials('fezzik@princessbride.com', timedelta(minutes=1))
+    firestore = _FakeCredentials('fezzik@princessbride.com',
+                                 timedelta(minutes=1),
+                                 datastore='auth.datastore.firestore.Firestore')
+    with TokenRefresher(lead_time=timedelta(minutes=10)) as refresher:
+      refresher.track(local)
+      refresher.track(firestore)
+      self.assertEqual(2, refresher.stats.tracked)
+      _wait_for(lambda: refresher.stats.refreshed == 2)
+
+      refresher.untrack(local)
+      self.assertEqual(1, refresher.stats.tracked)
+
+    self.assertEqual(1, local.refreshes)
+    self.assertEqual(1, firestore.refreshes)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,133 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import asyncio
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+@dataclass
+class _Call(object):
+  """A call in flight, and its eventual outcome."""
+  done: threading.Event = field(default_factory=threading.Event)
+  result: Any = None
+  error: Optional[BaseException] = None
+
+
+class SingleFlight(object):
+  """Coalesces concurrent calls for the same key into a single execution.
+
+  The first caller for a key (the 'leader') runs the function; every other
+  thread calling `do` with the same key while it is running blocks until it
+  finishes and then receives the same result, or has the same exception
+  raised. Once the call completes the key is forgotten, so the next caller
+  starts a new execution.
+  """
+
+  def __init__(self) -> SingleFlight:
+    self._lock = threading.Lock()
+    self._calls: Dict[str, _Call] = {}
+
+  def do(self, key: str, f: Callable[[], T]) -> T:
+    """Runs `f` once for all concurrent callers with the same key.
+
+    Args:
+        key (str): the key to coalesce calls on
+        f (Callable[[], T]): the function to run
+
+    Returns:
+        T: the result of the single execution of `f`
+    """
+    with self._lock:
+      if call := self._calls.get(key):
+        leader = False
+      else:
+        call = self._calls[key] = _Call()
+        leader = True
+
+    if not leader:
+      call.done.wait()
+      if call.error:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = f()
+      return call.result
+
+    except BaseException as e:
+      call.error = e
+      raise
+
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+  def in_flight(self, key: str) -> bool:
+    """Checks whether a call for the key is currently running.
+
+    Args:
+        key (str): the key
+
+    Returns:
+        bool: True if a call is in flight
+    """
+    with self._lock:
+      return key in self._calls
+
+
+class AsyncSingleFlight(object):
+  """Coalesces concurrent coroutine calls for the same key.
+
+  The asyncio counterpart of `SingleFlight`: the first caller for a key runs
+  the coroutine as a task and every other caller awaits that same task.
+  Calls are coalesced per event loop, so one instance may safely be shared by
+  loops running in different threads.
+
+  Cancelling a waiting caller does not cancel the shared call.
+  """
+
+  def __init__(self) -> AsyncSingleFlight:
+    self._lock = threading.Lock()
+    self._calls: Dict[Tuple[asyncio.AbstractEventLoop, str],
+                      asyncio.Task] = {}
+
+  async def do(self, key: str, f: Callable[[], Awaitable[T]]) -> T:
+    """Runs `f` once for all concurrent callers with the same key.
+
+    Args:
+        key (str): the key to coalesce calls on
+        f (Callable[[], Awaitable[T]]): the coroutine function to run
+
+    Returns:
+        T: the result of the single execution of `f`
+    """
+    call_key = (asyncio.get_running_loop(), key)
+    with self._lock:
+      if not (task := self._calls.get(call_key)):
+        task = self._calls[call_key] = asyncio.ensure_future(f())
+        task.add_done_callback(lambda t: self._forget(call_key, t))
+
+    return await asyncio.shield(task)
+
+  def _forget(self, call_key: Tuple[asyncio.AbstractEventLoop, str],
+              task: asyncio.Task) -> None:
+    with self._lock:
+      if self._calls.get(call_key) is task:
+        del self._calls[call_key]
@@ -0,0 +1,116 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import threading
+import time
+import unittest
+from concurrent import futures
+
+from auth.single_flight import AsyncSingleFlight, SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+  def test_single_caller(self):
+    flight = SingleFlight()
+    self.assertEqual('westley', flight.do('key', lambda: 'westley'))
+    self.assertFalse(flight.in_flight('key'))
+
+  def test_concurrent_callers_share_result(self):
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def _slow() -> str:
+      calls.append(1)
+      release.wait(5)
+      return 'buttercup'
+
+    with futures.ThreadPoolExecutor(max_workers=16) as pool:
+      results = [pool.submit(flight.do, 'key', _slow) for _ in range(16)]
+      time.sleep(0.2)
+      release.set()
+
+    self.assertEqual(['buttercup'] * 16, [r.result() for r in results])
+    self.assertEqual(1, len(calls))
+
+  def test_error_shared(self):
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def _fail() -> str:
+      started.set()
+      release.wait(5)
+      raise ValueError('inconceivable')
+
+    with futures.ThreadPoolExecutor(max_workers=2) as pool:
+      leader = pool.submit(flight.do, 'key', _fail)
+      started.wait(5)
+      follower = pool.submit(flight.do, 'key', lambda: 'never')
+      time.sleep(0.2)
+      release.set()
+
+    with self.assertRaisesRegex(ValueError, 'inconceivable'):
+      leader.result()
+    with self.assertRaises(ValueError):
+      follower.result()
+
+  def test_keys_independent(self):
+    flight = SingleFlight()
+    self.assertEqual('a', flight.do('a', lambda: 'a'))
+    self.assertEqual('b', flight.do('b', lambda: 'b'))
+
+
+class AsyncSingleFlightTest(unittest.IsolatedAsyncioTestCase):
+  async def test_concurrent_callers_share_result(self):
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def _slow() -> str:
+      calls.append(1)
+      await asyncio.sleep(0.05)
+      return 'buttercup'
+
+    results = await asyncio.gather(*[flight.do('key', _slow)
+                                     for _ in range(50)])
+
+    self.assertEqual(['buttercup'] * 50, results)
+    self.assertEqual(1, len(calls))
+
+  async def test_sequential_callers_not_coalesced(self):
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def _call() -> int:
+      calls.append(1)
+      return len(calls)
+
+    self.assertEqual(1, await flight.do('key', _call))
+    self.assertEqual(2, await flight.do('key', _call))
+
+  async def test_error_shared(self):
+    flight = AsyncSingleFlight()
+
+    async def _fail() -> str:
+      await asyncio.sleep(0.01)
+      raise ValueError('inconceivable')
+
+    results = await asyncio.gather(flight.do('key', _fail),
+                                   flight.do('key', _fail),
+                                   return_exceptions=True)
+    self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+
+if __name__ == '__main__':
+  unittest.main()
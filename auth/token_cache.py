@@ -0,0 +1,159 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from google.oauth2 import credentials as oauth
+
+
+class TokenCache(object):
+  """An in-process cache of OAuth credentials.
+
+  Building an `oauth.Credentials` object means a datastore read and a parse of
+  the stored token, which is wasteful when the access token is still valid for
+  most of its hour. The cache holds the built object, keyed by the user and
+  the datastore (see `credentials_helpers.cache_key`), until `skew` before
+  its expiry, after which it is evicted so the caller goes back to the
+  datastore (and refreshes).
+
+  The cache is bounded by `max_size`; when full, the least recently used
+  entry is evicted. A `max_size` of 0 disables caching completely.
+
+  All operations are thread-safe.
+  """
+
+  def __init__(self,
+               max_size: int = 10000,
+               skew: timedelta = timedelta(minutes=5)) -> TokenCache:
+    self._max_size = max_size
+    self._skew = skew
+    self._entries: OrderedDict[str, oauth.Credentials] = OrderedDict()
+    self._lock = threading.Lock()
+
+  @property
+  def max_size(self) -> int:
+    """The maximum number of cached credentials."""
+    return self._max_size
+
+  @max_size.setter
+  def max_size(self, max_size: int) -> None:
+    with self._lock:
+      self._max_size = max_size
+      self._trim()
+
+  @property
+  def skew(self) -> timedelta:
+    """How long before expiry a token is considered stale."""
+    return self._skew
+
+  @skew.setter
+  def skew(self, skew: timedelta) -> None:
+    self._skew = skew
+
+  def get(self, key: str) -> Optional[oauth.Credentials]:
+    """Fetches the cached credentials for a key.
+
+    Stale credentials are evicted rather than returned.
+
+    Args:
+        key (str): the cache key of the user
+
+    Returns:
+        oauth.Credentials: the credentials, or None if absent or stale
+    """
+    with self._lock:
+      if (creds := self._entries.get(key)) is None:
+        return None
+
+      if not self._is_fresh(creds):
+        del self._entries[key]
+        return None
+
+      self._entries.move_to_end(key)
+      return creds
+
+  def put(self, key: str, creds: oauth.Credentials) -> None:
+    """Caches the credentials for a key.
+
+    Credentials without an expiry, or which are already stale, are not cached
+    and any previous entry for the key is dropped.
+
+    Args:
+        key (str): the cache key of the user
+        creds (oauth.Credentials): the credentials
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+      if self._max_size > 0 and self._is_fresh(creds):
+        self._entries[key] = creds
+        self._trim()
+
+  def expiry(self, key: str) -> Optional[datetime]:
+    """The expiry of the cached credentials for a key, if any.
+
+    Args:
+        key (str): the cache key of the user
+
+    Returns:
+        datetime: the naive UTC expiry, or None if not cached
+    """
+    with self._lock:
+      creds = self._entries.get(key)
+      return creds.expiry if creds else None
+
+  def invalidate(self, key: str) -> None:
+    """Removes the cached credentials for a key.
+
+    Args:
+        key (str): the cache key of the user
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self) -> None:
+    """Empties the cache."""
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def __contains__(self, key: str) -> bool:
+    return self.get(key) is not None
+
+  def _is_fresh(self, creds: oauth.Credentials) -> bool:
+    """Checks the credentials are usable for at least `skew` longer.
+
+    `oauth.Credentials.expiry` is a naive datetime in UTC, so 'now' has to be
+    the same.
+    """
+    if not creds.token or not creds.expiry:
+      return False
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - self._skew > now
+
+  def _trim(self) -> None:
+    """Evicts least recently used entries until within `max_size`."""
+    while len(self._entries) > max(self._max_size, 0):
+      self._entries.popitem(last=False)
+
+
+# The process-wide cache shared by all `Credentials` objects unless one is
+# given explicitly.
+DEFAULT_TOKEN_CACHE = TokenCache()
@@ -0,0 +1,88 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from google.oauth2 import credentials as oauth
+
+from auth.token_cache import TokenCache
+
+
+def _creds(expires_in: timedelta) -> oauth.Credentials:
+  now = datetime.now(timezone.utc).replace(tzinfo=None)
+  return oauth.Credentials(token='token', expiry=now + expires_in)
+
+
+class TokenCacheTest(unittest.TestCase):
+  def test_get_missing(self):
+    cache = TokenCache()
+    self.assertIsNone(cache.get('westley'))
+
+  def test_put_and_get(self):
+    cache = TokenCache()
+    creds = _creds(timedelta(minutes=55))
+    cache.put('westley', creds)
+    self.assertIs(creds, cache.get('westley'))
+
+  def test_stale_not_cached(self):
+    cache = TokenCache(skew=timedelta(minutes=5))
+    cache.put('westley', _creds(timedelta(minutes=4)))
+    self.assertEqual(0, len(cache))
+    self.assertIsNone(cache.get('westley'))
+
+  def test_no_expiry_not_cached(self):
+    cache = TokenCache()
+    cache.put('westley', oauth.Credentials(token='token'))
+    self.assertIsNone(cache.get('westley'))
+
+  def test_evicted_inside_skew(self):
+    cache = TokenCache(skew=timedelta(minutes=5))
+    cache.put('westley', _creds(timedelta(minutes=10)))
+    cache.skew = timedelta(minutes=15)
+    self.assertIsNone(cache.get('westley'))
+    self.assertEqual(0, len(cache))
+
+  def test_lru_eviction(self):
+    cache = TokenCache(max_size=2)
+    cache.put('westley', _creds(timedelta(minutes=55)))
+    cache.put('buttercup', _creds(timedelta(minutes=55)))
+    cache.get('westley')
+    cache.put('inigo', _creds(timedelta(minutes=55)))
+
+    self.assertIn('westley', cache)
+    self.assertIn('inigo', cache)
+    self.assertNotIn('buttercup', cache)
+
+  def test_shrink(self):
+    cache = TokenCache(max_size=3)
+    for key in ['westley', 'buttercup', 'inigo']:
+      cache.put(key, _creds(timedelta(minutes=55)))
+    cache.max_size = 1
+    self.assertEqual(1, len(cache))
+    self.assertIn('inigo', cache)
+
+  def test_disabled(self):
+    cache = TokenCache(max_size=0)
+    cache.put('westley', _creds(timedelta(minutes=55)))
+    self.assertIsNone(cache.get('westley'))
+
+  def test_invalidate(self):
+    cache = TokenCache()
+    cache.put('westley', _creds(timedelta(minutes=55)))
+    cache.invalidate('westley')
+    self.assertIsNone(cache.get('westley'))
+
+
+if __name__ == '__main__':
+  unittest.main()
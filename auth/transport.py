@@ -0,0 +1,245 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import threading
+import weakref
+from typing import Any, AsyncIterator, Mapping, Optional
+
+import aiohttp
+import requests
+from google.auth import transport
+from google.auth.transport import requests as google_requests
+from requests import adapters
+
+try:
+  # Private to google-auth (the versions in requirements.txt have it) and
+  # only needed by `AsyncPooledRequest`, so losing it must not break the
+  # blocking transport.
+  from google.auth.transport import _aiohttp_requests
+except ImportError:
+  _aiohttp_requests = None
+
+
+class PooledRequest(google_requests.Request):
+  """A token-refresh transport backed by one pooled `requests.Session`.
+
+  `google.auth.transport.requests.Request()` creates a new session, and so a
+  new connection and TLS handshake, every time it is constructed. This
+  transport keeps a single session whose connection pool is shared by every
+  refresh made through it, so repeated refreshes against the token endpoint
+  reuse established connections.
+
+  Args:
+      pool_size (int): the maximum number of connections kept per host
+      keep_alive (bool): keep connections open between requests
+      timeout (float): the default per-request timeout in seconds
+      session (requests.Session): an existing session to use instead
+  """
+
+  def __init__(self,
+               pool_size: int = 10,
+               keep_alive: bool = True,
+               timeout: float = 30.0,
+               session: Optional[requests.Session] = None) -> PooledRequest:
+    if not session:
+      session = requests.Session()
+      adapter = adapters.HTTPAdapter(pool_connections=pool_size,
+                                     pool_maxsize=pool_size)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+
+    if not keep_alive:
+      session.headers['Connection'] = 'close'
+
+    self._timeout = timeout
+    super().__init__(session=session)
+
+  @property
+  def timeout(self) -> float:
+    """The default per-request timeout in seconds."""
+    return self._timeout
+
+  def __call__(self,
+               url: str,
+               method: str = 'GET',
+               body: Any = None,
+               headers: Optional[Mapping[str, str]] = None,
+               timeout: Optional[float] = None,
+               **kwargs) -> transport.Response:
+    return super().__call__(url,
+                            method=method,
+                            body=body,
+                            headers=headers,
+                            timeout=timeout or self._timeout,
+                            **kwargs)
+
+  def close(self) -> None:
+    """Closes the session and its pooled connections."""
+    self.session.close()
+
+
+_default_lock = threading.Lock()
+_default: Optional[PooledRequest] = None
+
+
+def default_transport() -> PooledRequest:
+  """The process-wide transport used for refreshes unless one is injected.
+
+  It is created on first use.
+
+  Returns:
+      PooledRequest: the shared transport
+  """
+  global _default
+  with _default_lock:
+    if _default is None:
+      _default = PooledRequest()
+    return _default
+
+
+def set_default_transport(request: Optional[PooledRequest]) -> None:
+  """Replaces the process-wide transport.
+
+  This is used to configure the pool size, keep-alive or timeout for every
+  `Credentials` object at once. Passing None reverts to a default transport
+  being created on next use. The previous transport is not closed.
+
+  Args:
+      request (PooledRequest): the new shared transport
+  """
+  global _default
+  with _default_lock:
+    _default = request
+
+
+class AsyncPooledRequest(
+        _aiohttp_requests.Request if _aiohttp_requests else object):
+  """The asyncio counterpart of `PooledRequest`, backed by `aiohttp`.
+
+  The `aiohttp.ClientSession` is bound to the event loop it is created on, so
+  it is created lazily on the first request. One instance must therefore only
+  be used from one event loop; `default_async_transport` keeps one per loop.
+  It can be used as an async context manager, closing the session on exit.
+
+  Args:
+      pool_size (int): the maximum number of concurrent connections
+      keep_alive (bool): keep connections open between requests
+      timeout (float): the default per-request timeout in seconds
+
+  Raises:
+      ImportError: if the installed google-auth has no aiohttp transport
+  """
+
+  def __init__(self,
+               pool_size: int = 100,
+               keep_alive: bool = True,
+               timeout: float = 30.0) -> AsyncPooledRequest:
+    if _aiohttp_requests is None:
+      raise ImportError('AsyncPooledRequest needs '
+                        'google.auth.transport._aiohttp_requests, which the '
+                        'installed google-auth does not have.')
+    self._pool_size = pool_size
+    self._keep_alive = keep_alive
+    self._timeout = timeout
+    super().__init__(session=None)
+
+  async def __aenter__(self) -> AsyncPooledRequest:
+    return self
+
+  async def __aexit__(self, *unused) -> None:
+    await self.close()
+
+  @property
+  def timeout(self) -> float:
+    """The default per-request timeout in seconds."""
+    return self._timeout
+
+  async def __call__(self,
+                     url: str,
+                     method: str = 'GET',
+                     body: Any = None,
+                     headers: Optional[Mapping[str, str]] = None,
+                     timeout: Optional[float] = None,
+                     **kwargs) -> transport.Response:
+    if self.session is None:
+      connector = aiohttp.TCPConnector(limit=self._pool_size,
+                                       force_close=not self._keep_alive)
+      self.session = aiohttp.ClientSession(connector=connector,
+                                           auto_decompress=False)
+
+    return await super().__call__(url,
+                                  method=method,
+                                  body=body,
+                                  headers=headers,
+                                  timeout=timeout or self._timeout,
+                                  **kwargs)
+
+  async def close(self) -> None:
+    """Closes the session and its pooled connections."""
+    if self.session is not None:
+      await self.session.close()
+      self.session = None
+
+
+# Each loop's shared transport.
+_async_defaults: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, AsyncPooledRequest] = \
+    weakref.WeakKeyDictionary()
+
+
+def default_async_transport() -> AsyncPooledRequest:
+  """The transport used for async refreshes on the running event loop.
+
+  It is created on first use. Its session stays open until closed with
+  `aclose_default_async_transport`, which `default_async_transport_context`
+  does on exit, so close it before the loop is closed.
+
+  Returns:
+      AsyncPooledRequest: the running loop's shared transport
+  """
+  loop = asyncio.get_running_loop()
+  with _default_lock:
+    if (request := _async_defaults.get(loop)) is None:
+      request = _async_defaults[loop] = AsyncPooledRequest()
+    return request
+
+
+async def aclose_default_async_transport() -> None:
+  """Closes the running event loop's shared transport, if it has one."""
+  loop = asyncio.get_running_loop()
+  with _default_lock:
+    request = _async_defaults.pop(loop, None)
+  if request:
+    await request.close()
+
+
+@contextlib.asynccontextmanager
+async def default_async_transport_context(
+) -> AsyncIterator[AsyncPooledRequest]:
+  """Yields the running loop's shared transport, closing it on exit.
+
+      async def main():
+        async with auth.transport.default_async_transport_context():
+          headers = await creds.auth_headers()
+
+  Yields:
+      AsyncPooledRequest: the running loop's shared transport
+  """
+  try:
+    yield default_async_transport()
+  finally:
+    await aclose_default_async_transport()
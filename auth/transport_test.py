@@ -0,0 +1,113 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+
+from auth import transport
+from auth.credentials import Credentials
+
+
+class PooledRequestTest(unittest.TestCase):
+  def test_pool_size(self):
+    request = transport.PooledRequest(pool_size=7)
+    adapter = request.session.get_adapter('https://oauth2.googleapis.com')
+    self.assertEqual(7, adapter._pool_maxsize)
+
+  def test_default_timeout(self):
+    session = mock.MagicMock()
+    request = transport.PooledRequest(timeout=3.5, session=session)
+    request('https://oauth2.googleapis.com/token', method='POST')
+    self.assertEqual(3.5, session.request.call_args.kwargs['timeout'])
+
+  def test_explicit_timeout(self):
+    session = mock.MagicMock()
+    request = transport.PooledRequest(timeout=3.5, session=session)
+    request('https://oauth2.googleapis.com/token', timeout=1)
+    self.assertEqual(1, session.request.call_args.kwargs['timeout'])
+
+  def test_no_keep_alive(self):
+    request = transport.PooledRequest(keep_alive=False)
+    self.assertEqual('close', request.session.headers['Connection'])
+
+  def test_default_transport_shared(self):
+    first = Credentials(datastore=mock.MagicMock(), email='westley@pb.com')
+    second = Credentials(datastore=mock.MagicMock(), email='inigo@pb.com')
+    self.assertIs(first.transport, second.transport)
+    self.assertIs(transport.default_transport(), first.transport)
+
+  def test_injected_transport(self):
+    request = transport.PooledRequest()
+    c = Credentials(datastore=mock.MagicMock(), email='westley@pb.com',
+                    transport=request)
+    self.assertIs(request, c.transport)
+
+  def test_set_default_transport(self):
+    request = transport.PooledRequest(pool_size=1)
+    try:
+      transport.set_default_transport(request)
+      self.assertIs(request, transport.default_transport())
+    finally:
+      transport.set_default_transport(None)
+    self.assertIsNot(request, transport.default_transport())
+
+
+
+class AsyncPooledRequestTest(unittest.TestCase):
+  def _open(self) -> transport.AsyncPooledRequest:
+    request = transport.default_async_transport()
+    request.session = aiohttp.ClientSession()
+    return request
+
+  def test_default_closed_on_context_exit(self):
+    async def _run():
+      async with transport.default_async_transport_context() as request:
+        self.assertIs(request, transport.default_async_transport())
+        request.session = aiohttp.ClientSession()
+        session = request.session
+      self.assertTrue(session.closed)
+      self.assertIsNot(request, transport.default_async_transport())
+      await transport.aclose_default_async_transport()
+
+    asyncio.run(_run())
+
+  def test_without_google_auth_aiohttp(self):
+    with mock.patch.object(transport, '_aiohttp_requests', None):
+      with self.assertRaises(ImportError):
+        transport.AsyncPooledRequest()
+
+  def test_async_context_manager(self):
+    async def _run():
+      async with transport.AsyncPooledRequest() as request:
+        request.session = aiohttp.ClientSession()
+        session = request.session
+      self.assertTrue(session.closed)
+      self.assertIsNone(request.session)
+
+    asyncio.run(_run())
+
+  def test_aclose_default(self):
+    async def _run():
+      request = self._open()
+      session = request.session
+      await transport.aclose_default_async_transport()
+      self.assertTrue(session.closed)
+      self.assertIsNot(request, transport.default_async_transport())
+
+    asyncio.run(_run())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the size and speed of the datastore codecs.
+
+A store of `--documents` tokens with random (so poorly compressible) values
+is encoded and decoded with the old `json.dumps(indent=2)` and with every
+codec whose libraries are installed. The best of `--repeat` runs is shown.
+
+    python -m benchmarks.codecs_benchmark --documents 10000
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import random
+import time
+from typing import Callable
+
+from auth.datastore import codecs
+
+
+def _token(rng: random.Random) -> dict:
+  def _random(length: int) -> str:
+    return base64.urlsafe_b64encode(rng.randbytes(length)).decode()
+
+  return {'access_token': f'ya29.{_random(128)}',
+          'refresh_token': f'1//{_random(76)}',
+          'token_uri': 'https://oauth2.googleapis.com/token',
+          'scopes': ['https://www.googleapis.com/auth/cloud-platform'],
+          'expiry': '2024-01-01T00:00:00'}
+
+
+def _best(f: Callable[[], object], repeat: int) -> float:
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    f()
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def _report(label: str, encode: Callable[[], bytes], repeat: int) -> None:
+  data = encode()
+  encode_time = _best(encode, repeat)
+  decode_time = _best(lambda: codecs.decode(data), repeat)
+  print(f'{label:<22} {len(data) / 2**20:8.2f} MiB '
+        f'{encode_time * 1000:9.1f} ms encode '
+        f'{decode_time * 1000:9.1f} ms decode')
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--documents', type=int, default=10_000)
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  rng = random.Random(0)
+  documents = {f'user{i}': _token(rng) for i in range(args.documents)}
+
+  _report('json indent=2 (old)',
+          lambda: json.dumps(documents, indent=2).encode('utf-8'),
+          args.repeat)
+  for format in codecs.Format:
+    for compression in codecs.Compression:
+      label = f'{format.value}+{compression.value}'
+      try:
+        codec = codecs.Codec(format, compression)
+      except ValueError:
+        print(f'{label:<22} not installed')
+        continue
+      _report(label, lambda: codec.encode(documents), args.repeat)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares cold start and memory of `LocalFile` and `IndexedFile`.
+
+A store of `--documents` tokens is written both as a `LocalFile` JSON file
+and as an `IndexedFile`. Each measurement runs in a fresh process, as a new
+worker would: the time from opening the store to having one user's token,
+and how much the process' resident memory grew in doing so (read from
+/proc, so Linux only).
+
+    python -m benchmarks.indexed_file_benchmark --documents 500000
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from auth.datastore import indexed_file, local_file
+
+
+def _token(i: int) -> dict:
+  return {'access_token': f'ya29.{i:0>170}',
+          'refresh_token': f'1//{i:0>100}',
+          'expiry': '2024-01-01T00:00:00'}
+
+
+def _rss_kib() -> int:
+  """The process' current resident memory.
+
+  `ru_maxrss` is not used, as Linux carries it over from the parent process.
+  """
+  with open('/proc/self/statm', 'r') as statm:
+    return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def _child(kind: str, path: str, id: str) -> None:
+  """Opens the store, reads one token and reports the cost as JSON."""
+  before = _rss_kib()
+  start = time.perf_counter()
+  if kind == 'LocalFile':
+    datastore = local_file.LocalFile(datastore_file=path)
+  else:
+    datastore = indexed_file.IndexedFile(datastore_file=path)
+  assert datastore.get_document(id)
+  elapsed = time.perf_counter() - start
+  print(json.dumps({'seconds': elapsed, 'rss_kib': _rss_kib() - before}))
+
+
+def _measure(kind: str, path: str, id: str) -> None:
+  result = json.loads(subprocess.run(
+      [sys.executable, '-m', 'benchmarks.indexed_file_benchmark',
+       '--child', kind, path, id],
+      check=True, capture_output=True, text=True).stdout)
+  print(f'{kind:<12} {os.path.getsize(path) / 2**20:8.1f} MiB '
+        f'{result["seconds"] * 1000:10.1f} ms to first token '
+        f'{result["rss_kib"] / 1024:8.1f} MiB RSS growth')
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--documents', type=int, default=500_000)
+  parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    _child(*args.child)
+    return
+
+  documents = {f'user{i}': _token(i) for i in range(args.documents)}
+  id = f'user{args.documents // 2}'
+  with tempfile.TemporaryDirectory() as directory:
+    json_file = os.path.join(directory, 'datastore.json')
+    with open(json_file, 'w') as store:
+      store.write(json.dumps(documents, indent=2))
+
+    indexed = os.path.join(directory, 'datastore.idx')
+    indexed_file.convert(json_file, indexed)
+    del documents
+
+    _measure('LocalFile', json_file, id)
+    _measure('IndexedFile', indexed, id)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the cost of each `LocalFile` durability level per write.
+
+Each level writes a store of `--documents` tokens `--writes` times to a file
+in `--directory` (the system temporary directory by default; point it at the
+filesystem you will actually use, as the cost of `fsync` depends on it). The
+in-place write the datastore used before is included as a baseline.
+
+    python -m benchmarks.local_file_durability_benchmark --writes 200
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Callable
+
+from auth.datastore import local_file
+
+
+def _in_place(path: str, data: str) -> None:
+  with open(path, 'w') as storage:
+    storage.write(data)
+
+
+def _run(label: str, writes: int, path: str, data: str,
+         write: Callable[[str, str], None]) -> None:
+  start = time.perf_counter()
+  for _ in range(writes):
+    write(path, data)
+  elapsed = time.perf_counter() - start
+  print(f'{label:<20} {elapsed * 1000 / writes:8.3f} ms/write')
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--writes', type=int, default=200)
+  parser.add_argument('--documents', type=int, default=1000)
+  parser.add_argument('--directory', default=None)
+  args = parser.parse_args()
+
+  data = json.dumps({f'user{i}': {'access_token': 'x' * 180,
+                                  'refresh_token': 'y' * 100,
+                                  'expiry': '2024-01-01T00:00:00'}
+                     for i in range(args.documents)}, indent=2)
+  print(f'{args.documents} documents, {len(data) / 1024:.0f} KiB per write')
+
+  with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+    path = os.path.join(directory, 'datastore.json')
+    _run('in place (before)', args.writes, path, data, _in_place)
+    for durability in local_file.Durability:
+      _run(f'atomic, {durability.value}', args.writes, path, data,
+           lambda p, d: local_file.write_atomic(p, d, durability))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares token write throughput of `LocalFile` and `LogStructured`.
+
+Each store is filled with 1k, 10k and 100k tokens, then `--writes` single
+token refreshes (`update_document`) are timed. Both use the same durability
+level (`--durability`), so the difference is the cost of rewriting the whole
+JSON file against appending one record.
+
+    python -m benchmarks.log_structured_benchmark --writes 100
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+
+from auth.abstract_datastore import AbstractDatastore
+from auth.datastore import local_file, log_structured
+
+
+def _token(i: int) -> dict:
+  return {'access_token': f'ya29.{i:0>170}',
+          'refresh_token': f'1//{i:0>100}',
+          'expiry': '2024-01-01T00:00:00'}
+
+
+def _run(label: str, datastore: AbstractDatastore, documents: int,
+         writes: int) -> None:
+  datastore.store_documents({f'user{i}': _token(i) for i in range(documents)})
+
+  start = time.perf_counter()
+  for i in range(writes):
+    datastore.update_document(id=f'user{i * 7919 % documents}',
+                              new_data=_token(i))
+  elapsed = time.perf_counter() - start
+  print(f'{documents:>7} {label:<14} {writes / elapsed:10.0f} writes/s '
+        f'{elapsed * 1000 / writes:9.3f} ms/write')
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--writes', type=int, default=100)
+  parser.add_argument('--durability', default='file',
+                      choices=[d.value for d in local_file.Durability])
+  parser.add_argument('--sizes', type=int, nargs='+',
+                      default=[1_000, 10_000, 100_000])
+  args = parser.parse_args()
+
+  for documents in args.sizes:
+    with tempfile.TemporaryDirectory() as directory:
+      _run('LocalFile', local_file.LocalFile(
+          datastore_file=os.path.join(directory, 'datastore.json'),
+          durability=args.durability), documents, args.writes)
+
+      with log_structured.LogStructured(
+              datastore_file=os.path.join(directory, 'datastore.log'),
+              durability=args.durability) as datastore:
+        _run('LogStructured', datastore, documents, args.writes)
+
+
+if __name__ == '__main__':
+  main()
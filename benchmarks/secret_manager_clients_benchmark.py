@@ -0,0 +1,98 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Counts Secret Manager clients (and so gRPC channels) per `update_document`.
+
+The client class is replaced by a fake that counts its instantiations and
+answers the calls `update_document` makes, so no project or network is
+needed. The 'before' case is `SecretManager` with its `client` property
+reverted to building a new client on every access.
+
+    python -m benchmarks.secret_manager_clients_benchmark --updates 100
+"""
+from __future__ import annotations
+
+import argparse
+from unittest import mock
+
+from google.cloud import secretmanager
+from google.cloud.secretmanager_v1.types import resources
+from google.protobuf import timestamp_pb2
+
+from auth.datastore import secret_manager
+
+
+class _CountingClient(object):
+  """Stands in for `SecretManagerServiceClient`, counting instantiations."""
+  created = 0
+  secret_path = staticmethod(
+      secretmanager.SecretManagerServiceClient.secret_path)
+  secret_version_path = staticmethod(
+      secretmanager.SecretManagerServiceClient.secret_version_path)
+
+  def __init__(self) -> None:
+    _CountingClient.created += 1
+    self.transport = mock.MagicMock()
+
+  def add_secret_version(self, request) -> resources.SecretVersion:
+    return resources.SecretVersion(
+        name=f'{request.parent}/versions/2',
+        create_time=timestamp_pb2.Timestamp(seconds=200))
+
+  def get_secret_version(self, request) -> resources.SecretVersion:
+    return resources.SecretVersion(name=request.name)
+
+  def list_secret_versions(self, request) -> mock.MagicMock:
+    page = mock.MagicMock()
+    page.versions = [resources.SecretVersion(
+        name=f'{request.parent}/versions/1',
+        create_time=timestamp_pb2.Timestamp(seconds=100))]
+    pager = mock.MagicMock()
+    pager.pages = [page]
+    return pager
+
+  def destroy_secret_version(self, request) -> None:
+    pass
+
+
+class _ClientPerAccess(secret_manager.SecretManager):
+  """The previous behaviour: a new client every time `client` is read."""
+  @property
+  def client(self) -> secretmanager.SecretManagerServiceClient:
+    return secretmanager.SecretManagerServiceClient()
+
+
+def _run(label: str, datastore: secret_manager.SecretManager,
+         updates: int) -> None:
+  _CountingClient.created = 0
+  for i in range(updates):
+    datastore.update_document(id=f'user{i}', new_data={'token': 'token'})
+  print(f'{label:<24} {_CountingClient.created / updates:6.2f} '
+        'clients per update_document')
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--updates', type=int, default=100)
+  args = parser.parse_args()
+
+  with mock.patch.object(secretmanager, 'SecretManagerServiceClient',
+                         _CountingClient):
+    _run('client per access', _ClientPerAccess(project='florin'),
+         args.updates)
+    _run('reused client', secret_manager.SecretManager(project='florin'),
+         args.updates)
+
+
+if __name__ == '__main__':
+  main()
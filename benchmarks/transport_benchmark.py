@@ -0,0 +1,133 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares a new `requests.Request()` per refresh with `PooledRequest`.
+
+A local HTTPS stand-in for the token endpoint (with a throwaway self-signed
+certificate) counts the TLS connections it accepts, so the handshakes saved by
+the pooled transport are visible alongside the wall-clock time.
+
+    python -m benchmarks.transport_benchmark --refreshes 200
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import http.server
+import ipaddress
+import json
+import os
+import ssl
+import tempfile
+import threading
+import time
+from typing import Callable
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from google.auth.transport import requests as google_requests
+
+from auth.transport import PooledRequest
+
+
+def _self_signed(directory: str) -> tuple[str, str]:
+  """Writes a self-signed certificate for 127.0.0.1 and its key."""
+  key = ec.generate_private_key(ec.SECP256R1())
+  name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+  now = datetime.datetime.now(datetime.timezone.utc)
+  cert = (x509.CertificateBuilder()
+          .subject_name(name).issuer_name(name)
+          .public_key(key.public_key())
+          .serial_number(x509.random_serial_number())
+          .not_valid_before(now)
+          .not_valid_after(now + datetime.timedelta(days=1))
+          .add_extension(x509.SubjectAlternativeName(
+              [x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+              critical=False)
+          .sign(key, hashes.SHA256()))
+
+  cert_file = os.path.join(directory, 'cert.pem')
+  key_file = os.path.join(directory, 'key.pem')
+  with open(cert_file, 'wb') as f:
+    f.write(cert.public_bytes(serialization.Encoding.PEM))
+  with open(key_file, 'wb') as f:
+    f.write(key.private_bytes(serialization.Encoding.PEM,
+                              serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption()))
+  return cert_file, key_file
+
+
+class _TokenHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  connections = 0
+
+  def setup(self) -> None:
+    _TokenHandler.connections += 1
+    super().setup()
+
+  def do_POST(self) -> None:
+    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    body = json.dumps({'access_token': 'token',
+                       'expires_in': 3600}).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *unused) -> None:
+    pass
+
+
+def _run(label: str, refreshes: int, url: str,
+         request: Callable[[], google_requests.Request]) -> None:
+  _TokenHandler.connections = 0
+  start = time.perf_counter()
+  for _ in range(refreshes):
+    request()(url, method='POST', body=b'grant_type=refresh_token',
+              headers={'Content-Type': 'application/x-www-form-urlencoded'})
+  elapsed = time.perf_counter() - start
+  print(f'{label:<28} {elapsed * 1000 / refreshes:8.2f} ms/refresh '
+        f'{_TokenHandler.connections:6d} TLS handshakes')
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--refreshes', type=int, default=200)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as directory:
+    cert_file, key_file = _self_signed(directory)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_file, key_file)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _TokenHandler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'https://127.0.0.1:{server.server_port}/token'
+    os.environ['REQUESTS_CA_BUNDLE'] = cert_file
+
+    try:
+      _run('requests.Request() per call', args.refreshes, url,
+           google_requests.Request)
+      pooled = PooledRequest()
+      _run('PooledRequest', args.refreshes, url, lambda: pooled)
+    finally:
+      server.shutdown()
+
+
+if __name__ == '__main__':
+  main()